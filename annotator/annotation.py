@@ -1,6 +1,22 @@
-from annotator import authz, document, es
+import calendar
+import datetime
+import json
+
+import iso8601
+
+from annotator import authz, document, es, events, tombstone
+from annotator.cache import LRUCache
+from annotator.elasticsearch import RESULTS_MAX_SIZE
 
 TYPE = 'annotation'
+
+# The fields whose most common values can be counted with facets()
+FACET_FIELDS = ('tags', 'user', 'uri', 'consumer')
+FACETS_DEFAULT_SIZE = 10
+
+# The fields and resolutions timeline() can compute histograms for
+TIMELINE_FIELDS = ('created', 'updated')
+TIMELINE_INTERVALS = ('hour', 'day', 'week')
 MAPPING = {
     'id': {'type': 'string', 'index': 'no'},
     'annotator_schema_version': {'type': 'string'},
@@ -62,8 +78,23 @@ class Annotation(es.Model):
                 doc.merge_links(links)
                 doc.save()
 
+        action = 'update' if 'id' in self else 'create'
+
         super(Annotation, self).save(*args, **kwargs)
 
+        events.publish(action, self)
+
+    def delete(self):
+        # Leave a tombstone behind, so that clients syncing incrementally can
+        # learn about the deletion.
+        if 'id' in self:
+            tombstone.Tombstone.for_annotation(self).save()
+
+        super(Annotation, self).delete()
+
+        if 'id' in self:
+            events.publish('delete', self)
+
     @classmethod
     def search_raw(cls, query=None, params=None, raw_result=False,
                    user=None, authorization_enabled=None):
@@ -83,24 +114,31 @@ class Annotation(es.Model):
         if authorization_enabled is None:
             authorization_enabled = es.authorization_enabled
         if authorization_enabled:
-            f = authz.permissions_filter(user)
-            if not f:
-                raise RuntimeError("Authorization filter creation failed")
-            filtered_query = {
-                'filtered': {
-                    'filter': f
-                }
-            }
-            # Insert original query (if present)
-            if 'query' in query:
-                filtered_query['filtered']['query'] = query['query']
-            # Use the filtered query instead of the original
-            query['query'] = filtered_query
+            authz.filter_query(query, user)
 
         res = super(Annotation, cls).search_raw(query=query, params=params,
                                                 raw_result=raw_result)
         return res
 
+    @classmethod
+    def msearch_raw(cls, queries, params=None,
+                    user=None, authorization_enabled=None):
+        """Perform several raw Elasticsearch queries in a single request
+
+        Keyword arguments:
+        queries -- Queries to send to Elasticsearch
+        params -- Extra keyword arguments to pass to Elasticsearch.msearch
+        user -- The user to filter the results for according to permissions
+        authorization_enabled -- Overrides Annotation.es.authorization_enabled
+        """
+        if authorization_enabled is None:
+            authorization_enabled = es.authorization_enabled
+        if authorization_enabled:
+            for query in queries:
+                authz.filter_query(query, user)
+
+        return super(Annotation, cls).msearch_raw(queries, params=params)
+
     @classmethod
     def _build_query(cls, query=None, offset=None, limit=None):
         if query is None:
@@ -128,7 +166,189 @@ class Annotation(es.Model):
 
         return q
 
+    @classmethod
+    def facets(cls, query=None, fields=FACET_FIELDS, size=FACETS_DEFAULT_SIZE,
+               **kwargs):
+        """Count the most common values of some fields
+
+        Only the annotations matching the query are counted, where the query
+        has the same meaning as for search.
+
+        Keyword arguments:
+        query -- A dict of field values, as for search
+        fields -- The fields to count values of
+        size -- The maximum number of values to return per field
+
+        Any other keyword arguments are passed on to search_raw.
+
+        Returns the total number of matching annotations, and for each field
+        a list of {'value': ..., 'count': ...} dicts, most common value first.
+        """
+        q = cls._build_query(query=query, offset=0, limit=0)
+        del q['sort']
+        q['aggs'] = dict((f, {'terms': {'field': f, 'size': size}})
+                         for f in fields)
+
+        res = cls.search_raw(q, raw_result=True, **kwargs)
+
+        aggs = res.get('aggregations', {})
+        facets = {}
+        for f in fields:
+            buckets = aggs.get(f, {}).get('buckets', [])
+            facets[f] = [{'value': b['key'], 'count': b['doc_count']}
+                         for b in buckets]
+
+        return res['hits']['total'], facets
+
+    # Buckets of a timeline that lie entirely in the past. Their counts only
+    # change when annotations are deleted (or, for 'updated', updated again),
+    # so the entries expire after an hour to bound how stale they get.
+    timeline_cache = LRUCache(maxsize=1000, ttl=3600, name='timeline')
+
+    @classmethod
+    def timeline(cls, query=None, field='created', interval='day',
+                 user=None, authorization_enabled=None):
+        """Count annotations per hour, day or week
+
+        Only the annotations matching the query are counted, where the query
+        has the same meaning as for search. Buckets that have closed are
+        cached, so that repeated calls only ask Elasticsearch for the
+        current one.
+
+        Keyword arguments:
+        query -- A dict of field values, as for search
+        field -- The date field to bucket annotations by
+        interval -- The size of the buckets: 'hour', 'day' or 'week'
+        user -- The user to filter the results for according to permissions
+        authorization_enabled -- Overrides Annotation.es.authorization_enabled
+
+        Returns a list of {'start': ..., 'count': ...} dicts, oldest first,
+        with the start time of each bucket in ISO 8601 format. Empty buckets
+        are left out.
+        """
+        if authorization_enabled is None:
+            authorization_enabled = es.authorization_enabled
+
+        q = cls._build_query(query=query, offset=0, limit=0)
+        del q['sort']
+        q['aggs'] = {'timeline': {'date_histogram': {'field': field,
+                                                     'interval': interval}}}
+
+        key = json.dumps([q, cls.es.index, _user_key(user, authorization_enabled)],
+                         sort_keys=True)
+        open_since = _bucket_start(_now(), interval)
+
+        cached = cls.timeline_cache.get(key)
+        if cached is not None:
+            closed_until, buckets = cached
+            q['query']['bool']['must'].append(
+                {'range': {field: {'gte': closed_until}}})
+        else:
+            buckets = []
+
+        res = cls.search_raw(q, raw_result=True, user=user,
+                             authorization_enabled=authorization_enabled)
+        buckets = buckets + [
+            {'key': b['key'], 'count': b['doc_count']}
+            for b in res['aggregations']['timeline']['buckets']]
+
+        cls.timeline_cache.set(
+            key, (open_since, [b for b in buckets if b['key'] < open_since]))
+
+        return [{'start': _from_epoch_ms(b['key']).isoformat(),
+                 'count': b['count']}
+                for b in buckets]
+
+    @classmethod
+    def count_by_uris(cls, uris, **kwargs):
+        """Count the annotations on each of the given URIs
+
+        Like a search on 'uri', each count includes the annotations on the
+        URIs known to be equivalent to it. All counts are computed with a
+        single Document lookup and a single aggregation query.
+
+        Keyword arguments are passed on to search_raw.
+        """
+        uris = list(uris)
+        if not uris:
+            return {}
+
+        # The first (i.e. oldest) document with a URI determines its
+        # equivalents, as in _build_query.
+        docs = document.Document.get_all_by_uris(
+            uris, limit=max(len(uris), RESULTS_MAX_SIZE))
+        doc_uris = [doc.uris() for doc in docs]
+        equivalents = {}
+        for uri in uris:
+            equivalents[uri] = next((u for u in doc_uris if uri in u), [uri])
+
+        all_uris = sorted(set(u for e in equivalents.values() for u in e))
+        q = {
+            'query': {'terms': {'uri': all_uris}},
+            'aggs': {'uri': {'terms': {'field': 'uri',
+                                       'size': len(all_uris)}}},
+            'size': 0,
+        }
+        res = cls.search_raw(q, raw_result=True, **kwargs)
+
+        counts = dict((b['key'], b['doc_count'])
+                      for b in res['aggregations']['uri']['buckets'])
+        return dict((uri, sum(counts.get(u, 0) for u in set(equivalents[uri])))
+                    for uri in uris)
+
+    @classmethod
+    def changes(cls, since=None, seen=None, uri=None, limit=None, **kwargs):
+        """Find annotations created or updated since a checkpoint
+
+        Results are ordered by their 'updated' field, oldest first, so that
+        the last result can serve as the checkpoint for the next call.
+
+        Keyword arguments:
+        since -- ISO 8601 timestamp; annotations updated at or after it match
+        seen -- [id, updated] pairs of the annotations already delivered with
+                'updated' in the millisecond of since
+        uri -- Only return annotations on this URI (or its equivalents)
+        limit -- The maximum number of annotations to return
+
+        Any other keyword arguments are passed on to search_raw.
+        """
+        query = {}
+        if uri is not None:
+            query['uri'] = uri
+
+        q = cls._build_query(query=query, offset=0, limit=limit)
+        return cls.search_changes(q, 'updated', since=since, seen=seen,
+                                  **kwargs)
+
 
 def _add_default_permissions(ann):
     if 'permissions' not in ann:
         ann['permissions'] = {'read': [authz.GROUP_CONSUMER]}
+
+
+def _user_key(user, authorization_enabled):
+    # What the permissions filter depends on, to key cached results by
+    if not authorization_enabled:
+        return None
+    if user is None:
+        return []
+    return [user.id, user.consumer.key, bool(user.is_admin)]
+
+
+def _bucket_start(dt, interval):
+    """Returns the start of the bucket dt falls in, in epoch milliseconds"""
+    dt = dt.replace(minute=0, second=0, microsecond=0)
+    if interval in ('day', 'week'):
+        dt = dt.replace(hour=0)
+    if interval == 'week':
+        # Like Elasticsearch, start weeks on Mondays
+        dt -= datetime.timedelta(days=dt.weekday())
+    return calendar.timegm(dt.utctimetuple()) * 1000
+
+
+def _from_epoch_ms(ms):
+    return datetime.datetime.fromtimestamp(ms / 1000.0, iso8601.iso8601.UTC)
+
+
+def _now():
+    return datetime.datetime.now(iso8601.iso8601.UTC)
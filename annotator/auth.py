@@ -4,6 +4,8 @@ import iso8601
 import jwt
 import six
 
+from annotator import metrics
+
 DEFAULT_TTL = 86400
 
 
@@ -107,6 +109,18 @@ def encode_token(token, secret):
 
 
 def decode_token(token, secret='', ttl=DEFAULT_TTL, verify=True):
+    try:
+        token = _decode_token(token, secret, ttl, verify)
+    except TokenInvalid:
+        metrics.TOKEN_DECODES.inc(verified=str(bool(verify)).lower(),
+                                  result='invalid')
+        raise
+    metrics.TOKEN_DECODES.inc(verified=str(bool(verify)).lower(),
+                              result='valid')
+    return token
+
+
+def _decode_token(token, secret, ttl, verify):
     try:
         if not type(token) is bytes:
             if six.PY3:
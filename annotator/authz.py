@@ -111,3 +111,21 @@ def permissions_filter(user=None):
             perm_f['or'].append({'term': {'consumer': user.consumer.key}})
 
     return perm_f
+
+
+def filter_query(query, user=None):
+    """Restrict an ElasticSearch query to what the current user may read"""
+    f = permissions_filter(user)
+    if not f:
+        raise RuntimeError("Authorization filter creation failed")
+    filtered_query = {
+        'filtered': {
+            'filter': f
+        }
+    }
+    # Insert original query (if present)
+    if 'query' in query:
+        filtered_query['filtered']['query'] = query['query']
+    # Use the filtered query instead of the original
+    query['query'] = filtered_query
+    return query
@@ -0,0 +1,60 @@
+"""
+A small in-process cache, for results that are expensive to compute and safe
+to share between requests.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+# All named caches, by name, to report their hit rates
+caches = {}
+
+
+class LRUCache(object):
+    """
+    A thread-safe mapping which holds at most maxsize entries, discarding the
+    least recently used ones first. Entries older than ttl seconds (if given)
+    are treated as missing.
+
+    Counts hits and misses, to tell whether the cache is worthwhile. A cache
+    given a name is listed in the module-level caches dict.
+    """
+
+    def __init__(self, maxsize=1000, ttl=None, name=None):
+        if name is not None:
+            caches[name] = self
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                stored, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if self.ttl is not None and stored + self.ttl < time.time():
+                self.misses += 1
+                return default
+            # Re-insert to mark as most recently used
+            self._data[key] = (stored, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time(), value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
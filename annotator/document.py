@@ -37,11 +37,12 @@ class Document(es.Model):
         return results[0] if len(results) > 0 else []
 
     @classmethod
-    def get_all_by_uris(cls, uris):
+    def get_all_by_uris(cls, uris, limit=None):
         """
         Returns a list of documents that have any of the supplied URIs.
 
-        It is only necessary for one of the supplied URIs to match.
+        It is only necessary for one of the supplied URIs to match. At most
+        limit documents are returned (Elasticsearch's default if None).
         """
         q = {'query': {'nested': {'path': 'link',
                                   'query': {'terms': {'link.href': uris}}}},
@@ -55,6 +56,8 @@ class Document(es.Model):
                                    # 'updated' appears unmapped due to an empty
                                    # index.
                                    'ignore_unmapped': True,}}]}
+        if limit is not None:
+            q['size'] = limit
 
         res = cls.es.conn.search(index=cls.es.index,
                                  doc_type=cls.__type__,
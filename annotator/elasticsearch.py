@@ -1,16 +1,21 @@
 from __future__ import absolute_import
 
+import copy
 import csv
+import hashlib
 import json
 import logging
 import datetime
+import time
 
 import iso8601
 
 import elasticsearch
 from six import iteritems
 from six.moves.urllib.parse import urlparse
+from annotator import memory, replay
 from annotator.atoi import atoi
+from annotator.timing import TimedConnection
 
 log = logging.getLogger(__name__)
 
@@ -29,10 +34,29 @@ class ElasticSearch(object):
     def __init__(self,
                  host = 'http://127.0.0.1:9200',
                  index = 'annotator',
-                 authorization_enabled = False):
+                 authorization_enabled = False,
+                 slowlog = None,
+                 record_path = None,
+                 replay_path = None,
+                 replay_latency = None,
+                 dual_write_index = None,
+                 upgrades = None):
         self.host = host
         self.index = index
         self.authorization_enabled = authorization_enabled
+        # An annotator.slowlog.SlowLog to report slow searches to, if any
+        self.slowlog = slowlog
+        # A file to record requests and responses to, or to replay them from
+        # instead of connecting to Elasticsearch (see annotator.replay)
+        self.record_path = record_path
+        self.replay_path = replay_path
+        self.replay_latency = replay_latency
+        # Another index to save and delete documents in too, while it is
+        # being reindexed into (see Reindexer.reindex_live)
+        self.dual_write_index = dual_write_index
+        # An annotator.upgrades.Upgrades to upgrade documents with as they are
+        # read, if any
+        self.upgrades = upgrades
 
         self.Model = make_model(self)
 
@@ -40,6 +64,9 @@ class ElasticSearch(object):
         host = self.host
         parsed = urlparse(host)
 
+        if parsed.scheme == 'memory':
+            return memory.connect(parsed.netloc + parsed.path)
+
         connargs = {
           'host': parsed.hostname,
         }
@@ -55,9 +82,22 @@ class ElasticSearch(object):
         if parsed.path:
             connargs['url_prefix'] = parsed.path
 
+        if self.replay_path is not None:
+            return elasticsearch.Elasticsearch(
+                hosts=[connargs],
+                connection_class=replay.ReplayConnection,
+                cassette=replay.Cassette.load(self.replay_path),
+                latency=self.replay_latency)
+
+        if self.record_path is not None:
+            return elasticsearch.Elasticsearch(
+                hosts=[connargs],
+                connection_class=replay.RecordingConnection,
+                recorder=replay.Recorder(self.record_path))
+
         conn = elasticsearch.Elasticsearch(
             hosts=[connargs],
-            connection_class=elasticsearch.Urllib3HttpConnection)
+            connection_class=TimedConnection)
         return conn
 
     @property
@@ -75,6 +115,8 @@ class _Model(dict):
        __mapping__ -- A mapping of the document's fields
 
        Mapping: Calling create_all() will create the mapping in the index.
+       The mapping carries a fingerprint of itself in its _meta, so that it
+       is only put again when it changed.
        One field, 'id', is treated specially. Its value will not be stored,
        but be used as the _id identifier of the document in Elasticsearch. If
        an item is indexed without providing an id, the _id is automatically
@@ -89,37 +131,71 @@ class _Model(dict):
 
     @classmethod
     def create_all(cls):
-        log.info("Creating index '%s'." % cls.es.index)
         conn = cls.es.conn
-        try:
-            conn.indices.create(cls.es.index)
-        except elasticsearch.exceptions.RequestError as e:
-            # Reraise anything that isn't just a notification that the index
-            # already exists (either as index or as an alias).
-            if not (e.error.startswith('IndexAlreadyExistsException')
-                    or e.error.startswith('InvalidIndexNameException')):
-                log.fatal("Failed to create an Elasticsearch index")
-                raise
-            log.warn("Index creation failed as index appears to already exist.")
         mapping = cls.get_mapping()
+        if not conn.indices.exists(cls.es.index):
+            log.info("Creating index '%s'." % cls.es.index)
+            try:
+                conn.indices.create(cls.es.index, body={'mappings': mapping})
+                return
+            except elasticsearch.exceptions.RequestError as e:
+                # Reraise anything that isn't just a notification that the
+                # index already exists (either as index or as an alias),
+                # like when another process created it in the meantime.
+                if not (e.error.startswith('IndexAlreadyExistsException')
+                        or e.error.startswith('InvalidIndexNameException')):
+                    log.fatal("Failed to create an Elasticsearch index")
+                    raise
+                log.warn("Index creation failed as index appears to already "
+                         "exist.")
+
+        current = cls._get_current_mapping()
+        fingerprint = mapping[cls.__type__]['_meta']['fingerprint']
+        if current is not None:
+            if current.get('_meta', {}).get('fingerprint') == fingerprint:
+                log.debug("Mapping of '%s' is up to date." % cls.__type__)
+                return
+            differences = _mapping_diff(current, mapping[cls.__type__])
+            log.info("Updating the mapping of '%s': %s" % (
+                cls.__type__, '; '.join(differences) or 'no field changed'))
         conn.indices.put_mapping(index=cls.es.index,
                                  doc_type=cls.__type__,
                                  body=mapping)
 
     @classmethod
     def get_mapping(cls):
-        return {
-            cls.__type__: {
-                '_id': {
-                    'path': 'id',
-                },
-                '_source': {
-                    'excludes': ['id'],
-                },
-                'analyzer': 'keyword',
-                'properties': cls.__mapping__,
-            }
+        mapping = {
+            '_id': {
+                'path': 'id',
+            },
+            '_source': {
+                'excludes': ['id'],
+            },
+            'analyzer': 'keyword',
+            'properties': cls.__mapping__,
         }
+        mapping['_meta'] = {'fingerprint': _fingerprint(mapping)}
+        return {cls.__type__: mapping}
+
+    @classmethod
+    def mapping_diff(cls):
+        """
+        Returns how the mapping of the document type in the index differs
+        from get_mapping(), as a list of differences of single fields.
+        """
+        current = cls._get_current_mapping() or {}
+        return ['{0}.{1}'.format(cls.__type__, d) for d in
+                _mapping_diff(current, cls.get_mapping()[cls.__type__])]
+
+    @classmethod
+    def _get_current_mapping(cls):
+        res = cls.es.conn.indices.get_mapping(index=cls.es.index)
+        # If the index is an alias, this is keyed by the index behind it
+        for index in res.values():
+            mapping = index.get('mappings', {}).get(cls.__type__)
+            if mapping is not None:
+                return mapping
+        return None
 
     @classmethod
     def drop_all(cls):
@@ -137,6 +213,8 @@ class _Model(dict):
                                   id=id)
         except elasticsearch.exceptions.NotFoundError:
             return None
+        if cls.es.upgrades is not None:
+            cls.es.upgrades.upgrade_hit(doc)
         return cls(doc['_source'], id=id)
 
     @classmethod
@@ -171,15 +249,99 @@ class _Model(dict):
             query = {}
         if params is None:
             params = {}
+        upgrades = cls.es.upgrades
+        if upgrades is not None and upgrades.write_back is not None:
+            # Upgraded documents are written back only if they are unchanged
+            # since, which takes knowing the version they were read at
+            params = dict(params, version=True)
+        start = time.time()
         res = cls.es.conn.search(index=cls.es.index,
                                  doc_type=cls.__type__,
                                  body=query,
                                  **params)
+        if cls.es.slowlog is not None:
+            cls.es.slowlog.observe(cls, query, params, time.time() - start)
+        if upgrades is not None:
+            _upgrade_hits(upgrades, res)
         if not raw_result:
             docs = res['hits']['hits']
             res = [cls(d['_source'], id=d['_id']) for d in docs]
         return res
 
+    @classmethod
+    def search_changes(cls, query, field, since=None, seen=None, **kwargs):
+        """Find documents changed at or after a checkpoint
+
+        Results are ordered by the date field holding the time of their last
+        change, oldest first, and at most query['size'] are returned.
+
+        Keyword arguments:
+        query -- A query as built by _build_query, to narrow down
+        field -- The date field holding the time of a document's last change
+        since -- ISO 8601 timestamp, to the millisecond; documents changed at
+                 or after it match
+        seen -- [id, time of change] pairs of the documents already delivered
+                in the millisecond of since, which are left out unless they
+                changed again since
+
+        Any other keyword arguments are passed on to search_raw.
+        """
+        clauses = query['query']['bool']
+        if since is not None:
+            clauses['must'].append({'range': {field: {'gte': since}}})
+        query['sort'] = [{field: {'order': 'asc', 'ignore_unmapped': True}}]
+
+        if since is None or not seen:
+            return cls.search_raw(query, **kwargs)
+
+        # Elasticsearch keeps dates to the millisecond, so the delivered
+        # documents are left out by the query itself, which keeps them from
+        # filling up the page, and only those of them which changed again in
+        # the same millisecond fetched by themselves, to compare the time of
+        # their change exactly.
+        delivered = dict(seen)
+        until = iso8601.parse_date(since) + datetime.timedelta(milliseconds=1)
+        within = {'gte': since, 'lt': until.isoformat()}
+        tie = {'bool': {'must': [{'ids': {'values': list(delivered)}},
+                                 {'range': {field: within}}]}}
+        again = copy.deepcopy(query)
+        again['query']['bool']['must'].append(tie)
+        again['from'] = 0
+        again['size'] = len(delivered)
+        clauses.setdefault('must_not', []).append(tie)
+
+        results = cls.search_raw(query, **kwargs)
+        results.extend(d for d in cls.search_raw(again, **kwargs)
+                       if d.get(field) != delivered.get(d['id']))
+        results.sort(key=lambda d: iso8601.parse_date(d[field]))
+        return results[:query['size']]
+
+    @classmethod
+    def msearch_raw(cls, queries, params=None):
+        """Perform several raw Elasticsearch queries in a single request
+
+        Returns Elasticsearch's response to each of the queries, in order. A
+        failed query has an 'error' key in its response rather than raising.
+
+        Keyword arguments:
+        queries -- Queries to send to Elasticsearch
+        params -- Extra keyword arguments to pass to Elasticsearch.msearch
+        """
+        if params is None:
+            params = {}
+        body = []
+        for query in queries:
+            body.append({})
+            body.append(query)
+        res = cls.es.conn.msearch(index=cls.es.index,
+                                  doc_type=cls.__type__,
+                                  body=body,
+                                  **params)
+        if cls.es.upgrades is not None:
+            for response in res['responses']:
+                _upgrade_hits(cls.es.upgrades, response)
+        return res['responses']
+
     @classmethod
     def count(cls, **kwargs):
         """Like search, but only count the number of matches."""
@@ -204,12 +366,35 @@ class _Model(dict):
                                  refresh=refresh)
         self['id'] = res['_id']
 
+        if self.es.dual_write_index is not None:
+            try:
+                self.es.conn.index(index=self.es.dual_write_index,
+                                   doc_type=self.__type__,
+                                   id=self['id'],
+                                   body=self,
+                                   refresh=refresh)
+            except elasticsearch.exceptions.ElasticsearchException:
+                log.exception("Failed to save %s %s to index %s too",
+                              self.__type__, self['id'],
+                              self.es.dual_write_index)
+
     def delete(self):
         if 'id' in self:
             self.es.conn.delete(index=self.es.index,
                                 doc_type=self.__type__,
                                 id=self['id'])
 
+            if self.es.dual_write_index is not None:
+                try:
+                    self.es.conn.delete(index=self.es.dual_write_index,
+                                        doc_type=self.__type__,
+                                        id=self['id'],
+                                        ignore=404)
+                except elasticsearch.exceptions.ElasticsearchException:
+                    log.exception("Failed to delete %s %s from index %s too",
+                                  self.__type__, self['id'],
+                                  self.es.dual_write_index)
+
 
 def make_model(es):
     return type('Model', (_Model,), {'es': es})
@@ -247,3 +432,36 @@ def _add_created(ann):
 
 def _add_updated(ann):
     ann['updated'] = datetime.datetime.now(iso8601.iso8601.UTC).isoformat()
+
+
+def _fingerprint(mapping):
+    mapping = dict((k, v) for k, v in iteritems(mapping) if k != '_meta')
+    return hashlib.sha1(json.dumps(mapping, sort_keys=True)
+                        .encode('utf-8')).hexdigest()
+
+
+def _mapping_diff(current, desired, path=''):
+    """
+    Returns the fields of a mapping whose values differ from those desired,
+    as a list of 'field is value, should be value' strings.
+    """
+    differences = []
+    for key, value in sorted(iteritems(desired)):
+        if not path and key == '_meta':
+            continue
+        field = path + '.' + key if path else key
+        if key not in current:
+            differences.append('{0} is missing, should be {1}'.format(
+                field, json.dumps(value, sort_keys=True)))
+        elif isinstance(value, dict) and isinstance(current[key], dict):
+            differences.extend(_mapping_diff(current[key], value, field))
+        elif current[key] != value:
+            differences.append('{0} is {1}, should be {2}'.format(
+                field, json.dumps(current[key], sort_keys=True),
+                json.dumps(value, sort_keys=True)))
+    return differences
+
+
+def _upgrade_hits(upgrades, res):
+    for hit in res.get('hits', {}).get('hits', ()):
+        upgrades.upgrade_hit(hit)
@@ -0,0 +1,147 @@
+"""
+A small publish/subscribe hub for annotation change events.
+
+Annotation.save and Annotation.delete publish an event on the channel of the
+annotation's URI; the store's stream endpoint subscribes to these channels and
+forwards the events to its clients.
+
+The default LocalBroker only delivers events within the current process. To
+share events between several worker processes, replace the module-level
+broker with one backed by a shared service, e.g.:
+
+    from annotator import events
+    events.broker = events.RedisBroker('redis://localhost:6379/0')
+
+Any object with the same publish() and subscribe() methods will do.
+"""
+from __future__ import absolute_import
+
+import json
+import logging
+import threading
+
+from six.moves import queue
+
+log = logging.getLogger(__name__)
+
+# The number of undelivered events a subscriber may have pending before it is
+# considered too slow and further events are dropped.
+SUBSCRIPTION_MAXSIZE = 1000
+
+
+class Subscription(object):
+    """A subscriber's queue of events on one or more channels"""
+
+    def __init__(self, channels, maxsize=SUBSCRIPTION_MAXSIZE):
+        self.channels = list(channels)
+        self.overflowed = False
+        self._queue = queue.Queue(maxsize)
+
+    def put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout=None):
+        """Wait for the next event, or return None after timeout seconds"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        pass
+
+
+class LocalBroker(object):
+    """Delivers events to subscribers in the current process only"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+
+    def publish(self, channel, event):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for s in subscriptions:
+            s.put(event)
+
+    def subscribe(self, channels):
+        s = _LocalSubscription(self, channels)
+        with self._lock:
+            for channel in s.channels:
+                self._subscriptions.setdefault(channel, set()).add(s)
+        return s
+
+    def _unsubscribe(self, s):
+        with self._lock:
+            for channel in s.channels:
+                subscriptions = self._subscriptions.get(channel, set())
+                subscriptions.discard(s)
+                if not subscriptions:
+                    self._subscriptions.pop(channel, None)
+
+
+class _LocalSubscription(Subscription):
+
+    def __init__(self, broker, channels):
+        super(_LocalSubscription, self).__init__(channels)
+        self._broker = broker
+
+    def close(self):
+        self._broker._unsubscribe(self)
+
+
+class RedisBroker(object):
+    """
+    Delivers events through Redis pub/sub, so that all processes connected to
+    the same Redis server share them. Requires the 'redis' package.
+    """
+
+    def __init__(self, url, prefix='annotator:'):
+        import redis
+        self.prefix = prefix
+        self._redis = redis.StrictRedis.from_url(url)
+
+    def publish(self, channel, event):
+        self._redis.publish(self.prefix + channel, json.dumps(event))
+
+    def subscribe(self, channels):
+        return _RedisSubscription(self, channels)
+
+
+class _RedisSubscription(Subscription):
+
+    def __init__(self, broker, channels):
+        super(_RedisSubscription, self).__init__(channels)
+        self._pubsub = broker._redis.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(*[broker.prefix + c for c in self.channels])
+
+    def get(self, timeout=None):
+        message = self._pubsub.get_message(timeout=timeout)
+        if message is None:
+            return None
+        data = message['data']
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+    def close(self):
+        self._pubsub.close()
+
+
+broker = LocalBroker()
+
+
+def publish(action, annotation):
+    """Publish a change to an annotation on the channel of its URI"""
+    uri = annotation.get('uri')
+    if not uri:
+        return
+    try:
+        broker.publish(uri, {'action': action, 'annotation': dict(annotation)})
+    except Exception:
+        # Failing to notify subscribers must not fail the change itself.
+        log.exception("Failed to publish %s event for annotation %s",
+                      action, annotation.get('id'))
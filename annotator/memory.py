@@ -0,0 +1,1273 @@
+"""
+An in-memory stand-in for the Elasticsearch client.
+
+It implements the parts of the client API and of the query DSL which annotator
+itself uses, closely enough to run the store, its tests and benchmarks without
+an Elasticsearch cluster. Select it by setting the Elasticsearch host to
+'memory://'. Wrappers given the same memory:// URL share their data, like
+clients of the same cluster would.
+
+Every document type keeps dict-based inverted indexes, mapping each term of
+each field to the ids of the documents containing it. These answer match, term,
+terms, ids and prefix queries; range queries, sorting and aggregations look at
+the flattened fields of the matching documents. Notable differences from
+Elasticsearch:
+
+- Changes are visible immediately, without a refresh.
+- Dates are compared with microsecond rather than millisecond precision.
+- All hits score 1.0. Without a sort, they are returned in indexing order.
+- Nested objects are matched as if they were plain objects.
+- Only the 'keyword' analyzer and an approximation of the 'standard' analyzer
+  (lowercased words) are known.
+- query_string queries understand only whitespace-separated [field:]value
+  terms, optionally quoted, prefixed with + or -, or joined by AND, OR and
+  NOT.
+- Date histograms never return empty buckets.
+"""
+from __future__ import absolute_import
+
+import base64
+import calendar
+import copy
+import datetime
+import fnmatch
+import json
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import iso8601
+from elasticsearch.exceptions import ConflictError, NotFoundError
+from elasticsearch.exceptions import RequestError, TransportError
+from elasticsearch.serializer import JSONSerializer
+from six import iteritems, string_types
+
+# The size of a search response if the query does not give one
+DEFAULT_SIZE = 10
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+# Unmapped strings like this are mapped as dates, as Elasticsearch does
+_DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}(T\d{2}:\d{2}(:\d{2}(\.\d+)?)?'
+                      r'(Z|[+-]\d{2}:?\d{2})?)?$')
+_QUERY_STRING_RE = re.compile(r'([+-]?)(?:([\w.]+):)?("[^"]*"|\S+)',
+                              re.UNICODE)
+
+# Keys of a query or filter body which are options rather than field names
+_OPTIONS = ('_cache', '_cache_key', '_name', 'boost')
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def connect(name=''):
+    """Returns the client of the named in-memory store, creating it first"""
+    with _stores_lock:
+        if name not in _stores:
+            _stores[name] = MemoryElasticsearch()
+        return _stores[name]
+
+
+class MemoryElasticsearch(object):
+    """Implements the parts of elasticsearch.Elasticsearch annotator uses"""
+
+    def __init__(self):
+        self.indices = _IndicesClient(self)
+        self.cluster = _ClusterClient(self)
+        self.nodes = _NodesClient(self)
+        self._lock = threading.RLock()
+        self._indices = {}
+        self._aliases = {}
+        self._scrolls = {}
+        # The bulk helpers serialize actions with the transport's serializer
+        self.transport = _Transport()
+
+    def ping(self, **params):
+        return True
+
+    def info(self, **params):
+        return {'status': 200,
+                'name': 'memory',
+                'version': {'number': '1.7.0'},
+                'tagline': 'You Know, for Search'}
+
+    def get(self, index, id, doc_type='_all', **params):
+        id = str(id)
+        with self._lock:
+            idx = self._write_index(index)
+            for t in idx.doc_types(doc_type):
+                if id in t.docs:
+                    return {'_index': idx.name,
+                            '_type': t.name,
+                            '_id': id,
+                            '_version': t.versions[id],
+                            'found': True,
+                            '_source': copy.deepcopy(t.docs[id])}
+            missing = {'_index': idx.name, '_type': doc_type, '_id': id,
+                       'found': False}
+            if 404 in _ignored(params):
+                return missing
+            raise NotFoundError(404, 'DocumentMissingException', missing)
+
+    def exists(self, index, id, doc_type='_all', **params):
+        try:
+            self.get(index, id, doc_type=doc_type)
+        except NotFoundError:
+            return False
+        return True
+
+    def index(self, index, doc_type, body, id=None, op_type=None, **params):
+        with self._lock:
+            idx = self._write_index(index, create=True)
+            return idx.doc_type(doc_type).index(self._copy(body), id, op_type,
+                                                idx.name,
+                                                version=params.get('version'))
+
+    def create(self, index, doc_type, body, id=None, **params):
+        return self.index(index, doc_type, body, id=id, op_type='create')
+
+    def delete(self, index, doc_type, id, **params):
+        id = str(id)
+        with self._lock:
+            idx = self._write_index(index)
+            t = idx.types.get(doc_type)
+            if t is None or id not in t.docs:
+                missing = {'_index': idx.name, '_type': doc_type, '_id': id,
+                           'found': False}
+                if 404 in _ignored(params):
+                    return missing
+                raise NotFoundError(404, 'DocumentMissingException', missing)
+            version = t.delete(id)
+            return {'found': True, '_index': idx.name, '_type': doc_type,
+                    '_id': id, '_version': version}
+
+    def search(self, index=None, doc_type=None, body=None, **params):
+        start = time.time()
+        body = body or {}
+        search_type = params.get('search_type')
+        size = params.get('size', body.get('size', DEFAULT_SIZE))
+        offset = params.get('from_', params.get('from', body.get('from', 0)))
+        size, offset = int(size), int(offset)
+        version = params.get('version', body.get('version')) in (True, 'true')
+
+        with self._lock:
+            matches = []
+            for idx in self._search_indices(index):
+                for t in idx.doc_types(doc_type):
+                    ids = _evaluate(t, body.get('query', {'match_all': {}}))
+                    if 'post_filter' in body:
+                        ids &= _evaluate(t, body['post_filter'])
+                    matches.extend((idx, t, i) for i in t.docs if i in ids)
+
+            aggs = body.get('aggs', body.get('aggregations'))
+            aggregations = _aggregate(matches, aggs) if aggs else None
+
+            sort = _sort_spec(body.get('sort'))
+            if sort and search_type != 'scan':
+                matches = _sort(matches, sort)
+
+            res = {'took': 0,
+                   'timed_out': False,
+                   '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+                   'hits': {'total': len(matches),
+                            'max_score': 1.0 if matches else None,
+                            'hits': []}}
+            if aggregations is not None:
+                res['aggregations'] = aggregations
+
+            if search_type == 'count':
+                return res
+            if 'scroll' in params:
+                # Copy all remaining hits now, as a scroll sees a snapshot
+                hits = [_hit(idx, t, i, sort, version)
+                        for idx, t, i in matches[offset:]]
+                if search_type != 'scan':
+                    res['hits']['hits'], hits = hits[:size], hits[size:]
+                res['_scroll_id'] = _new_id()
+                self._scrolls[res['_scroll_id']] = (hits, size)
+            else:
+                res['hits']['hits'] = [
+                    _hit(idx, t, i, sort, version)
+                    for idx, t, i in matches[offset:offset + size]]
+
+            res['took'] = int((time.time() - start) * 1000)
+        return res
+
+    def scroll(self, scroll_id=None, body=None, **params):
+        if scroll_id is None:
+            scroll_id = body['scroll_id'] if isinstance(body, dict) else body
+        with self._lock:
+            if scroll_id not in self._scrolls:
+                raise NotFoundError(404, 'SearchContextMissingException', {})
+            rest, size = self._scrolls[scroll_id]
+            page, rest = rest[:size], rest[size:]
+            self._scrolls[scroll_id] = (rest, size)
+        return {'_scroll_id': scroll_id,
+                'took': 0,
+                'timed_out': False,
+                '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+                'hits': {'total': len(page) + len(rest),
+                         'max_score': 1.0 if page else None,
+                         'hits': page}}
+
+    def clear_scroll(self, scroll_id=None, body=None, **params):
+        with self._lock:
+            if scroll_id is None:
+                self._scrolls.clear()
+            else:
+                for i in scroll_id.split(','):
+                    self._scrolls.pop(i, None)
+        return {}
+
+    def msearch(self, body, index=None, doc_type=None, **params):
+        lines = self._lines(body)
+        responses = []
+        for header, query in zip(lines[::2], lines[1::2]):
+            kwargs = dict(params)
+            if 'search_type' in header:
+                kwargs['search_type'] = header['search_type']
+            try:
+                responses.append(self.search(
+                    index=header.get('index', index),
+                    doc_type=header.get('type', doc_type),
+                    body=query,
+                    **kwargs))
+            except TransportError as e:
+                responses.append({'error': e.error})
+        return {'responses': responses}
+
+    def count(self, index=None, doc_type=None, body=None, **params):
+        res = self.search(index=index, doc_type=doc_type, body=body,
+                          search_type='count')
+        return {'count': res['hits']['total'], '_shards': res['_shards']}
+
+    def delete_by_query(self, index, doc_type=None, body=None, **params):
+        body = body or {}
+        with self._lock:
+            result = {}
+            for idx in self._search_indices(index):
+                for t in idx.doc_types(doc_type):
+                    query = body.get('query', {'match_all': {}})
+                    for i in _evaluate(t, query):
+                        t.delete(i)
+                result[idx.name] = {'_shards': {'total': 1, 'successful': 1,
+                                                'failed': 0}}
+            return {'_indices': result}
+
+    def bulk(self, body, index=None, doc_type=None, **params):
+        start = time.time()
+        lines = self._lines(body)
+        items = []
+        errors = False
+        with self._lock:
+            while lines:
+                (op, meta), = lines.pop(0).items()
+                source = lines.pop(0) if op != 'delete' else None
+                item = {'_index': meta.get('_index', index),
+                        '_type': meta.get('_type', doc_type),
+                        '_id': meta.get('_id')}
+                if '_version' in meta:
+                    item['_version'] = meta['_version']
+                try:
+                    item.update(self._bulk_item(op, item, source))
+                    item['status'] = 201 if item.get('created') else 200
+                except TransportError as e:
+                    errors = True
+                    item['status'] = e.status_code
+                    item['error'] = e.error
+                items.append({op: item})
+        return {'took': int((time.time() - start) * 1000),
+                'errors': errors,
+                'items': items}
+
+    def _bulk_item(self, op, item, source):
+        if op in ('index', 'create'):
+            return self.index(item['_index'], item['_type'], source,
+                              id=item['_id'], op_type=op,
+                              version=item.get('_version'))
+        if op == 'delete':
+            return self.delete(item['_index'], item['_type'], item['_id'])
+        if op == 'update':
+            try:
+                doc = self.get(item['_index'], item['_id'],
+                               doc_type=item['_type'])['_source']
+            except NotFoundError:
+                if 'upsert' in source:
+                    doc = source['upsert']
+                elif source.get('doc_as_upsert'):
+                    doc = {}
+                else:
+                    raise
+            doc.update(source.get('doc', {}))
+            return self.index(item['_index'], item['_type'], doc,
+                              id=item['_id'])
+        raise RequestError(400, 'ActionRequestValidationException', op)
+
+    def _lines(self, body):
+        if isinstance(body, string_types):
+            return [json.loads(l) for l in body.splitlines() if l.strip()]
+        return [json.loads(l) if isinstance(l, string_types) else self._copy(l)
+                for l in body]
+
+    def _copy(self, body):
+        # Serialize the body as the real client would, which also copies it
+        return json.loads(self.transport.serializer.dumps(body))
+
+    def _resolve(self, index):
+        """Returns the names of the indices an index expression refers to"""
+        if index is None or index == '_all':
+            return sorted(self._indices)
+        if not isinstance(index, string_types):
+            index = ','.join(index)
+        names = []
+        for name in index.split(','):
+            if name in self._indices:
+                names.append(name)
+            elif name in self._aliases:
+                names.extend(sorted(self._aliases[name]))
+            elif '*' in name:
+                names.extend(sorted(fnmatch.filter(self._indices, name)))
+            else:
+                raise NotFoundError(
+                    404, 'IndexMissingException[[{0}] missing]'.format(name),
+                    {'status': 404})
+        return names
+
+    def _search_indices(self, index):
+        indices = [self._indices[n] for n in self._resolve(index)]
+        for idx in indices:
+            idx.check_open()
+        return indices
+
+    def _write_index(self, name, create=False):
+        if create and name not in self._indices and name not in self._aliases:
+            self._indices[name] = _Index(name)
+        names = self._resolve(name)
+        if len(names) != 1:
+            raise RequestError(
+                400,
+                'ElasticsearchIllegalArgumentException[Alias [{0}] has more '
+                'than one indices associated with it]'.format(name),
+                {'status': 400})
+        idx = self._indices[names[0]]
+        idx.check_open()
+        return idx
+
+
+class _Transport(object):
+
+    def __init__(self):
+        self.serializer = JSONSerializer()
+
+
+class _IndicesClient(object):
+
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, index, body=None, **params):
+        body = body or {}
+        with self.client._lock:
+            if index in self.client._indices:
+                raise RequestError(
+                    400,
+                    'IndexAlreadyExistsException[[{0}] already exists]'
+                    .format(index),
+                    {'status': 400})
+            if index in self.client._aliases:
+                raise RequestError(
+                    400,
+                    'InvalidIndexNameException[[{0}] an alias with the same '
+                    'name already exists]'.format(index),
+                    {'status': 400})
+            idx = self.client._indices[index] = _Index(index)
+            idx.put_settings(body.get('settings', {}))
+            for name, mapping in iteritems(body.get('mappings', {})):
+                idx.doc_type(name).put_mapping(mapping)
+            for alias in body.get('aliases', {}):
+                self.client._aliases.setdefault(alias, set()).add(index)
+        return {'acknowledged': True}
+
+    def exists(self, index, **params):
+        with self.client._lock:
+            try:
+                return bool(self.client._resolve(index))
+            except NotFoundError:
+                return False
+
+    def delete(self, index, **params):
+        with self.client._lock:
+            for name in self.client._resolve(index):
+                del self.client._indices[name]
+                for alias, names in list(self.client._aliases.items()):
+                    names.discard(name)
+                    if not names:
+                        del self.client._aliases[alias]
+        return {'acknowledged': True}
+
+    def close(self, index, **params):
+        with self.client._lock:
+            for name in self.client._resolve(index):
+                self.client._indices[name].closed = True
+        return {'acknowledged': True}
+
+    def open(self, index, **params):
+        with self.client._lock:
+            for name in self.client._resolve(index):
+                self.client._indices[name].closed = False
+        return {'acknowledged': True}
+
+    def refresh(self, index=None, **params):
+        with self.client._lock:
+            self.client._resolve(index)
+        return {'_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+
+    def flush(self, index=None, **params):
+        return self.refresh(index)
+
+    def optimize(self, index=None, **params):
+        return self.refresh(index)
+
+    def put_mapping(self, doc_type, body, index=None, **params):
+        mapping = body.get(doc_type, body)
+        with self.client._lock:
+            for name in self.client._resolve(index):
+                self.client._indices[name].doc_type(doc_type).put_mapping(
+                    mapping)
+        return {'acknowledged': True}
+
+    def get_mapping(self, index=None, doc_type=None, **params):
+        with self.client._lock:
+            res = {}
+            for name in self.client._resolve(index):
+                idx = self.client._indices[name]
+                res[name] = {'mappings': dict(
+                    (t.name, copy.deepcopy(t.mapping))
+                    for t in idx.doc_types(doc_type) if t.mapping)}
+            return res
+
+    def get_settings(self, index=None, name=None, **params):
+        with self.client._lock:
+            res = {}
+            for n in self.client._resolve(index):
+                settings = dict(self.client._indices[n].settings)
+                if params.get('flat_settings') not in (True, 'true'):
+                    settings = _unflatten(settings)
+                res[n] = {'settings': settings}
+            return res
+
+    def put_settings(self, body, index=None, **params):
+        with self.client._lock:
+            for name in self.client._resolve(index):
+                self.client._indices[name].put_settings(body)
+        return {'acknowledged': True}
+
+    def exists_alias(self, name=None, index=None, **params):
+        with self.client._lock:
+            return name in self.client._aliases
+
+    def get_alias(self, name=None, index=None, **params):
+        with self.client._lock:
+            res = {}
+            for alias, names in iteritems(self.client._aliases):
+                if name is not None and alias != name:
+                    continue
+                for n in names:
+                    res.setdefault(n, {'aliases': {}})['aliases'][alias] = {}
+            if name is not None and not res:
+                raise NotFoundError(
+                    404, 'alias [{0}] missing'.format(name), {'status': 404})
+            return res
+
+    def put_alias(self, index, name, body=None, **params):
+        with self.client._lock:
+            if name in self.client._indices:
+                raise RequestError(
+                    400,
+                    'InvalidAliasNameException[[{0}] an index exists with the '
+                    'same name as the alias]'.format(name),
+                    {'status': 400})
+            for n in self.client._resolve(index):
+                self.client._aliases.setdefault(name, set()).add(n)
+        return {'acknowledged': True}
+
+    def delete_alias(self, index, name, **params):
+        with self.client._lock:
+            names = set(self.client._resolve(index))
+            for alias in name.split(','):
+                if alias not in self.client._aliases:
+                    raise NotFoundError(
+                        404, 'AliasesMissingException[aliases [[{0}]] missing]'
+                        .format(alias), {'status': 404})
+                self.client._aliases[alias] -= names
+                if not self.client._aliases[alias]:
+                    del self.client._aliases[alias]
+        return {'acknowledged': True}
+
+    def update_aliases(self, body, **params):
+        # All actions are applied under the lock, so atomically
+        with self.client._lock:
+            for action in body.get('actions', []):
+                (op, args), = action.items()
+                if op == 'add':
+                    self.put_alias(args['index'], args['alias'])
+                elif op == 'remove':
+                    self.delete_alias(args['index'], args['alias'])
+        return {'acknowledged': True}
+
+
+class _ClusterClient(object):
+
+    def __init__(self, client):
+        self.client = client
+
+    def health(self, index=None, **params):
+        return {'cluster_name': 'memory',
+                'status': 'green',
+                'timed_out': False,
+                'number_of_nodes': 1}
+
+
+class _NodesClient(object):
+
+    def __init__(self, client):
+        self.client = client
+
+    def stats(self, node_id=None, metric=None, **params):
+        return {'cluster_name': 'memory', 'nodes': {}}
+
+
+class _Index(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.closed = False
+        self.settings = {'index.number_of_shards': '1',
+                         'index.number_of_replicas': '0'}
+        self.types = OrderedDict()
+
+    def check_open(self):
+        if self.closed:
+            raise TransportError(
+                403, 'IndexClosedException[[{0}] closed]'.format(self.name),
+                {'status': 403})
+
+    def doc_type(self, name):
+        t = self.types.get(name)
+        if t is None:
+            t = self.types[name] = _DocType(name)
+        return t
+
+    def doc_types(self, names):
+        if names is None or names == '_all':
+            return list(self.types.values())
+        if isinstance(names, string_types):
+            names = names.split(',')
+        return [self.types[n] for n in names if n in self.types]
+
+    def put_settings(self, settings):
+        for key, value in iteritems(_flatten_settings(settings)):
+            if not key.startswith('index.'):
+                key = 'index.' + key
+            self.settings[key] = str(value)
+
+
+class _DocType(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.mapping = {}
+        self.fields = {}
+        self.analyzer = 'standard'
+        self.docs = OrderedDict()
+        self.versions = {}
+        # Each document's leaf values, by dotted field name
+        self.values = {}
+        # field -> term -> ids of the documents with that term in that field
+        self.postings = {}
+
+    def put_mapping(self, mapping):
+        new_fields = _mapped_fields(mapping.get('properties', {}))
+        conflicts = ['mapper [{0}] of different type, current_type [{1}], '
+                     'merged_type [{2}]'.format(f, self.fields[f].get('type'),
+                                                m.get('type'))
+                     for f, m in sorted(iteritems(new_fields))
+                     if f in self.fields
+                     and self.fields[f].get('type') != m.get('type')]
+        if conflicts:
+            raise RequestError(
+                400,
+                'MergeMappingException[Merge failed with failures {{[{0}]}}]'
+                .format(', '.join(conflicts)),
+                {'status': 400})
+
+        _merge_mapping(self.mapping, copy.deepcopy(mapping))
+        self.fields = _mapped_fields(self.mapping.get('properties', {}))
+        self.analyzer = self.mapping.get('analyzer', 'standard')
+        # Analysis may have changed, so index everything again
+        self.postings = {}
+        for i in self.docs:
+            self._add_postings(i)
+
+    def index(self, source, id, op_type, index_name, version=None):
+        id_path = self.mapping.get('_id', {}).get('path')
+        if id is None and id_path is not None:
+            id = source.get(id_path)
+        if id is None:
+            id = _new_id()
+        id = str(id)
+        for field in self.mapping.get('_source', {}).get('excludes', []):
+            source.pop(field, None)
+
+        values = _leaf_values(source)
+        for field, vs in iteritems(values):
+            if (field not in self.fields and vs and
+                    isinstance(vs[0], string_types) and _DATE_RE.match(vs[0])):
+                self._map_date(field)
+
+        created = id not in self.docs
+        if version is not None and self.versions.get(id) != int(version):
+            raise ConflictError(
+                409, 'VersionConflictEngineException[[{0}][{1}]: version '
+                     'conflict, current [{2}], provided [{3}]]'.format(
+                         index_name, id, self.versions.get(id, -1), version),
+                {'status': 409})
+        if not created and op_type == 'create':
+            raise ConflictError(
+                409, 'DocumentAlreadyExistsException[[{0}][{1}]: document '
+                     'already exists]'.format(index_name, id),
+                {'status': 409})
+        if not created:
+            self._remove_postings(id)
+        self.docs[id] = source
+        self.versions[id] = self.versions.get(id, 0) + 1
+        self.values[id] = values
+        self._add_postings(id)
+        return {'_index': index_name,
+                '_type': self.name,
+                '_id': id,
+                '_version': self.versions[id],
+                'created': created}
+
+    def delete(self, id):
+        self._remove_postings(id)
+        del self.docs[id]
+        del self.values[id]
+        self.versions[id] += 1
+        return self.versions[id]
+
+    def terms(self, field, value):
+        """Returns the terms a value is indexed under in the given field"""
+        if value is None:
+            return []
+        if field == '_all' or (isinstance(value, string_types) and
+                               self.analyzed(field)):
+            return _TOKEN_RE.findall(_text(value).lower())
+        return [value]
+
+    def analyzed(self, field):
+        analyzer = self.fields.get(field, {}).get('analyzer', self.analyzer)
+        return analyzer != 'keyword'
+
+    def _map_date(self, field):
+        mapping = {'type': 'date'}
+        for name in reversed(field.split('.')):
+            mapping = {'properties': {name: mapping}}
+        _merge_mapping(self.mapping, mapping)
+        self.fields[field] = {'type': 'date'}
+
+    def is_date(self, field):
+        return self.fields.get(field, {}).get('type') == 'date'
+
+    def _postings_of(self, id):
+        postings = set()
+        for field, values in iteritems(self.values[id]):
+            for value in values:
+                for term in self.terms(field, value):
+                    postings.add((field, term))
+                for term in self.terms('_all', value):
+                    postings.add(('_all', term))
+        return postings
+
+    def _add_postings(self, id):
+        for field, term in self._postings_of(id):
+            self.postings.setdefault(field, {}).setdefault(term, set()).add(id)
+
+    def _remove_postings(self, id):
+        for field, term in self._postings_of(id):
+            ids = self.postings[field][term]
+            ids.discard(id)
+            if not ids:
+                del self.postings[field][term]
+
+
+def _evaluate(t, clause):
+    """Returns the set of ids of the documents of type t matching a clause"""
+    if not isinstance(clause, dict) or len(clause) != 1:
+        raise _parse_error('Expected a single query or filter, got {0}'
+                           .format(json.dumps(clause)))
+    (kind, body), = clause.items()
+    handler = _CLAUSES.get(kind)
+    if handler is None:
+        raise _parse_error('No query registered for [{0}]'.format(kind))
+    return handler(t, body)
+
+
+def _field_and_value(body, key='value'):
+    """Split a clause body like {field: value} or {field: {key: value}}"""
+    fields = [k for k in body if k not in _OPTIONS]
+    if len(fields) != 1:
+        raise _parse_error('Expected a single field, got {0}'
+                           .format(json.dumps(body)))
+    value = body[fields[0]]
+    if isinstance(value, dict) and key is not None:
+        return fields[0], value.get(key), value
+    return fields[0], value, {}
+
+
+def _match_all(t, body):
+    return set(t.docs)
+
+
+def _match(t, body):
+    field, value, options = _field_and_value(body, key='query')
+    postings = t.postings.get(field, {})
+    sets = [postings.get(term, set()) for term in t.terms(field, value)]
+    if not sets:
+        return set()
+    if options.get('operator', 'or').lower() == 'and':
+        return set.intersection(*sets)
+    return set.union(*sets)
+
+
+def _term(t, body):
+    field, value, _ = _field_and_value(body)
+    return set(t.postings.get(field, {}).get(value, ()))
+
+
+def _terms(t, body):
+    fields = [k for k in body
+              if k not in _OPTIONS + ('execution', 'minimum_should_match')]
+    if len(fields) != 1:
+        raise _parse_error('Expected a single field in terms query')
+    postings = t.postings.get(fields[0], {})
+    ids = set()
+    for value in body[fields[0]]:
+        ids.update(postings.get(value, ()))
+    return ids
+
+
+def _prefix(t, body):
+    field, value, _ = _field_and_value(body)
+    ids = set()
+    for term, term_ids in iteritems(t.postings.get(field, {})):
+        if isinstance(term, string_types) and term.startswith(value):
+            ids.update(term_ids)
+    return ids
+
+
+def _ids(t, body):
+    types = body.get('type', body.get('types'))
+    if isinstance(types, string_types):
+        types = [types]
+    if types and t.name not in types:
+        return set()
+    return set(str(v) for v in body.get('values', ())) & set(t.docs)
+
+
+def _range(t, body):
+    field, bounds, _ = _field_and_value(body, key=None)
+    bounds = dict(bounds)
+    if 'from' in bounds:
+        key = 'gte' if bounds.get('include_lower', True) else 'gt'
+        bounds[key] = bounds['from']
+    if 'to' in bounds:
+        key = 'lte' if bounds.get('include_upper', True) else 'lt'
+        bounds[key] = bounds['to']
+    checks = [(op, _comparable(t, field, bounds[op]))
+              for op in ('gt', 'gte', 'lt', 'lte')
+              if bounds.get(op) is not None]
+
+    ids = set()
+    for i, values in iteritems(t.values):
+        if field == '_uid':
+            values = {field: [t.name + '#' + i]}
+        for v in values.get(field, ()):
+            try:
+                v = _comparable(t, field, v)
+                if all(_compare(op, v, bound) for op, bound in checks):
+                    ids.add(i)
+                    break
+            except (TypeError, ValueError):
+                continue
+    return ids
+
+
+def _compare(op, value, bound):
+    if op == 'gt':
+        return value > bound
+    if op == 'gte':
+        return value >= bound
+    if op == 'lt':
+        return value < bound
+    return value <= bound
+
+
+def _exists(t, body):
+    field = body['field']
+    return set(i for i, values in iteritems(t.values) if values.get(field))
+
+
+def _missing(t, body):
+    return set(t.docs) - _exists(t, body)
+
+
+def _bool(t, body):
+    must = _clauses(body.get('must')) + _clauses(body.get('filter'))
+    should = _clauses(body.get('should'))
+    must_not = _clauses(body.get('must_not'))
+
+    ids = set(t.docs)
+    for clause in must:
+        ids &= _evaluate(t, clause)
+
+    if should:
+        required = body.get('minimum_should_match',
+                            body.get('minimum_number_should_match'))
+        if required is None:
+            required = 0 if must else 1
+        required = _minimum_should_match(required, len(should))
+        if required > 0:
+            counts = {}
+            for clause in should:
+                for i in _evaluate(t, clause) & ids:
+                    counts[i] = counts.get(i, 0) + 1
+            ids = set(i for i, n in iteritems(counts) if n >= required)
+
+    for clause in must_not:
+        ids -= _evaluate(t, clause)
+    return ids
+
+
+def _minimum_should_match(value, n):
+    value = str(value)
+    if value.endswith('%'):
+        return n * int(value[:-1]) // 100
+    return int(value)
+
+
+def _and(t, body):
+    ids = set(t.docs)
+    for clause in _clauses(body, 'filters'):
+        ids &= _evaluate(t, clause)
+    return ids
+
+
+def _or(t, body):
+    ids = set()
+    for clause in _clauses(body, 'filters'):
+        ids |= _evaluate(t, clause)
+    return ids
+
+
+def _not(t, body):
+    if 'filter' in body:
+        body = body['filter']
+    elif 'query' in body and len(body) == 1:
+        body = body['query']
+    return set(t.docs) - _evaluate(t, body)
+
+
+def _filtered(t, body):
+    ids = _evaluate(t, body.get('query', {'match_all': {}}))
+    if body.get('filter'):
+        ids &= _evaluate(t, body['filter'])
+    return ids
+
+
+def _constant_score(t, body):
+    return _evaluate(t, body.get('filter', body.get('query')))
+
+
+def _nested(t, body):
+    # Nested documents are indexed as part of their parent here
+    return _evaluate(t, body.get('query', body.get('filter')))
+
+
+def _query(t, body):
+    return _evaluate(t, body)
+
+
+def _query_string(t, body):
+    default_field = body.get('default_field', '_all')
+    default_and = body.get('default_operator', 'or').lower() == 'and'
+
+    clauses = []
+    next_op = ''
+    for op, field, value in _QUERY_STRING_RE.findall(body.get('query', '')):
+        if not field and value in ('AND', 'OR', 'NOT'):
+            if value == 'AND' and clauses and clauses[-1][0] == '':
+                clauses[-1][0] = '+'
+            next_op = {'AND': '+', 'NOT': '-'}.get(value, '')
+            continue
+        op = op or next_op or ('+' if default_and else '')
+        next_op = ''
+        field = field or default_field
+
+        if value == '*':
+            clause = ({'match_all': {}} if field == '_all'
+                      else {'exists': {'field': field}})
+        elif value.endswith('*') and not value.startswith('"'):
+            prefix = value[:-1]
+            if t.analyzed(field):
+                prefix = prefix.lower()
+            clause = {'prefix': {field: prefix}}
+        else:
+            clause = {'match': {field: {'query': value.strip('"'),
+                                        'operator': 'and'}}}
+        clauses.append([op, clause])
+
+    if not clauses:
+        return set()
+    return _bool(t, {
+        'must': [c for op, c in clauses if op == '+'],
+        'should': [c for op, c in clauses if op == ''],
+        'must_not': [c for op, c in clauses if op == '-'],
+        'minimum_should_match': (1 if not any(op == '+' for op, _ in clauses)
+                                 else 0)})
+
+
+_CLAUSES = {
+    'match_all': _match_all,
+    'match': _match,
+    'term': _term,
+    'terms': _terms,
+    'in': _terms,
+    'prefix': _prefix,
+    'ids': _ids,
+    'range': _range,
+    'exists': _exists,
+    'missing': _missing,
+    'bool': _bool,
+    'and': _and,
+    'or': _or,
+    'not': _not,
+    'filtered': _filtered,
+    'constant_score': _constant_score,
+    'nested': _nested,
+    'query': _query,
+    'query_string': _query_string,
+}
+
+
+def _clauses(value, key=None):
+    if value is None:
+        return []
+    if isinstance(value, dict) and key is not None and key in value:
+        value = value[key]
+    if isinstance(value, dict):
+        return [value]
+    return list(value)
+
+
+def _aggregate(matches, aggs):
+    result = {}
+    for name, spec in iteritems(aggs):
+        kinds = [k for k in spec if k not in ('aggs', 'aggregations', 'meta')]
+        if len(kinds) != 1:
+            raise _parse_error('Expected a single aggregation type in [{0}]'
+                               .format(name))
+        kind = kinds[0]
+        handler = _AGGREGATIONS.get(kind)
+        if handler is None:
+            raise _parse_error('Could not find aggregator type [{0}] in [{1}]'
+                               .format(kind, name))
+        sub = spec.get('aggs', spec.get('aggregations'))
+        result[name] = handler(matches, spec[kind], sub)
+    return result
+
+
+def _bucket(key, matches, sub, **extra):
+    bucket = {'key': key, 'doc_count': len(matches)}
+    bucket.update(extra)
+    if sub:
+        bucket.update(_aggregate(matches, sub))
+    return bucket
+
+
+def _terms_agg(matches, params, sub):
+    field = params['field']
+    groups = {}
+    for match in matches:
+        idx, t, i = match
+        seen = set()
+        for value in t.values[i].get(field, ()):
+            for term in t.terms(field, value):
+                if term not in seen:
+                    seen.add(term)
+                    groups.setdefault(term, []).append(match)
+
+    ordered = sorted(groups, key=lambda k: (-len(groups[k]), k))
+    size = int(params.get('size', 10)) or len(ordered)
+    min_doc_count = int(params.get('min_doc_count', 1))
+    shown = [k for k in ordered[:size] if len(groups[k]) >= min_doc_count]
+    return {'doc_count_error_upper_bound': 0,
+            'sum_other_doc_count': sum(len(groups[k])
+                                       for k in ordered[size:]),
+            'buckets': [_bucket(k, groups[k], sub) for k in shown]}
+
+
+def _date_histogram_agg(matches, params, sub):
+    field = params['field']
+    interval = params['interval']
+    groups = {}
+    for match in matches:
+        idx, t, i = match
+        keys = set()
+        for value in t.values[i].get(field, ()):
+            try:
+                keys.add(_interval_start(int(_to_epoch_ms(value)),
+                                         interval))
+            except (TypeError, ValueError):
+                continue
+        for key in keys:
+            groups.setdefault(key, []).append(match)
+
+    min_doc_count = max(1, int(params.get('min_doc_count', 1)))
+    return {'buckets': [
+        _bucket(k, groups[k], sub, key_as_string=_format_epoch_ms(k))
+        for k in sorted(groups) if len(groups[k]) >= min_doc_count]}
+
+
+def _filter_agg(matches, params, sub):
+    selected = [(idx, t, i) for idx, t, i in matches
+                if i in _evaluate(t, params)]
+    res = {'doc_count': len(selected)}
+    if sub:
+        res.update(_aggregate(selected, sub))
+    return res
+
+
+def _metric_agg(fn):
+    def aggregate(matches, params, sub):
+        field = params['field']
+        values = []
+        for idx, t, i in matches:
+            for v in t.values[i].get(field, ()):
+                values.append(_comparable(t, field, v))
+        return {'value': fn(values)}
+    return aggregate
+
+
+_AGGREGATIONS = {
+    'terms': _terms_agg,
+    'date_histogram': _date_histogram_agg,
+    'filter': _filter_agg,
+    'min': _metric_agg(lambda vs: min(vs) if vs else None),
+    'max': _metric_agg(lambda vs: max(vs) if vs else None),
+    'sum': _metric_agg(sum),
+    'avg': _metric_agg(lambda vs: float(sum(vs)) / len(vs) if vs else None),
+    'value_count': _metric_agg(len),
+    'cardinality': _metric_agg(lambda vs: len(set(vs))),
+}
+
+
+def _sort_spec(sort):
+    """Returns a sort as a list of (field, descending) pairs"""
+    if sort is None:
+        return []
+    if not isinstance(sort, list):
+        sort = [sort]
+    spec = []
+    for s in sort:
+        if isinstance(s, string_types):
+            field, order = s, None
+        else:
+            (field, order), = s.items()
+            if isinstance(order, dict):
+                order = order.get('order')
+        if order is None:
+            order = 'desc' if field == '_score' else 'asc'
+        spec.append((field, order.lower() == 'desc'))
+    return spec
+
+
+def _sort_values(t, i, sort):
+    values = []
+    for field, desc in sort:
+        if field == '_score':
+            values.append(1.0)
+        elif field in ('_uid', '_id'):
+            values.append(i if field == '_id' else t.name + '#' + i)
+        else:
+            vs = [_comparable(t, field, v) for v in t.values[i].get(field, ())]
+            values.append((max if desc else min)(vs) if vs else None)
+    return values
+
+
+def _sort(matches, sort):
+    keyed = [(_sort_values(t, i, sort), (idx, t, i)) for idx, t, i in matches]
+    # Sort by the last key first, relying on the stability of sort() to keep
+    # that order among equal values of earlier keys.
+    for n in reversed(range(len(sort))):
+        desc = sort[n][1]
+
+        def key(k, n=n, desc=desc):
+            # Documents without a value go last, whatever the order
+            value = k[0][n]
+            return (value is None) != desc, 0 if value is None else value
+
+        keyed.sort(key=key, reverse=desc)
+    return [match for _, match in keyed]
+
+
+def _hit(idx, t, i, sort, version=False):
+    hit = {'_index': idx.name,
+           '_type': t.name,
+           '_id': i,
+           '_score': 1.0,
+           '_source': copy.deepcopy(t.docs[i])}
+    if version:
+        hit['_version'] = t.versions[i]
+    if sort:
+        values = _sort_values(t, i, sort)
+        hit['sort'] = [int(v) if t.is_date(field) and v is not None else v
+                       for (field, _), v in zip(sort, values)]
+    return hit
+
+
+def _comparable(t, field, value):
+    if t.is_date(field):
+        return _to_epoch_ms(value)
+    return value
+
+
+def _to_epoch_ms(value):
+    """
+    Returns a date as milliseconds since the epoch. Unlike in Elasticsearch,
+    microseconds are kept as a fraction, so that documents saved within the
+    same millisecond still sort in the order they were saved.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    try:
+        dt = iso8601.parse_date(value)
+    except iso8601.ParseError as e:
+        raise ValueError(str(e))
+    return (calendar.timegm(dt.utctimetuple()) * 1000 +
+            dt.microsecond / 1000.0)
+
+
+def _format_epoch_ms(ms):
+    dt = datetime.datetime.utcfromtimestamp(ms // 1000)
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.') + '{0:03d}Z'.format(ms % 1000)
+
+
+_INTERVALS = {'second': 1000, 'minute': 60 * 1000, 'hour': 3600 * 1000,
+              'day': 24 * 3600 * 1000}
+_UNITS = {'s': 1000, 'm': 60 * 1000, 'h': 3600 * 1000, 'd': 24 * 3600 * 1000}
+
+
+def _interval_start(ms, interval):
+    """Returns the start of the date histogram bucket a time falls in"""
+    if interval in _INTERVALS:
+        return ms - ms % _INTERVALS[interval]
+    if interval == 'week':
+        day = _INTERVALS['day']
+        days = ms // day
+        # 1970-01-01 was a Thursday; weeks start on Monday
+        return (days - (days + 3) % 7) * day
+    if interval in ('month', 'quarter', 'year'):
+        dt = datetime.datetime.utcfromtimestamp(ms // 1000)
+        month = 1 if interval == 'year' else dt.month
+        if interval == 'quarter':
+            month -= (month - 1) % 3
+        start = datetime.datetime(dt.year, month, 1)
+        return calendar.timegm(start.utctimetuple()) * 1000
+    match = re.match(r'^(\d+)([smhd])$', interval)
+    if match is None:
+        raise _parse_error('Unknown interval [{0}]'.format(interval))
+    length = int(match.group(1)) * _UNITS[match.group(2)]
+    return ms - ms % length
+
+
+def _leaf_values(source, prefix=''):
+    """Returns a dict mapping dotted field names to lists of leaf values"""
+    values = {}
+
+    def walk(value, path):
+        if isinstance(value, dict):
+            for k, v in iteritems(value):
+                walk(v, path + '.' + k if path else k)
+        elif isinstance(value, list):
+            for v in value:
+                walk(v, path)
+        elif value is not None:
+            values.setdefault(path, []).append(value)
+
+    walk(source, prefix)
+    return values
+
+
+def _mapped_fields(properties, prefix=''):
+    """Returns a dict mapping dotted field names to their mappings"""
+    fields = {}
+    for name, mapping in iteritems(properties):
+        path = prefix + name
+        if 'properties' in mapping:
+            fields.update(_mapped_fields(mapping['properties'], path + '.'))
+        else:
+            fields[path] = mapping
+    return fields
+
+
+def _ignored(params):
+    """The status codes a call's 'ignore' parameter asks not to raise"""
+    ignore = params.get('ignore', ())
+    if isinstance(ignore, int):
+        return (ignore,)
+    return ignore
+
+
+def _merge_mapping(target, source):
+    for k, v in iteritems(source):
+        if isinstance(v, dict) and isinstance(target.get(k), dict):
+            _merge_mapping(target[k], v)
+        else:
+            target[k] = v
+
+
+def _flatten_settings(settings, prefix=''):
+    flat = {}
+    for k, v in iteritems(settings):
+        if isinstance(v, dict):
+            flat.update(_flatten_settings(v, prefix + k + '.'))
+        else:
+            flat[prefix + k] = v
+    return flat
+
+
+def _unflatten(flat):
+    nested = {}
+    for key, value in iteritems(flat):
+        d = nested
+        parts = key.split('.')
+        for part in parts[:-1]:
+            d = d.setdefault(part, {})
+        d[parts[-1]] = value
+    return nested
+
+
+def _text(value):
+    return value if isinstance(value, string_types) else str(value)
+
+
+def _new_id():
+    # Like Elasticsearch's own ids: a URL-safe base64 encoded random UUID
+    return base64.urlsafe_b64encode(uuid.uuid4().bytes).decode('ascii')[:22]
+
+
+def _parse_error(message):
+    return RequestError(400, 'SearchPhaseExecutionException[{0}]'
+                        .format(message), {'status': 400})
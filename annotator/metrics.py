@@ -0,0 +1,375 @@
+"""
+In-process metrics, exposed in the Prometheus text format.
+
+Counters and histograms are kept per process, guarded by one short-held lock
+each. When the store runs in several prefork worker processes, give them a
+shared directory: each process then periodically writes a snapshot of its
+metrics there, and a scrape of any process reports the sum over all of them.
+
+When a process exits, or is found to have died, its counters and histograms
+are added to those of the processes that exited before, kept in a file of
+their own, so that the sums never go down as workers are recycled. Clear the
+directory when the server starts, before it forks its workers.
+"""
+import atexit
+import bisect
+import errno
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from six import iteritems
+
+from annotator import cache
+
+log = logging.getLogger(__name__)
+
+# The files in a shared directory: the snapshots of running processes, the
+# sums of those of exited processes, and a lock guarding the latter
+SNAPSHOT_FILE = 'metrics-{0}.json'
+EXITED_FILE = 'metrics-exited.json'
+LOCK_FILE = 'metrics.lock'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+class Counter(object):
+
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[l] for l in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(k), v] for k, v in iteritems(self._values)]
+
+
+class Histogram(object):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels[l] for l in self.labelnames)
+        # Index of the first bucket the value fits in; len(buckets) is +Inf
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            v = self._values.get(key)
+            if v is None:
+                v = self._values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            v[0][i] += 1
+            v[1] += value
+            v[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(k), [list(v[0]), v[1], v[2]]]
+                    for k, v in iteritems(self._values)]
+
+
+class Callback(object):
+    """
+    A metric whose values are read from a callback when they are needed.
+
+    The callback returns a dict mapping tuples of label values to values.
+    Counters read this way are summed over processes like any other, whereas
+    gauges only ever describe the current process.
+    """
+
+    def __init__(self, type, name, help, callback, labelnames=()):
+        self.type = type
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+
+    def snapshot(self):
+        try:
+            values = self.callback()
+        except Exception:
+            log.exception("Failed to read metric %s", self.name)
+            return []
+        return [[list(k), v] for k, v in iteritems(values)]
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+        self._last_flush = 0
+        self._exit_registered = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def callback(self, *args, **kwargs):
+        return self.register(Callback(*args, **kwargs))
+
+    def snapshot(self, gauges=True):
+        return dict((m.name, m.snapshot()) for m in self.metrics
+                    if gauges or m.type != 'gauge')
+
+    def flush(self, directory, min_interval=1.0):
+        """
+        Write this process's metrics to the shared directory, unless that was
+        done less than min_interval seconds ago.
+        """
+        now = time.time()
+        if now - self._last_flush < min_interval:
+            return
+        self._last_flush = now
+
+        pid = os.getpid()
+        _write_json(os.path.join(directory, SNAPSHOT_FILE.format(pid)),
+                    self.snapshot(gauges=False))
+
+        if self._exit_registered != (directory, pid):
+            self._exit_registered = (directory, pid)
+            atexit.register(self.exit, directory, pid)
+
+    def exit(self, directory, pid):
+        """
+        Add this process's counters and histograms to those of the processes
+        that exited before, and remove its snapshot. Called at exit by the
+        process with the given pid.
+        """
+        # A process forked from the one that wrote the snapshot leaves it be,
+        # as does one whose directory has gone
+        if os.getpid() != pid or not os.path.isdir(directory):
+            return
+        with _locked(directory):
+            self._add_exited(directory, [self.snapshot(gauges=False)])
+            _remove(os.path.join(directory, SNAPSHOT_FILE.format(pid)))
+
+    def clear(self, directory):
+        """Remove the snapshots of all processes from the shared directory"""
+        for path in glob.glob(os.path.join(directory, 'metrics-*.json*')):
+            _remove(path)
+
+    def _add_exited(self, directory, snapshots):
+        path = os.path.join(directory, EXITED_FILE)
+        exited = _read_json(path)
+        if exited is not None:
+            snapshots = [exited] + snapshots
+        total = {}
+        for m in self.metrics:
+            if m.type != 'gauge':
+                samples = _merge(m, [s.get(m.name, []) for s in snapshots])
+                total[m.name] = [[list(k), v] for k, v in iteritems(samples)]
+        _write_json(path, total)
+
+    def _add_dead(self, directory):
+        """Add the snapshots of processes that died without exiting"""
+        dead = []
+        for path in glob.glob(os.path.join(directory, 'metrics-*.json')):
+            name = os.path.basename(path)[len('metrics-'):-len('.json')]
+            try:
+                pid = int(name)
+            except ValueError:
+                continue
+            if pid != os.getpid() and not _alive(pid):
+                dead.append(path)
+        if dead:
+            snapshots = [_read_json(path) for path in dead]
+            self._add_exited(directory,
+                             [s for s in snapshots if s is not None])
+            for path in dead:
+                _remove(path)
+
+    def render(self, directory=None):
+        """
+        Returns all metrics in the Prometheus text format. If a shared
+        directory is given, counters and histograms are summed over the
+        snapshots of all processes in it.
+        """
+        if directory is None:
+            snapshots = [self.snapshot()]
+        else:
+            self.flush(directory, min_interval=0)
+            snapshots = [dict((m.name, m.snapshot()) for m in self.metrics
+                              if m.type == 'gauge')]
+            # Holding the lock, no snapshot is counted both on its own and
+            # as part of the exited processes' sums
+            with _locked(directory):
+                self._add_dead(directory)
+                for path in glob.glob(os.path.join(directory,
+                                                   'metrics-*.json')):
+                    snapshot = _read_json(path)
+                    if snapshot is not None:
+                        snapshots.append(snapshot)
+
+        lines = []
+        for m in self.metrics:
+            samples = _merge(m, [s.get(m.name, []) for s in snapshots])
+            lines.append('# HELP {0} {1}'.format(m.name, m.help))
+            lines.append('# TYPE {0} {1}'.format(m.name, m.type))
+            for key in sorted(samples):
+                labels = list(zip(m.labelnames, key))
+                if m.type == 'histogram':
+                    lines.extend(_histogram_lines(m, labels, samples[key]))
+                else:
+                    lines.append(_line(m.name, labels, samples[key]))
+        return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def _locked(directory):
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(directory, LOCK_FILE), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _alive(pid):
+    if pid <= 0:
+        # Not a process that can be asked about
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            log.warn("Skipping unreadable metrics file %s", path)
+    except ValueError:
+        log.warn("Skipping unreadable metrics file %s", path)
+    return None
+
+
+def _write_json(path, data):
+    # Written whole, so that it is never read half written
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp, path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _merge(metric, snapshots):
+    merged = {}
+    for samples in snapshots:
+        for key, value in samples:
+            key = tuple(key)
+            if metric.type != 'histogram':
+                merged[key] = merged.get(key, 0) + value
+            elif key not in merged:
+                merged[key] = [list(value[0]), value[1], value[2]]
+            else:
+                m = merged[key]
+                m[0] = [a + b for a, b in zip(m[0], value[0])]
+                m[1] += value[1]
+                m[2] += value[2]
+    return merged
+
+
+def _histogram_lines(metric, labels, value):
+    counts, total, count = value
+    cumulative = 0
+    for bound, c in zip(metric.buckets + ('+Inf',), counts):
+        cumulative += c
+        yield _line(metric.name + '_bucket',
+                    labels + [('le', _format_value(bound))],
+                    cumulative)
+    yield _line(metric.name + '_sum', labels, total)
+    yield _line(metric.name + '_count', labels, count)
+
+
+def _line(name, labels, value):
+    if labels:
+        name += '{' + ','.join('{0}="{1}"'.format(k, _escape(v))
+                               for k, v in labels) + '}'
+    return '{0} {1}'.format(name, _format_value(value))
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\')
+                      .replace('"', '\\"')
+                      .replace('\n', '\\n'))
+
+
+def _format_value(value):
+    if isinstance(value, str):
+        return value
+    return repr(float(value))
+
+
+registry = Registry()
+
+REQUESTS = registry.counter(
+    'annotator_requests_total',
+    "Requests handled by the store, by endpoint, method and status",
+    ('endpoint', 'method', 'status'))
+REQUEST_DURATION = registry.histogram(
+    'annotator_request_duration_seconds',
+    "Time taken to handle store requests, by endpoint",
+    ('endpoint',))
+ES_DURATION = registry.histogram(
+    'annotator_es_request_duration_seconds',
+    "Time taken by Elasticsearch calls made by store requests, by operation",
+    ('operation',))
+TOKEN_DECODES = registry.counter(
+    'annotator_token_decodes_total',
+    "Authentication tokens decoded, by whether they were verified and valid",
+    ('verified', 'result'))
+CACHE_HITS = registry.callback(
+    'counter', 'annotator_cache_hits_total',
+    "Lookups answered from an in-process cache, by cache",
+    lambda: dict(((name, ), c.hits) for name, c in cache.caches.items()),
+    ('cache',))
+CACHE_MISSES = registry.callback(
+    'counter', 'annotator_cache_misses_total',
+    "Lookups not answered from an in-process cache, by cache",
+    lambda: dict(((name, ), c.misses) for name, c in cache.caches.items()),
+    ('cache',))
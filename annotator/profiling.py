@@ -0,0 +1,74 @@
+"""
+A sampling profiler for individual requests.
+
+While running, the profiler periodically records the call stack of the thread
+handling the request. The result is written in the "collapsed stack" format
+(one line per distinct stack, frames separated by semicolons, followed by
+the number of samples), which flame graph tools read directly.
+"""
+import os
+import re
+import sys
+import threading
+import time
+
+DEFAULT_INTERVAL = 0.005
+
+
+class SamplingProfiler(object):
+
+    def __init__(self, thread_id=None, interval=DEFAULT_INTERVAL):
+        if thread_id is None:
+            thread_id = threading.current_thread().ident
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='annotator-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{0} ({1}:{2})'.format(code.co_name,
+                                                    code.co_filename,
+                                                    code.co_firstlineno))
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            self.samples[key] = self.samples.get(key, 0) + 1
+
+    def collapsed(self):
+        """Returns the samples in the collapsed stack format"""
+        return ''.join('{0} {1}\n'.format(stack, count)
+                       for stack, count in sorted(self.samples.items()))
+
+    def write(self, directory, *tags):
+        """
+        Write the samples to a file in the directory, named after the current
+        time and the given tags. Returns the path of the file.
+        """
+        name = '-'.join([time.strftime('%Y%m%dT%H%M%S')] +
+                        [_safe_filename(t) for t in tags])
+        path = os.path.join(directory, name + '.folded')
+        with open(path, 'w') as f:
+            f.write(self.collapsed())
+        return path
+
+
+def _safe_filename(s):
+    return re.sub(r'[^A-Za-z0-9_.]+', '_', str(s))
@@ -0,0 +1,191 @@
+"""
+A guard against expensive raw Elasticsearch queries.
+
+The raw search API passes query bodies on to Elasticsearch more or less as
+is, so a single query with a leading wildcard, a script or a deeply nested
+aggregation can keep a node busy for everyone. QueryGuard walks the query
+tree, rejects such constructs, estimates the cost of the rest, and bounds the
+time and number of hits Elasticsearch may spend on it.
+"""
+import json
+import logging
+import re
+
+from six import iteritems, string_types
+
+log = logging.getLogger(__name__)
+
+# Keys that introduce scripts anywhere in the query DSL
+SCRIPT_KEYS = frozenset(['script', 'script_score', 'script_fields',
+                         'scripted_metric', 'script_file', 'script_id',
+                         '_script'])
+AGGREGATION_KEYS = frozenset(['aggs', 'aggregations', 'facets'])
+QUERY_STRING_KEYS = frozenset(['query_string', 'simple_query_string'])
+WILDCARD_KEYS = frozenset(['wildcard', 'regexp'])
+
+# The estimated cost of the query constructs that are expensive to run. Any
+# other key counts as 1.
+COSTS = {
+    'query_string': 10,
+    'simple_query_string': 10,
+    'wildcard': 20,
+    'regexp': 50,
+    'fuzzy': 20,
+    'more_like_this': 50,
+    'nested': 5,
+    'has_child': 50,
+    'has_parent': 50,
+}
+AGGREGATION_COST = 20
+
+# A term in a query string that starts with a wildcard
+_LEADING_WILDCARD = re.compile(r'(^|[\s(\[{:+\-!~^])[*?]')
+
+
+class QueryRejected(ValueError):
+    def __init__(self, reason, cost=None):
+        super(QueryRejected, self).__init__(reason)
+        self.reason = reason
+        self.cost = cost
+
+
+class QueryGuard(object):
+    """
+    Checks raw query bodies against a set of limits, and adds a timeout and a
+    hit budget to them.
+
+    Keyword arguments:
+    timeout -- Search timeout to impose, e.g. '10s' (None for none)
+    terminate_after -- Stop collecting hits on each shard after this many
+    max_cost -- The maximum estimated cost of a query
+    max_agg_depth -- The maximum nesting depth of aggregations
+    max_terms -- The maximum number of values in a 'terms' query or filter
+    allow_scripts -- Whether to let scripts through
+    allow_leading_wildcards -- Whether to let leading wildcards through
+    """
+
+    def __init__(self, timeout='10s', terminate_after=None, max_cost=1000,
+                 max_agg_depth=2, max_terms=1024, allow_scripts=False,
+                 allow_leading_wildcards=False):
+        self.timeout = timeout
+        self.terminate_after = terminate_after
+        self.max_cost = max_cost
+        self.max_agg_depth = max_agg_depth
+        self.max_terms = max_terms
+        self.allow_scripts = allow_scripts
+        self.allow_leading_wildcards = allow_leading_wildcards
+
+    @classmethod
+    def from_config(cls, config):
+        """Make a guard from SEARCH_RAW_* settings in a Flask config"""
+        kwargs = {}
+        for key in ('timeout', 'terminate_after', 'max_cost', 'max_agg_depth',
+                    'max_terms', 'allow_scripts', 'allow_leading_wildcards'):
+            name = 'SEARCH_RAW_' + key.upper()
+            if name in config:
+                kwargs[key] = config[name]
+        return cls(**kwargs)
+
+    def apply(self, query):
+        """
+        Check the query, and impose this guard's timeout and hit budget on it.
+        Raises QueryRejected if the query is not allowed, and returns its
+        estimated cost otherwise.
+        """
+        try:
+            cost = self.check(query)
+        except QueryRejected as e:
+            log.warn("Rejected raw search query (estimated cost %s): %s. "
+                     "Query: %s", e.cost, e.reason, json.dumps(query))
+            raise
+
+        if self.timeout is not None:
+            query['timeout'] = self.timeout
+        if self.terminate_after is not None:
+            query['terminate_after'] = self.terminate_after
+
+        return cost
+
+    def check(self, query):
+        """
+        Returns the estimated cost of the query, or raises QueryRejected if
+        the query is not allowed.
+        """
+        try:
+            cost = self._walk(query, 0)
+        except QueryRejected as e:
+            # The walk stopped at the construct it rejected, so estimate the
+            # cost of the whole query for the log.
+            e.cost = self._estimate(query)
+            raise
+        if self.max_cost is not None and cost > self.max_cost:
+            raise QueryRejected("estimated cost {0} exceeds the maximum of "
+                                "{1}".format(cost, self.max_cost), cost)
+        return cost
+
+    def _estimate(self, query):
+        """The estimated cost of a query, whether it is allowed or not"""
+        permissive = QueryGuard(max_cost=None, max_agg_depth=float('inf'),
+                                max_terms=float('inf'), allow_scripts=True,
+                                allow_leading_wildcards=True)
+        return permissive._walk(query, 0)
+
+    def _walk(self, node, agg_depth):
+        if isinstance(node, list):
+            return sum(self._walk(n, agg_depth) for n in node)
+        if not isinstance(node, dict):
+            return 0
+
+        cost = 0
+        for key, value in iteritems(node):
+            if key in SCRIPT_KEYS and not self.allow_scripts:
+                raise QueryRejected("scripts are not allowed")
+
+            if key in AGGREGATION_KEYS and isinstance(value, dict):
+                depth = agg_depth + 1
+                if depth > self.max_agg_depth:
+                    raise QueryRejected("aggregations may not be nested more "
+                                        "than {0} deep"
+                                        .format(self.max_agg_depth))
+                cost += AGGREGATION_COST * depth * len(value)
+                cost += self._walk(value, depth)
+                continue
+
+            if not self.allow_leading_wildcards:
+                if key in QUERY_STRING_KEYS and isinstance(value, dict):
+                    q = value.get('query')
+                    if (isinstance(q, string_types) and
+                            _LEADING_WILDCARD.search(q)):
+                        raise QueryRejected("leading wildcards are not "
+                                            "allowed")
+                elif key in WILDCARD_KEYS and isinstance(value, dict):
+                    if _has_leading_wildcard(key, value):
+                        raise QueryRejected("leading wildcards are not "
+                                            "allowed")
+
+            if key == 'terms' and isinstance(value, dict):
+                for v in value.values():
+                    if isinstance(v, list) and len(v) > self.max_terms:
+                        raise QueryRejected("'terms' may not list more than "
+                                            "{0} values"
+                                            .format(self.max_terms))
+                    if isinstance(v, list):
+                        cost += len(v) // 100
+
+            cost += COSTS.get(key, 1)
+            cost += self._walk(value, agg_depth)
+
+        return cost
+
+
+def _has_leading_wildcard(key, clause):
+    for v in clause.values():
+        if isinstance(v, dict):
+            v = v.get('value', v.get(key))
+        if not isinstance(v, string_types):
+            continue
+        if key == 'wildcard' and v[:1] in ('*', '?'):
+            return True
+        if key == 'regexp' and (v.startswith('.*') or v.startswith('.+')):
+            return True
+    return False
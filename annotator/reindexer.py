@@ -1,30 +1,119 @@
 from __future__ import absolute_import
 
+import collections
+import datetime
+import hashlib
+import itertools
+import json
+import math
+import os
+import threading
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+import iso8601
 from elasticsearch import helpers
 
 from .annotation import Annotation
 from .document import Document
+from .tombstone import Tombstone
+
+
+# The field the documents are split into slices by, for parallel reindexing
+SLICE_FIELD = 'created'
+
+# The number of slices per worker. Documents are rarely spread evenly over
+# time, so with more slices than workers, the work is shared more evenly.
+SLICES_PER_WORKER = 4
+
+# The default size of a bulk request, and the maximum number of documents in
+# one, when reindexing in parallel
+DEFAULT_CHUNK_BYTES = 10 * 1024 * 1024
+MAX_CHUNK_DOCS = 5000
+
+# The progress of a slice is saved to the checkpoint file, if any, every time
+# this many more of its documents have been copied
+CHECKPOINT_EVERY = 1000
+
+# The settings of an index while it is being filled, which make it refresh
+# and flush less often, and not copy documents to replicas as they come
+BULK_LOAD_SETTINGS = {
+    'index.refresh_interval': '-1',
+    'index.number_of_replicas': '0',
+    'index.translog.flush_threshold_size': '1gb',
+}
+# Elasticsearch's defaults of these, to restore if they weren't set
+DEFAULT_SETTINGS = {
+    'index.refresh_interval': '1s',
+    'index.number_of_replicas': '1',
+    'index.translog.flush_threshold_size': '512mb',
+}
+
+# When reindexing live, the alias is moved to the new index once a round of
+# catching up copies at most this many changes...
+DEFAULT_MAX_DELTA = 100
+# ...or the reindexing is given up after this many rounds
+DEFAULT_MAX_ROUNDS = 10
+# Changes are caught up from this many seconds before each checkpoint, to
+# allow for differences between clocks and for changes not yet refreshed
+CATCH_UP_MARGIN = 5
+# While catching up, the documents of the new index are looked up in batches
+# of this many, to leave out changes older than theirs
+CATCH_UP_LOOKUP_DOCS = 500
+
+# When verifying, the checksums of ranges of up to this many documents are
+# compared between the indices
+VERIFY_RANGE_DOCS = 1000
 
 
 class Reindexer(object):
 
-    es_models = Annotation, Document
+    es_models = Annotation, Document, Tombstone
 
-    def __init__(self, conn, interactive=False):
+    def __init__(self, conn, interactive=False, pipeline=None):
         self.conn = conn
         self.interactive = interactive
+        # An annotator.transforms.Pipeline to transform documents with on
+        # their way to the new index, if any
+        self.pipeline = pipeline
 
     def _print(self, s):
         if self.interactive:
             print(s)
 
-    def reindex(self, old_index, new_index):
-        """Reindex documents using the current mappings."""
+    def reindex(self, old_index, new_index, workers=1, chunk_size=None,
+                checkpoint=None, resume=False, verify=True,
+                bulk_settings=True):
+        """Reindex documents using the current mappings.
+
+        With more than one worker, the documents are split into slices by
+        their creation date, which are copied in parallel, each by its own
+        scroll and bulk requests. chunk_size is the size of a bulk request in
+        bytes.
+
+        If a checkpoint file is given, the progress of every slice is saved
+        to it, and with resume, a reindexing which was interrupted continues
+        where it left off. Once all slices are copied, the number of
+        documents in each is compared between the indices (unless verify is
+        False, or there is a pipeline, which may drop documents), and a
+        RuntimeError raised if any differ.
+
+        Unless bulk_settings is False, the new index has BULK_LOAD_SETTINGS
+        while it is filled (see bulk_load).
+        """
         conn = self.conn
 
         if not conn.indices.exists(old_index):
             raise ValueError("Index {0} does not exist!".format(old_index))
 
+        state = None
+        if resume:
+            state = Checkpoint.load(checkpoint)
+            if (state.source, state.target) != (old_index, new_index):
+                raise ValueError("Checkpoint {0} is of reindexing {1} to {2}."
+                                 .format(checkpoint, state.source,
+                                         state.target))
+
         if conn.indices.exists(new_index):
             self._print("Index {0} already exists. "
                         "The mapping will not be changed.".format(new_index))
@@ -32,11 +121,439 @@ class Reindexer(object):
             # Create the new index with (presumably) new mapping config
             conn.indices.create(new_index, body=self.get_index_config())
 
+        parallel = (workers > 1 or chunk_size is not None
+                    or checkpoint is not None or self.pipeline is not None)
+        if parallel and state is None:
+            slices = self.get_slices(old_index, workers * SLICES_PER_WORKER)
+            state = Checkpoint.start(checkpoint, old_index, new_index, slices)
+            # Saved before they are changed, so that a resumed run restores
+            # them rather than the bulk-load settings
+            if bulk_settings:
+                state.settings = original_settings(conn, new_index)
+            state.save()
+
         # Do the actual reindexing.
         self._print("Reindexing {0} to {1}...".format(old_index, new_index))
-        helpers.reindex(conn, old_index, new_index)
+        original = state.settings if state is not None else None
+        with self.bulk_load(new_index, enabled=bulk_settings,
+                            original=original):
+            if parallel:
+                self._reindex_parallel(old_index, new_index, workers,
+                                       chunk_size or DEFAULT_CHUNK_BYTES,
+                                       state)
+            else:
+                helpers.reindex(conn, old_index, new_index)
+
+        if (state is not None and state.path is not None and verify
+                and self.pipeline is None):
+            self._verify(old_index, new_index, state)
+        if self.pipeline is not None:
+            self._print_stage_stats()
         self._print("Reindexing done.")
 
+    def _print_stage_stats(self):
+        for s in self.pipeline.stats():
+            self._print("Transform {0}: {1} documents in {2:.1f}s{3}".format(
+                s['stage'], s['docs'], s['seconds'],
+                '' if s['docs_per_second'] is None else
+                ', {0:.0f} documents/s'.format(s['docs_per_second'])))
+
+    def bulk_load(self, index, enabled=True, original=None):
+        """
+        A context in which an index has BULK_LOAD_SETTINGS, as with the
+        bulk_load function, printing what it does if interactive.
+        """
+        if not enabled:
+            return _nothing()
+        return bulk_load(self.conn, index, log=self._print, original=original)
+
+    def reindex_live(self, old_index, new_index, alias=None,
+                     workers=1, chunk_size=None,
+                     checkpoint=None, resume=False, bulk_settings=True,
+                     max_delta=DEFAULT_MAX_DELTA,
+                     max_rounds=DEFAULT_MAX_ROUNDS):
+        """Reindex documents while the old index is still being written to.
+
+        After copying all documents, the changes made since the copy started
+        are copied over in rounds, each catching up with the changes made
+        during the previous one. Once a round copies at most max_delta
+        changes, the alias (if given) is moved to the new index, and the
+        changes made in the meantime are copied a last time. By then the new
+        index is written to, so changes older than a document's, or than its
+        tombstone's, in the new index are left out rather than undo them.
+
+        Setting dual_write_index of the app's ElasticSearch wrapper to the new
+        index before starting makes the rounds, and so the window in which
+        writes to the old index can be missed, shorter still.
+        """
+        conn = self.conn
+        # If the old index is an alias, it may be the one moved to the new
+        # index, so the catching up has to read from the index behind it.
+        if conn.indices.exists_alias(old_index):
+            old_index = ','.join(conn.indices.get_alias(old_index).keys())
+
+        since = _timestamp()
+        # Document counts can't be verified while the old index changes
+        self.reindex(old_index, new_index, workers, chunk_size,
+                     checkpoint=checkpoint, resume=resume, verify=False,
+                     bulk_settings=bulk_settings)
+        if resume:
+            # Catch up with the changes since the interrupted run started
+            since = Checkpoint.load(checkpoint).started
+
+        for i in range(max_rounds):
+            next_since = _timestamp()
+            delta = self.catch_up(old_index, new_index, since, chunk_size)
+            since = next_since
+            self._print("Caught up with {0} changes.".format(delta))
+            if delta <= max_delta:
+                break
+        else:
+            raise RuntimeError("Still {0} changes to catch up with after {1} "
+                               "rounds, giving up.".format(delta, max_rounds))
+
+        if alias:
+            self.alias(new_index, alias)
+            delta = self.catch_up(old_index, new_index, since, chunk_size)
+            self._print("Caught up with {0} changes after moving the alias."
+                        .format(delta))
+
+    def catch_up(self, old_index, new_index, since, chunk_size=None):
+        """
+        Copy the documents updated since a checkpoint to the new index, and
+        delete the annotations deleted since then from it. Returns the number
+        of documents copied and deleted.
+
+        Changes older than those made to the same documents in the new index
+        (such as by writes to it once the alias moved) are left out.
+        """
+        conn = self.conn
+        conn.indices.refresh(old_index)
+        conn.indices.refresh(new_index)
+
+        updated = _filtered({'range': {'updated': {'gte': since}}})
+        copied = self.copy_slice(old_index, new_index, updated,
+                                 chunk_size or DEFAULT_CHUNK_BYTES,
+                                 keep_newer=True)
+
+        deleted = _filtered({'range': {'deleted': {'gte': since}}})
+        tombstones = helpers.scan(conn, index=old_index,
+                                  doc_type=Tombstone.__type__,
+                                  query={'query': deleted})
+        tombstones = self._drop_stale(
+            new_index, tombstones,
+            lambda t: (Annotation.__type__, t['_source'].get('deleted')))
+        deletions = ({'_op_type': 'delete',
+                      '_index': new_index,
+                      '_type': Annotation.__type__,
+                      '_id': t['_id']} for t in tombstones)
+        # Annotations which never made it into the new index can't be deleted
+        # from it, which is fine.
+        count = 0
+        for ok, item in helpers.streaming_bulk(conn, deletions,
+                                               chunk_size=MAX_CHUNK_DOCS,
+                                               raise_on_error=False):
+            count += 1
+        return copied + count
+
+    def _reindex_parallel(self, old_index, new_index, workers, chunk_size,
+                          checkpoint):
+        todo = [i for i, s in enumerate(checkpoint.slices) if not s['done']]
+        self._print("Copying {0} of {1} slices with {2} workers..."
+                    .format(len(todo), len(checkpoint.slices), workers))
+
+        def copy(i):
+            return self._copy_checkpointed(old_index, new_index, chunk_size,
+                                           checkpoint, i)
+
+        pool = ThreadPool(workers)
+        try:
+            total = 0
+            for done, count in enumerate(pool.imap_unordered(copy, todo)):
+                total += count
+                self._print("{0}/{1} slices done, {2} documents copied"
+                            .format(done + 1, len(todo), total))
+        finally:
+            pool.close()
+            pool.join()
+        return total
+
+    def _verify(self, old_index, new_index, checkpoint):
+        mismatches = self.verify_slices(old_index, new_index,
+                                        [s['query'] for s in
+                                         checkpoint.slices])
+        if mismatches:
+            raise RuntimeError(
+                "Document counts differ in {0} slices: {1}".format(
+                    len(mismatches),
+                    ', '.join('slice {0} has {1} in {2} but {3} in {4}'
+                              .format(i, old_count, old_index,
+                                      new_count, new_index)
+                              for i, old_count, new_count in mismatches)))
+        self._print("Document counts of all slices match.")
+
+    def _copy_checkpointed(self, old_index, new_index, chunk_size,
+                           checkpoint, i):
+        """Copy slice i of a checkpoint, from where it left off"""
+        s = checkpoint.slices[i]
+        query = s['query']
+        if s['after'] is not None:
+            query = _and(query, {'range': {SLICE_FIELD: {'gte': s['after']}}})
+        copied = s['copied']
+
+        progress = None
+        if s['resumable']:
+            def progress(count, last):
+                checkpoint.update(i, copied=copied + count, after=last)
+
+        count = self.copy_slice(old_index, new_index, query, chunk_size,
+                                progress)
+        checkpoint.update(i, copied=copied + count, done=True)
+        return count
+
+    def get_slices(self, index, n):
+        """
+        Split the documents of an index into about n slices of equal time
+        spans of their creation date, and one of the documents without one.
+        Returns the query of each slice.
+
+        The first and last slices are open ended, so that documents created
+        since, or in another index the slices are used on, are in one too.
+        """
+        res = self.conn.search(index=index, search_type='count', body={
+            'aggs': {'min': {'min': {'field': SLICE_FIELD}},
+                     'max': {'max': {'field': SLICE_FIELD}}}})
+        low = res['aggregations']['min']['value']
+        high = res['aggregations']['max']['value']
+        if low is None or high is None:
+            return [{'match_all': {}}]
+
+        low, high = int(math.floor(low)), int(math.floor(high)) + 1
+        step = max(1, int(math.ceil((high - low) / float(n))))
+        starts = list(range(low, high, step))
+        slices = []
+        for n, start in enumerate(starts):
+            bounds = {}
+            if n > 0:
+                bounds['gte'] = start
+            if n < len(starts) - 1:
+                bounds['lt'] = start + step
+            slices.append(_filtered({'range': {SLICE_FIELD: bounds}}))
+        slices.append(_filtered({'missing': {'field': SLICE_FIELD}}))
+        return slices
+
+    def copy_slice(self, old_index, new_index, query, chunk_size,
+                   progress=None, keep_newer=False):
+        """
+        Copy the documents matching a query to another index, in bulk
+        requests of about chunk_size bytes. Returns the number copied.
+
+        If a progress function is given, the documents are copied in the
+        order of their creation date, and every CHECKPOINT_EVERY documents
+        it is called with the number copied so far and the creation date of
+        the last one.
+
+        The documents are transformed by the reindexer's pipeline, if any,
+        and those it leaves out are neither copied nor counted. So are those
+        updated earlier than their copy or tombstone in the new index, if
+        keep_newer is set.
+        """
+        conn = self.conn
+        body = {'query': query}
+        if progress is not None:
+            body['sort'] = [{SLICE_FIELD: 'asc'}]
+        hits = helpers.scan(conn, index=old_index, query=body,
+                            preserve_order=progress is not None)
+        if keep_newer:
+            hits = self._drop_stale(
+                new_index, hits,
+                lambda h: (h['_type'], h['_source'].get('updated')))
+        if self.pipeline is not None:
+            hits = self.pipeline.run(hits)
+
+        # The sort values of the documents sent but not yet confirmed
+        pending = collections.deque()
+
+        def actions():
+            for h in hits:
+                pending.append(h.get('sort', [None])[0])
+                h['_index'] = new_index
+                h.pop('sort', None)
+                if '_fields' in h:
+                    h.update(h.pop('_fields'))
+                yield h
+
+        count = 0
+        for ok, item in helpers.streaming_bulk(conn, actions(),
+                                               chunk_size=MAX_CHUNK_DOCS,
+                                               max_chunk_bytes=chunk_size):
+            count += 1
+            last = pending.popleft()
+            if progress is not None and count % CHECKPOINT_EVERY == 0:
+                progress(count, last)
+        return count
+
+    def _drop_stale(self, index, hits, change):
+        """
+        Leave out the hits whose documents changed later in an index. The
+        change function gives the type of the document a hit changes, and the
+        time it does; a tombstone in the index counts as a change of its
+        annotation at the time of the deletion.
+        """
+        for batch in _batches(hits, CATCH_UP_LOOKUP_DOCS):
+            ids = list(set(h['_id'] for h in batch))
+            res = self.conn.search(index=index, body={
+                'query': {'ids': {'values': ids}},
+                'size': 2 * len(ids)})
+            latest = {}
+            for d in res['hits']['hits']:
+                if d['_type'] == Tombstone.__type__:
+                    key = (Annotation.__type__, d['_id'])
+                    time = d['_source'].get('deleted')
+                else:
+                    key = (d['_type'], d['_id'])
+                    time = d['_source'].get('updated')
+                if time is not None:
+                    time = iso8601.parse_date(time)
+                    latest[key] = max(time, latest.get(key, time))
+
+            for h in batch:
+                doc_type, time = change(h)
+                newer = latest.get((doc_type, h['_id']))
+                if (newer is None or time is None or
+                        iso8601.parse_date(time) >= newer):
+                    yield h
+
+    def verify_slices(self, old_index, new_index, slices):
+        """
+        Compare the number of documents matching each slice's query in both
+        indices. Returns the (slice number, old count, new count) of those
+        which differ.
+        """
+        conn = self.conn
+        conn.indices.refresh(new_index)
+        mismatches = []
+        for i, query in enumerate(slices):
+            old_count, new_count = [
+                conn.count(index=index, body={'query': query})['count']
+                for index in (old_index, new_index)]
+            if old_count != new_count:
+                mismatches.append((i, old_count, new_count))
+        return mismatches
+
+    def verify(self, old_index, new_index, workers=1,
+               range_docs=VERIFY_RANGE_DOCS):
+        """Compare the documents of two indices.
+
+        The indices are split into slices (see get_slices), which workers
+        threads compare in parallel with compare_slice. Returns the (type,
+        id) of the documents only in the old index ('missing'), only in the
+        new index ('extra'), and in both but with different sources
+        ('differing'), each as a sorted list.
+        """
+        conn = self.conn
+        conn.indices.refresh(new_index)
+        slices = self.get_slices(old_index, workers * SLICES_PER_WORKER)
+        self._print("Verifying {0} slices of {1} against {2} with {3} "
+                    "workers...".format(len(slices), old_index, new_index,
+                                        workers))
+
+        def compare(query):
+            return self.compare_slice(old_index, new_index, query,
+                                      range_docs)
+
+        missing, extra, differing = set(), set(), set()
+        pool = ThreadPool(workers)
+        try:
+            for done, (m, e, d) in enumerate(pool.imap_unordered(compare,
+                                                                 slices)):
+                missing |= m
+                extra |= e
+                differing |= d
+                self._print("{0}/{1} slices verified".format(done + 1,
+                                                             len(slices)))
+        finally:
+            pool.close()
+            pool.join()
+
+        # A document whose creation date changed is in different slices of
+        # the indices
+        moved = missing & extra
+        differences = {'missing': sorted(missing - moved),
+                       'extra': sorted(extra - moved),
+                       'differing': sorted(differing | moved)}
+        for kind, ids in sorted(differences.items()):
+            if ids:
+                self._print("{0} {1} documents: {2}{3}".format(
+                    len(ids), kind,
+                    ', '.join('{0}/{1}'.format(*uid) for uid in ids[:10]),
+                    ', ...' if len(ids) > 10 else ''))
+        if not any(differences.values()):
+            self._print("All documents match.")
+        return differences
+
+    def compare_slice(self, old_index, new_index, query,
+                      range_docs=VERIFY_RANGE_DOCS):
+        """
+        Compare the documents matching a query in two indices. Both are
+        scanned in the order of _uid, and checksums of the sources of ranges
+        of up to range_docs documents compared, so that only the documents
+        of ranges which differ are kept and compared one by one. Returns the
+        sets of the (type, id) of documents only in the old index, only in
+        the new index, and in both but different.
+        """
+        missing, extra, differing = set(), set(), set()
+        for bounds in self._differing_ranges(old_index, new_index, query,
+                                             range_docs):
+            range_query = query
+            if bounds:
+                range_query = _and(query, {'range': {'_uid': bounds}})
+            old, new = [dict(((h['_type'], h['_id']), h['_source'])
+                             for h in self._scan_by_uid(index, range_query))
+                        for index in (old_index, new_index)]
+            missing.update(k for k in old if k not in new)
+            extra.update(k for k in new if k not in old)
+            differing.update(k for k in old if k in new and old[k] != new[k])
+        return missing, extra, differing
+
+    def _differing_ranges(self, old_index, new_index, query, range_docs):
+        """
+        Yields the bounds of the ranges of _uid whose documents have
+        different checksums in the indices. A range ends with every
+        range_docs documents of the old index, and the last one takes in the
+        remaining documents of the new index.
+        """
+        old = iter(self._scan_by_uid(old_index, query))
+        new = iter(self._scan_by_uid(new_index, query))
+        next_new = next(new, None)
+        lower = None
+        while True:
+            old_sum, new_sum = hashlib.sha1(), hashlib.sha1()
+            upper = None
+            for hit in itertools.islice(old, range_docs):
+                upper = _uid(hit)
+                _checksum(old_sum, hit)
+            while next_new is not None and (upper is None or
+                                            _uid(next_new) <= upper):
+                _checksum(new_sum, next_new)
+                next_new = next(new, None)
+
+            if old_sum.digest() != new_sum.digest():
+                bounds = {}
+                if lower is not None:
+                    bounds['gt'] = lower
+                if upper is not None:
+                    bounds['lte'] = upper
+                yield bounds
+            if upper is None:
+                return
+            lower = upper
+
+    def _scan_by_uid(self, index, query):
+        return helpers.scan(self.conn, index=index,
+                            query={'query': query, 'sort': ['_uid']},
+                            preserve_order=True)
+
     def alias(self, index, alias):
         conn = self.conn
         # Remove the alias's current targets.
@@ -64,3 +581,180 @@ class Reindexer(object):
         for model in self.es_models:
             index_config['mappings'].update(model.get_mapping())
         return index_config
+
+
+def original_settings(conn, index, settings=BULK_LOAD_SETTINGS):
+    """
+    Returns the values an index has of the given settings, to restore after
+    bulk loading. Values equal to the bulk-load ones are taken to be left over
+    from a run that was killed while loading, and Elasticsearch's defaults
+    returned instead.
+    """
+    index = _single_index(conn, index)
+    current = conn.indices.get_settings(index=index, flat_settings=True)
+    current = current[index]['settings']
+    original = {}
+    for k, v in settings.items():
+        value = current.get(k)
+        if value is None or str(value) == str(v):
+            value = DEFAULT_SETTINGS.get(k)
+        if value is not None:
+            original[k] = value
+    return original
+
+
+@contextmanager
+def bulk_load(conn, index, settings=BULK_LOAD_SETTINGS, optimize=True,
+              log=None, original=None):
+    """
+    A context in which an index has settings suited to filling it in bulk.
+
+    Afterwards, even if filling it failed, the index's original settings are
+    restored: those given, such as saved by an earlier run, or else those of
+    original_settings. If it succeeded, the index is also refreshed and
+    optimized, before its replicas are restored, so that they copy the merged
+    segments.
+    """
+    if log is None:
+        log = lambda s: None
+
+    index = _single_index(conn, index)
+    if original is None:
+        original = original_settings(conn, index, settings)
+    replicas = 'index.number_of_replicas'
+
+    log("Changing the settings of {0} for bulk loading...".format(index))
+    conn.indices.put_settings(index=index, body=settings)
+    done = False
+    try:
+        yield
+        done = True
+    finally:
+        log("Restoring the settings of {0}...".format(index))
+        restored = dict((k, v) for k, v in original.items() if k != replicas)
+        try:
+            if restored:
+                conn.indices.put_settings(index=index, body=restored)
+            if done:
+                conn.indices.refresh(index=index)
+                if optimize:
+                    log("Optimizing {0}...".format(index))
+                    conn.indices.optimize(index=index)
+        finally:
+            if replicas in original:
+                conn.indices.put_settings(
+                    index=index, body={replicas: original[replicas]})
+
+
+def _single_index(conn, index):
+    # Settings are keyed by the index an alias points to, which can only be
+    # written to in bulk if there is just the one.
+    if conn.indices.exists_alias(index):
+        indices = list(conn.indices.get_alias(index).keys())
+        if len(indices) != 1:
+            raise ValueError("Alias {0} points to {1} indices, not one."
+                             .format(index, len(indices)))
+        index = indices[0]
+    return index
+
+
+@contextmanager
+def _nothing():
+    yield
+
+
+class Checkpoint(object):
+    """
+    The progress of copying each slice of an index, saved to a file (if a
+    path is given) to resume from.
+    """
+
+    def __init__(self, path, source, target, slices, started=None,
+                 settings=None):
+        self.path = path
+        self.source = source
+        self.target = target
+        self.slices = slices
+        # The settings of the target to restore after bulk loading it
+        self.settings = settings
+        # When the reindexing started, to catch up with the changes since
+        if started is None:
+            started = _timestamp()
+        self.started = started
+        self._lock = threading.Lock()
+
+    @classmethod
+    def start(cls, path, source, target, queries):
+        """A checkpoint of nothing copied yet, of slices with these queries"""
+        return cls(path, source, target, [
+            {'query': q,
+             # Slices by creation date can be resumed part way through
+             'resumable': 'range' in q.get('filtered', {}).get('filter', {}),
+             'after': None,
+             'copied': 0,
+             'done': False}
+            for q in queries])
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        return cls(path, data['source'], data['target'], data['slices'],
+                   data['started'], data.get('settings'))
+
+    def update(self, i, **progress):
+        with self._lock:
+            self.slices[i].update(progress)
+            self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        if self.path is None:
+            return
+        # Write the file whole, so that it is never left half written
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'source': self.source,
+                       'target': self.target,
+                       'started': self.started,
+                       'settings': self.settings,
+                       'slices': self.slices}, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.path)
+
+
+def _filtered(filter):
+    return {'filtered': {'filter': filter}}
+
+
+def _and(query, filter):
+    """A query of a slice, narrowed down by a filter"""
+    if 'filtered' in query:
+        return _filtered({'and': [query['filtered']['filter'], filter]})
+    return _filtered(filter)
+
+
+def _batches(iterable, n):
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, n))
+        if not batch:
+            return
+        yield batch
+
+
+def _uid(hit):
+    return hit['_type'] + '#' + hit['_id']
+
+
+def _checksum(checksum, hit):
+    source = json.dumps(hit['_source'], sort_keys=True, separators=(',', ':'))
+    checksum.update((_uid(hit) + '\n' + source + '\n').encode('utf-8'))
+
+
+def _timestamp():
+    """The time to catch up with changes from, if starting now"""
+    now = datetime.datetime.now(iso8601.iso8601.UTC)
+    return (now - datetime.timedelta(seconds=CATCH_UP_MARGIN)).isoformat()
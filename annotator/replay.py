@@ -0,0 +1,196 @@
+"""
+Recording and replaying of the requests made to Elasticsearch.
+
+A RecordingConnection passes every request on to Elasticsearch, and writes it
+and the response to a cassette: a gzipped file with one JSON object per line.
+A ReplayConnection answers requests from such a cassette instead, without
+Elasticsearch, so the store's own code can be timed without the variance of
+a real cluster. Use them through the ``record_path`` and ``replay_path``
+attributes of annotator.elasticsearch.ElasticSearch.
+
+Replayed requests are matched on their method, URL, parameters and body. As
+bodies often hold values which change between runs (like the timestamps of a
+saved annotation), a request whose body does not match any recording falls
+back to the recordings of the same method, URL and parameters. Recordings
+which match the same request are replayed in the order they were recorded,
+and the last one is repeated once they run out.
+"""
+from __future__ import absolute_import
+
+import atexit
+import gzip
+import json
+import threading
+import time
+
+from elasticsearch import Connection, Urllib3HttpConnection
+from elasticsearch.exceptions import ConnectionError, TransportError
+
+from annotator.timing import TimingMixin
+
+
+class Recorder(object):
+    """Appends recorded requests to a cassette file"""
+
+    def __init__(self, path):
+        self.path = path
+        # Written as UTF-8 bytes, as a TextIOWrapper around a gzip file only
+        # takes unicode on Python 2
+        self._file = gzip.open(path, 'ab')
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def write(self, entry):
+        line = json.dumps(entry, sort_keys=True, separators=(',', ':'))
+        with self._lock:
+            self._file.write((line + '\n').encode('utf-8'))
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+class Cassette(object):
+    """The recorded requests of a cassette file, to replay"""
+
+    def __init__(self, entries=()):
+        self._exact = {}
+        self._loose = {}
+        self._lock = threading.Lock()
+        for entry in entries:
+            self.add(entry)
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, 'rb') as f:
+            return cls(json.loads(line.decode('utf-8'))
+                       for line in f if line.strip())
+
+    def add(self, entry):
+        exact, loose = _keys(entry['method'], entry['url'], entry['params'],
+                             entry['body'])
+        self._exact.setdefault(exact, _Recordings()).append(entry)
+        self._loose.setdefault(loose, _Recordings()).append(entry)
+
+    def find(self, method, url, params, body):
+        """Returns the next recording matching a request, or None"""
+        exact, loose = _keys(method, url, params, body)
+        with self._lock:
+            recordings = self._exact.get(exact) or self._loose.get(loose)
+            if recordings is None:
+                return None
+            return recordings.next()
+
+
+class _Recordings(list):
+
+    position = 0
+
+    def next(self):
+        entry = self[min(self.position, len(self) - 1)]
+        self.position += 1
+        return entry
+
+
+class RecordingMixin(object):
+    """
+    Records every request made through an elasticsearch Connection class to
+    the Recorder passed as the ``recorder`` connection option.
+    """
+
+    def __init__(self, recorder=None, **kwargs):
+        super(RecordingMixin, self).__init__(**kwargs)
+        self.recorder = recorder
+
+    def perform_request(self, method, url, params=None, body=None,
+                        timeout=None, ignore=()):
+        start = time.time()
+        try:
+            status, headers, data = super(RecordingMixin, self).perform_request(
+                method, url, params, body, timeout=timeout, ignore=ignore)
+        except TransportError as e:
+            # Connection failures have no status code, and aren't recorded
+            if isinstance(e.status_code, int):
+                info = e.info
+                self._record(method, url, params, body, e.status_code,
+                             info if isinstance(info, str) else
+                             json.dumps(info), time.time() - start)
+            raise
+        self._record(method, url, params, body, status, data,
+                     time.time() - start)
+        return status, headers, data
+
+    def _record(self, method, url, params, body, status, data, duration):
+        self.recorder.write({'method': method,
+                             'url': url,
+                             'params': params or {},
+                             'body': _text(body),
+                             'status': status,
+                             'data': data,
+                             'duration': round(duration, 6)})
+
+
+class CassetteConnection(Connection):
+    """
+    An elasticsearch Connection class which answers requests from the
+    Cassette passed as the ``cassette`` connection option, without making
+    them.
+
+    The ``latency`` option simulates the time Elasticsearch takes: 'recorded'
+    waits as long as the recorded request took, a number waits that many
+    seconds, and None (the default) answers immediately.
+    """
+
+    def __init__(self, cassette=None, latency=None, **kwargs):
+        super(CassetteConnection, self).__init__(**kwargs)
+        self.cassette = cassette
+        self.latency = latency
+
+    def perform_request(self, method, url, params=None, body=None,
+                        timeout=None, ignore=()):
+        entry = self.cassette.find(method, url, params, body)
+        if entry is None:
+            raise ConnectionError('N/A', 'No recorded response for {0} {1}'
+                                  .format(method, url), None)
+
+        if self.latency == 'recorded':
+            time.sleep(entry['duration'])
+        elif self.latency:
+            time.sleep(self.latency)
+
+        status, data = entry['status'], entry['data']
+        if not (200 <= status < 300) and status not in ignore:
+            self._raise_error(status, data)
+        return status, {}, data
+
+
+class RecordingConnection(TimingMixin, RecordingMixin, Urllib3HttpConnection):
+    pass
+
+
+class ReplayConnection(TimingMixin, CassetteConnection):
+    pass
+
+
+def _keys(method, url, params, body):
+    params = tuple(sorted((k, str(v)) for k, v in (params or {}).items()))
+    loose = (method, url, params)
+    return loose + (_normalize(_text(body)),), loose
+
+
+def _text(body):
+    if isinstance(body, bytes):
+        return body.decode('utf-8')
+    return body
+
+
+def _normalize(body):
+    """Returns a body with its JSON documents in a canonical form"""
+    if not body:
+        return None
+    try:
+        return '\n'.join(json.dumps(json.loads(line), sort_keys=True)
+                         for line in body.splitlines() if line.strip())
+    except ValueError:
+        return body
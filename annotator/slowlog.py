@@ -0,0 +1,110 @@
+"""
+A log of slow Elasticsearch searches.
+
+Searches taking longer than a threshold are logged with the exact query body
+that was sent, i.e. after permission filtering and URI expansion. To keep a
+struggling cluster from also flooding the logs, only a sample of slow
+searches is considered and at most a fixed number are logged per minute.
+Optionally, each logged search is run again with 'explain' (or, on
+Elasticsearch 2.2 and later, 'profile') to show where its time goes.
+"""
+from __future__ import absolute_import
+
+import json
+import logging
+import random
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class RateLimiter(object):
+    """A token bucket allowing up to `rate` events per `per` seconds"""
+
+    def __init__(self, rate, per=60.0):
+        self.rate = rate
+        self.per = per
+        self._allowance = float(rate)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            now = time.time()
+            self._allowance = min(
+                self.rate,
+                self._allowance + (now - self._last) * self.rate / self.per)
+            self._last = now
+            if self._allowance < 1:
+                return False
+            self._allowance -= 1
+            return True
+
+
+class SlowLog(object):
+    """
+    Keyword arguments:
+    threshold -- Searches taking at least this many seconds are slow
+    sample_rate -- The fraction of slow searches to consider for logging
+    max_per_minute -- The maximum number of slow searches to log per minute
+    capture -- None, or 'explain' or 'profile' to re-run logged searches with
+               that option and log the result
+    """
+
+    def __init__(self, threshold=1.0, sample_rate=1.0, max_per_minute=10,
+                 capture=None):
+        if capture not in (None, 'explain', 'profile'):
+            raise ValueError("capture must be None, 'explain' or 'profile'")
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.capture = capture
+        self.suppressed = 0
+        self._limiter = RateLimiter(max_per_minute)
+
+    def observe(self, model, query, params, duration):
+        """Log the search if it was slow, and it is selected for logging"""
+        if duration < self.threshold:
+            return False
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return False
+        if not self._limiter.allow():
+            self.suppressed += 1
+            return False
+
+        suppressed, self.suppressed = self.suppressed, 0
+        log.warn("Slow search on %s/%s took %.1f ms "
+                 "(%d slow searches not logged since the last one). "
+                 "Params: %s. Query: %s",
+                 model.es.index, model.__type__, duration * 1000, suppressed,
+                 json.dumps(params, sort_keys=True),
+                 json.dumps(query, sort_keys=True))
+
+        if self.capture is not None:
+            self._capture(model, query, params)
+        return True
+
+    def _capture(self, model, query, params):
+        body = dict(query)
+        body[self.capture] = True
+        if self.capture == 'explain':
+            # Explanations are per hit, and the top one tells enough.
+            body['size'] = 1
+        try:
+            res = model.es.conn.search(index=model.es.index,
+                                       doc_type=model.__type__,
+                                       body=body,
+                                       **params)
+        except Exception:
+            log.exception("Failed to capture %s of slow search",
+                          self.capture)
+            return
+
+        if self.capture == 'explain':
+            hits = res.get('hits', {}).get('hits', [])
+            detail = hits[0].get('_explanation') if hits else None
+        else:
+            detail = res.get('profile')
+        log.warn("Slow search %s (re-run took %s ms): %s",
+                 self.capture, res.get('took'),
+                 json.dumps(detail, sort_keys=True))
@@ -0,0 +1,264 @@
+"""
+Snapshots of an index in local files, to back up an index or seed one from,
+without another cluster.
+
+A snapshot is a directory of gzipped files with one JSON object per line,
+each holding the '_type', '_id' and '_source' of a document, and a
+manifest.json listing the files, the number of documents in each, and the
+mappings of the snapshotted index. The manifest is written last, so a
+directory without one holds an unfinished export.
+
+Documents are exported in slices of their creation date (see
+Reindexer.get_slices), each written to its own files, so that slices can be
+exported, and files imported, in parallel. Files are read a line at a time,
+so importing takes no more memory than a bulk request per worker.
+"""
+from __future__ import absolute_import
+
+import glob
+import gzip
+import json
+import os
+from multiprocessing.pool import ThreadPool
+
+from elasticsearch import helpers
+
+from .annotation import Annotation
+from .document import Document
+from .reindexer import (DEFAULT_CHUNK_BYTES, MAX_CHUNK_DOCS,
+                        SLICES_PER_WORKER, Reindexer, _nothing, _timestamp,
+                        bulk_load)
+from .tombstone import Tombstone
+
+MANIFEST = 'manifest.json'
+
+# The version of the format of snapshots, which importing checks
+FORMAT_VERSION = 1
+
+# The maximum number of documents in one file
+DEFAULT_CHUNK_DOCS = 50000
+
+
+class Snapshotter(object):
+
+    es_models = Annotation, Document, Tombstone
+
+    def __init__(self, conn, interactive=False):
+        self.conn = conn
+        self.interactive = interactive
+
+    def _print(self, s):
+        if self.interactive:
+            print(s)
+
+    def export_index(self, index, path, workers=1,
+                     chunk_docs=DEFAULT_CHUNK_DOCS, overwrite=False):
+        """
+        Export the documents of an index to a snapshot in the directory at
+        path, in files of up to chunk_docs documents, with slices of the
+        index exported by workers threads in parallel. Returns the number of
+        documents exported.
+
+        The directory has to be empty, or not exist yet, unless overwrite is
+        set, in which case any snapshot in it is removed first.
+        """
+        conn = self.conn
+        if not conn.indices.exists(index):
+            raise ValueError("Index {0} does not exist!".format(index))
+        if os.path.isdir(path) and os.listdir(path):
+            if not overwrite:
+                if os.path.exists(os.path.join(path, MANIFEST)):
+                    raise ValueError("There already is a snapshot in {0}."
+                                     .format(path))
+                raise ValueError("Directory {0} is not empty.".format(path))
+            self._print("Removing the snapshot in {0}...".format(path))
+            _remove_snapshot(path)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        created = _timestamp()
+        mappings = {}
+        # If the index is an alias, these are of the indices behind it
+        for res in conn.indices.get_mapping(index=index).values():
+            mappings.update(res['mappings'])
+
+        slices = Reindexer(conn).get_slices(index,
+                                            workers * SLICES_PER_WORKER)
+        self._print("Exporting {0} slices of {1} to {2} with {3} workers..."
+                    .format(len(slices), index, path, workers))
+
+        def export(args):
+            i, query = args
+            return self.export_slice(index, query, path,
+                                     '{0:03d}'.format(i), chunk_docs)
+
+        pool = ThreadPool(workers)
+        try:
+            chunks = []
+            for done, files in enumerate(pool.imap(export,
+                                                   enumerate(slices))):
+                chunks.extend(files)
+                self._print("{0}/{1} slices done, {2} documents exported"
+                            .format(done + 1, len(slices),
+                                    sum(c['docs'] for c in chunks)))
+        finally:
+            pool.close()
+            pool.join()
+
+        _write_json(os.path.join(path, MANIFEST), {
+            'format': FORMAT_VERSION,
+            'index': index,
+            'created': created,
+            'mappings': mappings,
+            'chunks': chunks,
+        })
+        count = sum(c['docs'] for c in chunks)
+        self._print("Exported {0} documents in {1} files."
+                    .format(count, len(chunks)))
+        return count
+
+    def export_slice(self, index, query, path, prefix,
+                     chunk_docs=DEFAULT_CHUNK_DOCS):
+        """
+        Export the documents of the models' types matching a query to files
+        named after prefix. Returns the file name and number of documents of
+        each file written.
+        """
+        doc_types = ','.join(m.__type__ for m in self.es_models)
+        hits = helpers.scan(self.conn, index=index, doc_type=doc_types,
+                            query={'query': query})
+        chunks = []
+        f = None
+        try:
+            for hit in hits:
+                if f is None or chunks[-1]['docs'] >= chunk_docs:
+                    if f is not None:
+                        f.close()
+                    name = '{0}-{1:05d}.ndjson.gz'.format(prefix,
+                                                          len(chunks))
+                    f = _open(os.path.join(path, name), 'wb')
+                    chunks.append({'file': name, 'docs': 0})
+                f.write(_line({'_type': hit['_type'],
+                               '_id': hit['_id'],
+                               '_source': hit['_source']}))
+                chunks[-1]['docs'] += 1
+        finally:
+            if f is not None:
+                f.close()
+        return chunks
+
+    def import_index(self, path, index, workers=1, chunk_size=None,
+                     bulk_settings=True):
+        """
+        Import the documents of the snapshot in the directory at path to an
+        index, created with the snapshot's mappings unless it exists, with
+        workers threads each importing a file at a time in bulk requests of
+        about chunk_size bytes. Returns the number of documents imported.
+
+        Unless bulk_settings is False, the index has BULK_LOAD_SETTINGS while
+        it is filled (see annotator.reindexer.bulk_load).
+        """
+        conn = self.conn
+        manifest = load_manifest(path)
+
+        if conn.indices.exists(index):
+            self._print("Index {0} already exists. "
+                        "The mapping will not be changed.".format(index))
+        else:
+            conn.indices.create(index, body={'mappings':
+                                             manifest['mappings']})
+
+        chunks = manifest['chunks']
+        self._print("Importing {0} files of {1} to {2} with {3} workers..."
+                    .format(len(chunks), path, index, workers))
+
+        def load(chunk):
+            return self.import_chunk(os.path.join(path, chunk['file']),
+                                     index, chunk['docs'],
+                                     chunk_size or DEFAULT_CHUNK_BYTES)
+
+        context = (bulk_load(conn, index, log=self._print) if bulk_settings
+                   else _nothing())
+        with context:
+            pool = ThreadPool(workers)
+            try:
+                count = 0
+                for done, n in enumerate(pool.imap_unordered(load, chunks)):
+                    count += n
+                    self._print("{0}/{1} files done, {2} documents imported"
+                                .format(done + 1, len(chunks), count))
+            finally:
+                pool.close()
+                pool.join()
+
+        self._print("Imported {0} documents.".format(count))
+        return count
+
+    def import_chunk(self, filename, index, docs, chunk_size):
+        """
+        Import the documents of a file to an index, checking that it holds
+        as many as the manifest says. Returns the number imported.
+        """
+        actions = ({'_index': index,
+                    '_type': doc['_type'],
+                    '_id': doc['_id'],
+                    '_source': doc['_source']}
+                   for doc in _read(filename))
+        count = 0
+        for ok, item in helpers.streaming_bulk(self.conn, actions,
+                                               chunk_size=MAX_CHUNK_DOCS,
+                                               max_chunk_bytes=chunk_size):
+            count += 1
+        if count != docs:
+            raise RuntimeError("{0} holds {1} documents, but the manifest "
+                               "says {2}.".format(filename, count, docs))
+        return count
+
+
+def load_manifest(path):
+    """Returns the manifest of the snapshot in the directory at path"""
+    filename = os.path.join(path, MANIFEST)
+    if not os.path.exists(filename):
+        raise ValueError("There is no finished snapshot in {0}."
+                         .format(path))
+    with open(filename) as f:
+        manifest = json.load(f)
+    if manifest.get('format') != FORMAT_VERSION:
+        raise ValueError("Snapshot {0} is of format {1}, not {2}."
+                         .format(path, manifest.get('format'),
+                                 FORMAT_VERSION))
+    return manifest
+
+
+def _remove_snapshot(path):
+    # The manifest goes first, so that the directory never holds a finished
+    # snapshot with some of its files missing
+    manifest = os.path.join(path, MANIFEST)
+    for filename in [manifest] + glob.glob(os.path.join(path, '*.ndjson.gz')):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def _open(filename, mode):
+    # The files are written and read as UTF-8 bytes, as a TextIOWrapper
+    # around a gzip file only takes unicode on Python 2
+    return gzip.open(filename, mode)
+
+
+def _line(doc):
+    return (json.dumps(doc, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def _read(filename):
+    with _open(filename, 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line.decode('utf-8'))
+
+
+def _write_json(filename, data):
+    # Write the file whole, so that it is never left half written
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.rename(tmp, filename)
@@ -9,42 +9,93 @@ It defines these routes:
   * Update
   * Delete
   * Search
+  * Multi-search
   * Raw ElasticSearch search
+  * Changes
+  * Stream
+  * Counts
+  * Facets
+  * Timeline
+  * Metrics
 See their descriptions in `root`'s definition for more detail.
 """
 from __future__ import absolute_import
 
+import base64
+import csv
+import hmac
 import json
+import logging
+import random
+import time
+import uuid
 
+import iso8601
 from elasticsearch.exceptions import TransportError
 from flask import Blueprint, Response
 from flask import current_app, g
 from flask import request
 from flask import url_for
-from six import iteritems
+from six import iteritems, string_types
 
+from annotator import events, metrics, timing
 from annotator.atoi import atoi
 from annotator.annotation import Annotation
+from annotator.annotation import FACET_FIELDS, FACETS_DEFAULT_SIZE
+from annotator.annotation import TIMELINE_FIELDS, TIMELINE_INTERVALS
+from annotator.document import Document
+from annotator.elasticsearch import RESULTS_DEFAULT_SIZE, RESULTS_MAX_SIZE
+from annotator.profiling import SamplingProfiler
+from annotator.queryguard import QueryGuard, QueryRejected
+from annotator.tombstone import Tombstone
 
 store = Blueprint('store', __name__)
 
+log = logging.getLogger(__name__)
+
 CREATE_FILTER_FIELDS = ('updated', 'created', 'consumer', 'id')
 UPDATE_FILTER_FIELDS = ('updated', 'created', 'user', 'consumer')
 
+# The URL parameters a raw search POST may pass on to Elasticsearch; the rest
+# (q, timeout, terminate_after, ...) would get around the query guard
+SEARCH_RAW_PARAMS = ('search_type', 'from', 'size')
+
+# The maximum number of searches in one multi-search request
+MSEARCH_MAX_SEARCHES = 50
+
+# The maximum number of URIs to count annotations for in one request
+COUNTS_MAX_URIS = 1000
+
+# Seconds between keep-alive comments on an idle event stream
+STREAM_HEARTBEAT = 15
+# Seconds after which an event stream is closed, for clients to reconnect
+STREAM_MAX_DURATION = 300
+
 
 # We define our own jsonify rather than using flask.jsonify because we wish
 # to jsonify arbitrary objects (e.g. index returns a list) rather than kwargs.
 def jsonify(obj, *args, **kwargs):
-    res = json.dumps(obj, indent=None if request.is_xhr else 2)
+    with timing.phase('json'):
+        res = json.dumps(obj, indent=None if request.is_xhr else 2)
     return Response(res, mimetype='application/json', *args, **kwargs)
 
 
 @store.before_request
 def before_request():
+    if (current_app.config.get('REQUEST_TIMING') or
+            current_app.config.get('METRICS_ENABLED')):
+        timing.start()
+
+    if current_app.config.get('PROFILE_DIR') and _should_profile():
+        g.profiler = SamplingProfiler(
+            interval=current_app.config.get('PROFILE_INTERVAL', 0.005))
+        g.profiler.start()
+
     if not hasattr(g, 'annotation_class'):
         g.annotation_class = Annotation
 
-    user = g.auth.request_user(request)
+    with timing.phase('auth'):
+        user = g.auth.request_user(request)
     if user is not None:
         g.user = user
     elif not hasattr(g, 'user'):
@@ -53,6 +104,15 @@ def before_request():
 
 @store.after_request
 def after_request(response):
+    profiler = getattr(g, 'profiler', None)
+    if profiler is not None:
+        g.profiler = None
+        profiler.stop()
+        request_id = request.headers.get('x-request-id', uuid.uuid4().hex)
+        path = profiler.write(current_app.config['PROFILE_DIR'],
+                              request.endpoint or 'none', request_id)
+        log.info("Wrote profile of request %s to %s", request_id, path)
+
     ac = 'Access-Control-'
     rh = response.headers
 
@@ -65,9 +125,74 @@ def after_request(response):
         rh[ac + 'Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
         rh[ac + 'Max-Age'] = '86400'
 
+    collector = timing.stop()
+    if collector is not None:
+        if current_app.config.get('METRICS_ENABLED'):
+            _record_metrics(collector, response)
+        if current_app.config.get('REQUEST_TIMING'):
+            _report_timing(collector, response)
+
     return response
 
 
+def _record_metrics(collector, response):
+    endpoint = request.endpoint or 'none'
+    metrics.REQUESTS.inc(endpoint=endpoint,
+                         method=request.method,
+                         status=str(response.status_code))
+    metrics.REQUEST_DURATION.observe(collector.elapsed, endpoint=endpoint)
+    for call in collector.es_calls:
+        metrics.ES_DURATION.observe(call['duration'],
+                                    operation=call['operation'])
+
+    directory = current_app.config.get('METRICS_DIR')
+    if directory is not None:
+        metrics.registry.flush(directory)
+
+
+@store.teardown_request
+def teardown_request(exc):
+    # Stop the timing and profiler of a request which failed before
+    # after_request ran, so they don't carry over to the thread's next one
+    timing.stop()
+
+    profiler = getattr(g, 'profiler', None)
+    if profiler is not None:
+        g.profiler = None
+        profiler.stop()
+
+
+def _should_profile():
+    """
+    Whether to profile the current request: either it carries the configured
+    profiling token, or it is picked by the sample rate.
+    """
+    token = current_app.config.get('PROFILE_TOKEN')
+    header = request.headers.get('x-annotator-profile')
+    if token and header and hmac.compare_digest(str(header), str(token)):
+        return True
+    rate = current_app.config.get('PROFILE_SAMPLE_RATE', 0)
+    return rate > 0 and random.random() < rate
+
+
+def _report_timing(collector, response):
+    response.headers['Server-Timing'] = collector.server_timing()
+
+    endpoint = request.endpoint
+    for call in collector.es_calls:
+        log.info("es_call endpoint=%s operation=%s index=%s "
+                 "duration_ms=%.1f bytes=%d",
+                 endpoint, call['operation'], call['index'],
+                 call['duration'] * 1000, call['size'])
+    log.info("request endpoint=%s method=%s status=%d es_calls=%d "
+             "es_ms=%.1f %s total_ms=%.1f",
+             endpoint, request.method, response.status_code,
+             len(collector.es_calls), collector.es_duration * 1000,
+             ' '.join('{0}_ms={1:.1f}'.format(k, v * 1000)
+                      for k, v in sorted(collector.phases.items())),
+             collector.elapsed * 1000)
+
+
 # ROOT
 @store.route('/')
 def root():
@@ -123,12 +248,94 @@ def root():
                 'url': url_for('.search_annotations', _external=True),
                 'desc': 'Basic search API'
             },
+            'msearch': {
+                'method': 'POST',
+                'url': url_for('.msearch_annotations', _external=True),
+                'desc': ('Run several searches at once. Takes a JSON list of '
+                         'objects with the same parameters as the basic '
+                         'search API, and returns a list of their results.')
+            },
             'search_raw': {
                 'method': 'GET/POST',
                 'url': url_for('.search_annotations_raw', _external=True),
                 'desc': ('Advanced search API -- direct access to '
                          'ElasticSearch. Uses the same API as the '
                          'ElasticSearch query endpoint.')
+            },
+            'changes': {
+                'method': 'GET',
+                'url': url_for('.changes_annotations', _external=True),
+                'query': {
+                    'since': {
+                        'type': 'str',
+                        'desc': ("An ISO 8601 timestamp, or the 'next' token "
+                                 "returned by a previous call")
+                    },
+                    'uri': {
+                        'type': 'str',
+                        'desc': "Only return changes to annotations on this URI"
+                    },
+                    'limit': {
+                        'type': 'int',
+                        'desc': "The maximum number of changes to return"
+                    }
+                },
+                'desc': ('Changes feed -- annotations created, updated or '
+                         'deleted since a checkpoint, oldest first')
+            },
+            'stream': {
+                'method': 'GET',
+                'url': url_for('.stream_annotations', _external=True),
+                'query': {
+                    'uri': {
+                        'type': 'str',
+                        'desc': "The URI to receive annotation changes for"
+                    }
+                },
+                'desc': ('Server-sent events stream of annotations created, '
+                         'updated or deleted on a URI')
+            },
+            'facets': {
+                'method': 'GET',
+                'url': url_for('.facet_annotations', _external=True),
+                'query': {
+                    'fields': {
+                        'type': 'str',
+                        'desc': ("Comma-separated fields to count values of "
+                                 "(default: {0})".format(
+                                     ','.join(FACET_FIELDS)))
+                    },
+                    'size': {
+                        'type': 'int',
+                        'desc': "The maximum number of values per field"
+                    }
+                },
+                'desc': ('Count the most common tags, users, URIs and '
+                         'consumers of the annotations matching the other '
+                         'parameters, as for the basic search API')
+            },
+            'timeline': {
+                'method': 'GET',
+                'url': url_for('.timeline_annotations', _external=True),
+                'query': {
+                    'field': {
+                        'type': 'str',
+                        'desc': "'created' (default) or 'updated'"
+                    },
+                    'interval': {
+                        'type': 'str',
+                        'desc': "'hour', 'day' (default) or 'week'"
+                    }
+                },
+                'desc': ('Count the annotations matching the other '
+                         'parameters, as for the basic search API, per '
+                         'hour, day or week')
+            },
+            'counts': {
+                'method': 'POST',
+                'url': url_for('.count_annotations', _external=True),
+                'desc': ('Count the annotations on each of a list of URIs, '
+                         'sent as {"uris": [...]}')
             }
         }
     })
@@ -264,17 +471,7 @@ def delete_annotation(id):
 # SEARCH
 @store.route('/search')
 def search_annotations():
-    params = dict(request.args.items())
-    kwargs = dict()
-
-    # Take limit and offset out of the parameters
-    if 'offset' in params:
-        kwargs['offset'] = atoi(params.pop('offset'), default=None)
-    if 'limit' in params:
-        kwargs['limit'] = atoi(params.pop('limit'), default=None)
-
-    # All remaining parameters are considered searched fields.
-    kwargs['query'] = params
+    kwargs = _search_kwargs(dict(request.args.items()))
 
     if current_app.config.get('AUTHZ_ON'):
         # Pass the current user to do permission filtering on results
@@ -287,6 +484,48 @@ def search_annotations():
                     'rows': results})
 
 
+# MULTI-SEARCH
+@store.route('/msearch', methods=['POST'])
+def msearch_annotations():
+    searches = request.json
+
+    if (not isinstance(searches, list) or
+            not all(isinstance(p, dict) for p in searches)):
+        return jsonify('Expected a JSON list of search parameter objects.',
+                       status=400)
+
+    if len(searches) > MSEARCH_MAX_SEARCHES:
+        return jsonify('Cannot run more than {0} searches at once.'
+                       .format(MSEARCH_MAX_SEARCHES),
+                       status=400)
+
+    queries = []
+    for params in searches:
+        kwargs = _search_kwargs(dict(params))
+        queries.append(g.annotation_class._build_query(**kwargs))
+
+    kwargs = {}
+    if current_app.config.get('AUTHZ_ON'):
+        # Pass the current user to do permission filtering on results
+        kwargs['user'] = g.user
+
+    responses = g.annotation_class.msearch_raw(queries, **kwargs)
+
+    results = []
+    for res in responses:
+        if 'error' in res:
+            results.append({'error': res['error']})
+        else:
+            hits = res['hits']
+            results.append({
+                'total': hits['total'],
+                'rows': [g.annotation_class(d['_source'], id=d['_id'])
+                         for d in hits['hits']]
+            })
+
+    return jsonify(results)
+
+
 # RAW ES SEARCH
 @store.route('/search_raw', methods=['GET', 'POST'])
 def search_annotations_raw():
@@ -297,6 +536,13 @@ def search_annotations_raw():
         return jsonify('Could not parse request payload!',
                        status=400)
 
+    if current_app.config.get('SEARCH_RAW_GUARD', True):
+        try:
+            QueryGuard.from_config(current_app.config).apply(query)
+        except QueryRejected as e:
+            return jsonify('Query rejected: {0}.'.format(e.reason),
+                           status=400)
+
     if current_app.config.get('AUTHZ_ON'):
         user = g.user
     else:
@@ -315,6 +561,220 @@ def search_annotations_raw():
     return jsonify(res, status=res.get('status', 200))
 
 
+# CHANGES
+@store.route('/annotations/changes')
+def changes_annotations():
+    try:
+        since, seen = _decode_since(request.args.get('since'))
+    except ValueError:
+        return jsonify('Could not parse since parameter!', status=400)
+
+    limit = atoi(request.args.get('limit'), default=RESULTS_DEFAULT_SIZE)
+    limit = min(RESULTS_MAX_SIZE, max(0, limit))
+
+    kwargs = {'since': since, 'limit': limit}
+    kwargs['uri'] = request.args.get('uri')
+
+    if current_app.config.get('AUTHZ_ON'):
+        # Pass the current user to do permission filtering on results
+        kwargs['user'] = g.user
+
+    # Changes already delivered at the checkpoint's time are told apart by
+    # kind as well as id, as an annotation may have been both updated and
+    # deleted within that millisecond.
+    rows = g.annotation_class.changes(seen=_seen_of_kind(seen, 'row'),
+                                      **kwargs)
+    deleted = Tombstone.since(seen=_seen_of_kind(seen, 'deleted'), **kwargs)
+
+    # Interleave updates and deletions into a single timeline, and only
+    # return its first page so that the checkpoint covers both. As both lists
+    # are sorted already, the page holds a prefix of each of them.
+    changes = ([(_truncate_timestamp(r['updated']), r['id'], 'row',
+                 r['updated'])
+                for r in rows] +
+               [(_truncate_timestamp(t['deleted']), t['id'], 'deleted',
+                 t['deleted'])
+                for t in deleted])
+    changes.sort(key=lambda c: c[0])
+    changes = changes[:limit]
+
+    if changes:
+        since, seen = _checkpoint(changes, since, seen)
+
+    kinds = [c[2] for c in changes]
+
+    return jsonify({'rows': rows[:kinds.count('row')],
+                    'deleted': deleted[:kinds.count('deleted')],
+                    'next': _encode_since(since, seen)})
+
+
+# STREAM
+@store.route('/annotations/stream')
+def stream_annotations():
+    uri = request.args.get('uri')
+    if not uri:
+        return jsonify('No uri given. Cannot stream annotation changes.',
+                       status=400)
+
+    # Also receive changes to annotations on equivalent URIs.
+    doc = Document.get_by_uri(uri)
+    uris = doc.uris() if doc else [uri]
+
+    user = g.user
+    authorize = g.authorize
+    heartbeat = current_app.config.get('STREAM_HEARTBEAT', STREAM_HEARTBEAT)
+    deadline = time.time() + current_app.config.get('STREAM_MAX_DURATION',
+                                                    STREAM_MAX_DURATION)
+
+    def generate():
+        subscription = events.broker.subscribe(uris)
+        try:
+            while time.time() < deadline:
+                timeout = min(heartbeat, max(0, deadline - time.time()))
+                event = subscription.get(timeout=timeout)
+                if subscription.overflowed:
+                    # Events have been lost; the client has to catch up by
+                    # other means, e.g. the changes feed.
+                    yield 'event: overflow\ndata: null\n\n'
+                    return
+                if event is None:
+                    yield ': keep-alive\n\n'
+                elif authorize(event['annotation'], 'read', user):
+                    yield 'event: {0}\ndata: {1}\n\n'.format(
+                        event['action'], json.dumps(event['annotation']))
+        finally:
+            subscription.close()
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+# FACETS
+@store.route('/facets')
+def facet_annotations():
+    params = dict(request.args.items())
+
+    fields = FACET_FIELDS
+    if 'fields' in params:
+        fields = _csv_split(params.pop('fields'))
+        unknown = [f for f in fields if f not in FACET_FIELDS]
+        if unknown:
+            return jsonify('Cannot count values of field(s): {0}'
+                           .format(', '.join(unknown)),
+                           status=400)
+
+    size = atoi(params.pop('size', None), default=FACETS_DEFAULT_SIZE)
+    size = min(RESULTS_MAX_SIZE, max(1, size))
+
+    # Paging makes no sense here, but should not end up in the query.
+    params.pop('offset', None)
+    params.pop('limit', None)
+
+    kwargs = {'query': params, 'fields': fields, 'size': size}
+
+    if current_app.config.get('AUTHZ_ON'):
+        # Pass the current user to do permission filtering on results
+        kwargs['user'] = g.user
+
+    total, facets = g.annotation_class.facets(**kwargs)
+
+    return jsonify({'total': total,
+                    'facets': facets})
+
+
+# TIMELINE
+@store.route('/timeline')
+def timeline_annotations():
+    params = dict(request.args.items())
+
+    field = params.pop('field', 'created')
+    if field not in TIMELINE_FIELDS:
+        return jsonify('Cannot make a timeline of field: {0}'.format(field),
+                       status=400)
+
+    interval = params.pop('interval', 'day')
+    if interval not in TIMELINE_INTERVALS:
+        return jsonify('Unknown timeline interval: {0}'.format(interval),
+                       status=400)
+
+    # Paging makes no sense here, but should not end up in the query.
+    params.pop('offset', None)
+    params.pop('limit', None)
+
+    kwargs = {'query': params, 'field': field, 'interval': interval}
+
+    if current_app.config.get('AUTHZ_ON'):
+        # Pass the current user to do permission filtering on results
+        kwargs['user'] = g.user
+
+    return jsonify({'buckets': g.annotation_class.timeline(**kwargs)})
+
+
+# METRICS
+@store.route('/metrics')
+def metrics_text():
+    if not current_app.config.get('METRICS_ENABLED'):
+        return jsonify('Metrics are not enabled.', status=404)
+
+    text = metrics.registry.render(current_app.config.get('METRICS_DIR'))
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+
+def _es_bulk_queue():
+    # The number of bulk requests queued on the Elasticsearch nodes, summed
+    stats = Annotation.es.conn.nodes.stats(metric='thread_pool')
+    return {(): sum(n['thread_pool']['bulk']['queue']
+                    for n in stats['nodes'].values())}
+
+
+metrics.registry.callback(
+    'gauge', 'annotator_es_bulk_queue',
+    "Bulk requests queued on the Elasticsearch nodes",
+    _es_bulk_queue)
+
+
+# COUNTS
+@store.route('/counts', methods=['POST'])
+def count_annotations():
+    payload = request.json
+    if isinstance(payload, dict):
+        payload = payload.get('uris')
+
+    if (not isinstance(payload, list) or
+            not all(isinstance(u, string_types) for u in payload)):
+        return jsonify('Expected a JSON list of URIs. No counts returned.',
+                       status=400)
+
+    if len(payload) > COUNTS_MAX_URIS:
+        return jsonify('Cannot count annotations on more than {0} URIs at '
+                       'once.'.format(COUNTS_MAX_URIS),
+                       status=400)
+
+    kwargs = {}
+    if current_app.config.get('AUTHZ_ON'):
+        # Pass the current user to do permission filtering on results
+        kwargs['user'] = g.user
+
+    counts = g.annotation_class.count_by_uris(payload, **kwargs)
+    return jsonify({'counts': counts})
+
+
+def _search_kwargs(params):
+    kwargs = dict()
+
+    # Take limit and offset out of the parameters
+    if 'offset' in params:
+        kwargs['offset'] = atoi(params.pop('offset'), default=None)
+    if 'limit' in params:
+        kwargs['limit'] = atoi(params.pop('limit'), default=None)
+
+    # All remaining parameters are considered searched fields.
+    kwargs['query'] = params
+
+    return kwargs
+
+
 def _filter_input(obj, fields):
     for field in fields:
         obj.pop(field, None)
@@ -336,7 +796,9 @@ def _get_annotation_user(ann):
 
 
 def _check_action(annotation, action, message=''):
-    if not g.authorize(annotation, action, g.user):
+    with timing.phase('authz'):
+        authorized = g.authorize(annotation, action, g.user)
+    if not authorized:
         return _failed_authz_response(message)
 
 
@@ -364,6 +826,74 @@ def _failed_authz_response(msg=''):
                     status=401)
 
 
+def _checkpoint(changes, since, seen):
+    """
+    Returns the checkpoint to resume a changes feed after the given changes,
+    a list of (timestamp, id, kind, exact timestamp) tuples: the time of the
+    last change, and the [kind, id, exact timestamp] of all changes sharing
+    that time.
+
+    Changes are told apart by their exact time rather than by id alone, so
+    that an annotation which changes again within the same millisecond is
+    still reported.
+    """
+    last = changes[-1][0]
+    delivered = [[c[2], c[1], c[3]] for c in changes if c[0] == last]
+
+    # If the whole page shared the previous checkpoint's time, the changes
+    # that were already delivered before it must still be skipped next time,
+    # unless a later change to the same annotation replaced them.
+    if since == last:
+        replaced = set((kind, id) for kind, id, _ in delivered)
+        delivered = [s for s in seen
+                     if (s[0], s[1]) not in replaced] + delivered
+
+    return last, delivered
+
+
+def _seen_of_kind(seen, kind):
+    return [[id, exact] for k, id, exact in seen if k == kind]
+
+
+def _truncate_timestamp(ts):
+    # Elasticsearch stores dates with millisecond precision, so compare and
+    # resume at that precision too.
+    dt = iso8601.parse_date(ts)
+    dt = dt.replace(microsecond=dt.microsecond // 1000 * 1000)
+    return dt.isoformat()
+
+
+def _encode_since(since, seen):
+    if since is None:
+        return None
+    token = json.dumps({'since': since, 'seen': seen}).encode('utf-8')
+    return base64.urlsafe_b64encode(token).decode('ascii').rstrip('=')
+
+
+def _decode_since(value):
+    """
+    Parses the 'since' parameter of the changes feed, which is either an
+    ISO 8601 timestamp or a token as returned by _encode_since.
+    """
+    if not value:
+        return None, []
+
+    try:
+        return _truncate_timestamp(value), []
+    except iso8601.ParseError:
+        pass
+
+    try:
+        padded = value + '=' * (-len(value) % 4)
+        token = json.loads(
+            base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+        seen = [[kind, id, exact] for kind, id, exact in token['seen']
+                if kind in ('row', 'deleted')]
+        return _truncate_timestamp(token['since']), seen
+    except (TypeError, KeyError, UnicodeError, ValueError):
+        raise ValueError("invalid since parameter: {0!r}".format(value))
+
+
 def _build_query_raw(request):
     query = {}
     params = {}
@@ -377,14 +907,16 @@ def _build_query_raw(request):
 
     elif request.method == 'POST':
 
-        try:
-            query = json.loads(request.json or
-                               request.data or
-                               request.form.keys()[0])
-        except (ValueError, IndexError):
-            raise ValueError
+        query = request.get_json(silent=True)
+        if query is None:
+            try:
+                query = json.loads(request.data or
+                                   list(request.form.keys())[0])
+            except (ValueError, IndexError):
+                raise ValueError
 
-        params = request.args
+        params = dict((k, v) for k, v in iteritems(request.args)
+                      if k in SEARCH_RAW_PARAMS)
 
     for o in (params, query):
         if 'from' in o:
@@ -0,0 +1,132 @@
+"""
+Request-scoped timing of Elasticsearch calls and other phases of a request.
+
+Call start() at the beginning of a request to begin collecting timings in the
+current thread, and stop() at its end to retrieve them. While no collection is
+running, the instrumentation does nothing but look up a thread-local.
+"""
+from __future__ import absolute_import
+
+import threading
+import time
+from contextlib import contextmanager
+
+from elasticsearch import Urllib3HttpConnection
+
+_local = threading.local()
+
+
+class Collector(object):
+    """The timings collected during one request"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.es_calls = []
+        self.phases = {}
+
+    def record_es(self, operation, index, duration, size):
+        self.es_calls.append({'operation': operation,
+                              'index': index,
+                              'duration': duration,
+                              'size': size})
+
+    def add(self, name, duration):
+        self.phases[name] = self.phases.get(name, 0) + duration
+
+    @property
+    def es_duration(self):
+        return sum(c['duration'] for c in self.es_calls)
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    def server_timing(self):
+        """Returns the timings as the value of a Server-Timing header"""
+        metrics = ['es;dur={0:.1f};desc="{1} call{2}"'.format(
+            self.es_duration * 1000,
+            len(self.es_calls),
+            '' if len(self.es_calls) == 1 else 's')]
+        for name in sorted(self.phases):
+            metrics.append('{0};dur={1:.1f}'.format(
+                name, self.phases[name] * 1000))
+        metrics.append('total;dur={0:.1f}'.format(self.elapsed * 1000))
+        return ', '.join(metrics)
+
+
+def start():
+    _local.collector = Collector()
+    return _local.collector
+
+
+def stop():
+    collector = current()
+    _local.collector = None
+    return collector
+
+
+def current():
+    return getattr(_local, 'collector', None)
+
+
+@contextmanager
+def phase(name):
+    """Add the time spent in the with block to the named phase, if timing"""
+    collector = getattr(_local, 'collector', None)
+    if collector is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        collector.add(name, time.time() - start)
+
+
+class TimingMixin(object):
+    """
+    Records every request made through an elasticsearch Connection class in
+    the current collector, if any.
+    """
+
+    def perform_request(self, method, url, params=None, body=None,
+                        timeout=None, ignore=()):
+        collector = getattr(_local, 'collector', None)
+        if collector is None:
+            return super(TimingMixin, self).perform_request(
+                method, url, params, body, timeout=timeout, ignore=ignore)
+
+        start = time.time()
+        size = 0
+        try:
+            status, headers, data = super(TimingMixin, self).perform_request(
+                method, url, params, body, timeout=timeout, ignore=ignore)
+            size = len(data or '')
+            return status, headers, data
+        finally:
+            operation, index = _describe(method, url)
+            collector.record_es(operation, index, time.time() - start, size)
+
+
+class TimedConnection(TimingMixin, Urllib3HttpConnection):
+    pass
+
+
+def _describe(method, url):
+    """Returns the kind of operation and the index an ES API URL refers to"""
+    parts = [p for p in url.split('?', 1)[0].split('/') if p]
+
+    index = ''
+    if parts and not parts[0].startswith('_'):
+        index = parts[0]
+
+    for part in reversed(parts):
+        if part.startswith('_'):
+            return part[1:], index
+
+    if method == 'HEAD':
+        return 'exists', index
+    if len(parts) >= 2:
+        return {'GET': 'get', 'DELETE': 'delete'}.get(method, 'index'), index
+    return {'PUT': 'create_index',
+            'DELETE': 'delete_index'}.get(method, 'index_info'), index
@@ -0,0 +1,100 @@
+import datetime
+
+import iso8601
+
+from annotator import authz, document, es
+
+TYPE = 'tombstone'
+MAPPING = {
+    'id': {'type': 'string', 'index': 'no'},
+    'deleted': {'type': 'date'},
+    'uri': {'type': 'string'},
+    'user': {'type': 'string'},
+    'consumer': {'type': 'string'},
+    'permissions': {
+        'index_name': 'permission',
+        'properties': {
+            'read': {'type': 'string'},
+        }
+    },
+}
+
+# Tombstones older than this are purged by default. Clients that have not
+# synced for longer than this need to re-fetch everything.
+HORIZON = datetime.timedelta(days=30)
+
+
+class Tombstone(es.Model):
+    """
+    A lightweight record of a deleted annotation.
+
+    It keeps just enough of the annotation to tell who may learn about the
+    deletion (its owner and read permissions) and which document it was on.
+    """
+
+    __type__ = TYPE
+    __mapping__ = MAPPING
+
+    @classmethod
+    def for_annotation(cls, annotation):
+        user, consumer = authz._annotation_owner(annotation)
+        permissions = annotation.get('permissions', {})
+        return cls(id=annotation['id'],
+                   deleted=_now().isoformat(),
+                   uri=annotation.get('uri'),
+                   user=user,
+                   consumer=consumer,
+                   permissions={'read': permissions.get('read', [])})
+
+    @classmethod
+    def search_raw(cls, query=None, params=None, raw_result=False,
+                   user=None, authorization_enabled=None):
+        """Perform a raw Elasticsearch query, filtered by read permissions
+
+        Keyword arguments are as for Annotation.search_raw.
+        """
+        if query is None:
+            query = {}
+        if authorization_enabled is None:
+            authorization_enabled = es.authorization_enabled
+        if authorization_enabled:
+            authz.filter_query(query, user)
+
+        return super(Tombstone, cls).search_raw(query=query, params=params,
+                                                raw_result=raw_result)
+
+    @classmethod
+    def since(cls, since=None, seen=None, uri=None, limit=None, **kwargs):
+        """Find tombstones of annotations deleted since a checkpoint
+
+        Results are ordered by deletion time, oldest first. The arguments have
+        the same meaning as for Annotation.changes, except that seen holds
+        [id, deleted] pairs.
+        """
+        q = cls._build_query(offset=0, limit=limit)
+        clauses = q['query']['bool']
+
+        if uri is not None:
+            doc = document.Document.get_by_uri(uri)
+            uris = doc.uris() if doc else [uri]
+            clauses['must'].append({'bool': {
+                'should': [{'match': {'uri': u}} for u in uris],
+                'minimum_should_match': 1
+            }})
+
+        return cls.search_changes(q, 'deleted', since=since, seen=seen,
+                                  **kwargs)
+
+    @classmethod
+    def purge(cls, horizon=HORIZON):
+        """Delete all tombstones older than the given horizon (a timedelta)"""
+        cutoff = (_now() - horizon).isoformat()
+        cls.es.conn.delete_by_query(index=cls.es.index,
+                                    doc_type=cls.__type__,
+                                    body={'query': {'range': {
+                                        'deleted': {'lt': cutoff}}}})
+        return cutoff
+
+
+def _now():
+    return datetime.datetime.now(iso8601.iso8601.UTC)
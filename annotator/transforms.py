@@ -0,0 +1,207 @@
+"""
+Transforms of documents on their way from one index to another.
+
+A stage is a callable taking a list of hits (dicts with '_index', '_type',
+'_id' and '_source', as returned by a scroll) and returning the list to pass
+on, so that it can work on a whole chunk of documents at once. For stages
+which look at one document at a time, wrap a function taking a hit and
+returning it (or None, to leave the document out) in PerDocument.
+
+A Pipeline runs the stages over a stream of hits in chunks, optionally in a
+pool of processes for stages which are heavy on the CPU, and keeps track of
+the throughput of every stage. Stages run in a process pool have to be
+picklable, which module-level functions and PerDocument instances of them
+are.
+"""
+from __future__ import absolute_import
+
+import importlib
+import multiprocessing
+import threading
+import time
+
+from six.moves.urllib.parse import urlsplit, urlunsplit
+
+DEFAULT_CHUNK_DOCS = 500
+
+# The version of the annotation schema the documents without one have
+SCHEMA_VERSION = 'v1.0'
+
+
+class PerDocument(object):
+    """A stage which transforms every document of a chunk by itself"""
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.name = fn.__name__
+
+    def __call__(self, hits):
+        results = []
+        for hit in hits:
+            hit = self.fn(hit)
+            if hit is not None:
+                results.append(hit)
+        return results
+
+
+class Pipeline(object):
+    """
+    Runs stages over streams of hits, in chunks of chunk_docs documents. With
+    processes, chunks are transformed in a pool of that many processes, and
+    close() should be called when done.
+    """
+
+    def __init__(self, stages, chunk_docs=DEFAULT_CHUNK_DOCS, processes=0):
+        self.stages = list(stages)
+        self.chunk_docs = chunk_docs
+        self.pool = None
+        if processes:
+            self.pool = multiprocessing.Pool(processes)
+        self._lock = threading.Lock()
+        self._stats = [{'docs': 0, 'seconds': 0.0} for _ in self.stages]
+
+    def run(self, hits):
+        """Transform a stream of hits, returning a stream of the results"""
+        chunks = _chunks(hits, self.chunk_docs)
+        if self.pool is not None:
+            results = self.pool.imap(_StageRunner(self.stages), chunks)
+        else:
+            results = (_run_stages(self.stages, c) for c in chunks)
+
+        for chunk, timings in results:
+            with self._lock:
+                for stats, (docs, seconds) in zip(self._stats, timings):
+                    stats['docs'] += docs
+                    stats['seconds'] += seconds
+            for hit in chunk:
+                yield hit
+
+    def stats(self):
+        """
+        Returns the number of documents each stage has been given, the time
+        it took, and the resulting throughput.
+        """
+        with self._lock:
+            return [{'stage': _name(stage),
+                     'docs': s['docs'],
+                     'seconds': s['seconds'],
+                     'docs_per_second': (s['docs'] / s['seconds']
+                                         if s['seconds'] else None)}
+                    for stage, s in zip(self.stages, self._stats)]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+class _StageRunner(object):
+    """_run_stages with the stages bound, picklable unlike a partial in py2"""
+
+    def __init__(self, stages):
+        self.stages = stages
+
+    def __call__(self, chunk):
+        return _run_stages(self.stages, chunk)
+
+
+def _run_stages(stages, chunk):
+    timings = []
+    for stage in stages:
+        start = time.time()
+        docs = len(chunk)
+        chunk = stage(chunk)
+        timings.append((docs, time.time() - start))
+    return chunk, timings
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _name(stage):
+    return getattr(stage, 'name', None) or getattr(stage, '__name__',
+                                                   repr(stage))
+
+
+def normalize_user(hit):
+    """Store the user of an annotation as its id, rather than an object"""
+    if hit.get('_type') == 'annotation':
+        user = hit['_source'].get('user')
+        if isinstance(user, dict):
+            hit['_source']['user'] = user.get('id')
+    return hit
+
+
+def schema_version(hit):
+    """Set the schema version of annotations and documents without one"""
+    if hit.get('_type') in ('annotation', 'document'):
+        hit['_source'].setdefault('annotator_schema_version', SCHEMA_VERSION)
+    return hit
+
+
+def canonical_uri(hit):
+    """
+    Canonicalize the URI of an annotation and the links of a document: the
+    scheme and host are lowercased, and default ports and fragments dropped.
+    """
+    source = hit['_source']
+    if hit.get('_type') == 'annotation' and source.get('uri'):
+        source['uri'] = canonicalize_uri(source['uri'])
+    elif hit.get('_type') == 'document':
+        for link in source.get('link', ()):
+            if link.get('href'):
+                link['href'] = canonicalize_uri(link['href'])
+    return hit
+
+
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def canonicalize_uri(uri):
+    try:
+        parts = urlsplit(uri)
+        port = parts.port
+    except ValueError:
+        # A malformed URI, e.g. with a port that isn't a number, is kept as is
+        return uri
+    scheme = parts.scheme.lower()
+    if scheme not in _DEFAULT_PORTS or not parts.netloc:
+        # Like urn: or doi: URIs, which have no host to canonicalize
+        return uri
+    netloc = parts.netloc.rpartition('@')
+    host = netloc[2].lower()
+    if port == _DEFAULT_PORTS[scheme]:
+        host = host.rsplit(':', 1)[0]
+    netloc = netloc[0] + netloc[1] + host
+    return urlunsplit((scheme, netloc, parts.path or '/', parts.query, ''))
+
+
+STAGES = {
+    'normalize-user': PerDocument(normalize_user),
+    'schema-version': PerDocument(schema_version),
+    'canonical-uri': PerDocument(canonical_uri),
+}
+
+
+def get_stage(name):
+    """
+    Returns a built-in stage by name, or a stage given as
+    'package.module:function'.
+    """
+    if name in STAGES:
+        return STAGES[name]
+    module, _, attr = name.partition(':')
+    if not attr:
+        raise ValueError("Unknown transform {0!r}, not one of {1} or a "
+                         "'module:function'".format(
+                             name, ', '.join(sorted(STAGES))))
+    return getattr(importlib.import_module(module), attr)
@@ -0,0 +1,198 @@
+"""
+Upgrades of documents to the current schema, as they are read.
+
+Rather than reindexing whenever the shape of stored documents changes, an
+upgrade from one schema version to the next can be registered, keyed on the
+document type and the ``annotator_schema_version`` it upgrades from:
+
+    from annotator.upgrades import registry
+
+    @registry.register('annotation', None, 'v1.0')
+    def user_ids(source):
+        if isinstance(source.get('user'), dict):
+            source['user'] = source['user'].get('id')
+
+Setting the ``upgrades`` attribute of the ElasticSearch wrapper to a registry
+makes the models upgrade every document they fetch or search for, by running
+the chain of upgrades from its version. With a WriteBack, upgraded documents are
+also written back to the index in the background, in bulk, so that an index
+migrates gradually as it is used.
+"""
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+
+from elasticsearch import helpers
+from six.moves import queue
+
+log = logging.getLogger(__name__)
+
+VERSION_FIELD = 'annotator_schema_version'
+
+
+class Upgrades(object):
+    """A registry of upgrades, by document type and version"""
+
+    def __init__(self, write_back=None):
+        self._upgrades = {}
+        # A WriteBack to save upgraded documents with, if any
+        self.write_back = write_back
+
+    def register(self, doc_type, from_version, to_version):
+        """
+        Returns a decorator registering a function as the upgrade of documents
+        of a type from one version to another. The function is given the
+        document's source to change, and may also return a new source. None
+        stands for documents without a version.
+        """
+        def decorator(fn):
+            key = (doc_type, from_version)
+            if key in self._upgrades:
+                raise ValueError("An upgrade of {0} from version {1} is "
+                                 "already registered".format(doc_type,
+                                                             from_version))
+            self._upgrades[key] = (to_version, fn)
+            return fn
+        return decorator
+
+    def upgrade(self, doc_type, source):
+        """
+        Upgrade a document's source to the latest version there are upgrades
+        to. Returns the upgraded source, or None if it needed no upgrade.
+        """
+        upgraded = False
+        seen = set()
+        while True:
+            version = source.get(VERSION_FIELD)
+            upgrade = self._upgrades.get((doc_type, version))
+            if upgrade is None or version in seen:
+                break
+            seen.add(version)
+            to_version, fn = upgrade
+            source = _result(fn(source), source)
+            source[VERSION_FIELD] = to_version
+            upgraded = True
+        return source if upgraded else None
+
+    def upgrade_hit(self, hit):
+        """
+        Upgrade the source of a hit (or of the response to a get) in place,
+        and queue it to be written back, if there is a WriteBack.
+        """
+        if not self._upgrades or '_source' not in hit:
+            return
+        source = self.upgrade(hit['_type'], hit['_source'])
+        if source is None:
+            return
+        hit['_source'] = source
+        if self.write_back is not None:
+            self.write_back.add(hit)
+
+
+class WriteBack(object):
+    """
+    Writes upgraded documents back to their index in the background, in bulk
+    requests of up to batch_size documents, at least every interval seconds
+    while there are any.
+
+    Documents are written with the version they were read at, so that ones
+    changed in the meantime are not overwritten, but left to be upgraded the
+    next time they are read. When more than max_queued documents are waiting
+    to be written, further ones are not queued.
+    """
+
+    def __init__(self, es, batch_size=500, interval=1.0, max_queued=10000):
+        self.es = es
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue(max_queued)
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def add(self, hit):
+        action = {'_op_type': 'index',
+                  '_index': hit['_index'],
+                  '_type': hit['_type'],
+                  '_id': hit['_id'],
+                  '_source': dict((k, v) for k, v in hit['_source'].items()
+                                  if k != 'id')}
+        if '_version' in hit:
+            action['_version'] = hit['_version']
+        try:
+            self.queue.put_nowait(action)
+        except queue.Full:
+            return
+        self._start()
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='annotator-write-back')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def flush(self):
+        """
+        Write all queued documents now, and wait for the ones being written
+        in the background
+        """
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self._write(batch)
+        self.queue.join()
+
+    def _write(self, batch):
+        try:
+            self._bulk(batch)
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+
+    def _bulk(self, batch):
+        try:
+            written, errors = helpers.bulk(self.es.conn, batch,
+                                           raise_on_error=False)
+        except Exception:
+            log.exception("Failed to write back %d upgraded documents",
+                          len(batch))
+            return
+        # Conflicts are documents changed since they were read, which is fine
+        errors = [e for e in errors
+                  if list(e.values())[0].get('status') != 409]
+        if errors:
+            log.warn("Failed to write back %d upgraded documents: %s",
+                     len(errors), errors[:5])
+
+
+def _result(returned, source):
+    if returned is None:
+        return source
+    return returned
+
+
+# The registry of upgrades which run.py uses
+registry = Upgrades()
@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the store's hot paths and endpoints.
+
+Each benchmark is run for a number of iterations, and reported with its
+throughput, median (p50) and 99th percentile (p99) latency, and the peak
+memory allocated during a call. The endpoints are called through Flask's test
+client, against the in-memory Elasticsearch stand-in, so that no cluster is
+needed. The timings include the stand-in's own searching and indexing, which
+is no measure of Elasticsearch's, so they are only good for comparing changes
+to the store with each other.
+
+Results are compared against a baseline file, and benchmarks which got slower
+by more than a tolerance are flagged. Timings depend on the machine, and the
+baseline.json shipped here was recorded on another one, so record a baseline
+on the machine you compare on:
+
+    $ python benchmarks/bench.py --save
+    ... change things ...
+    $ python benchmarks/bench.py --check
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import timeit
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+from annotator import auth, authz, es, store
+from annotator.annotation import Annotation
+from annotator.document import Document
+from annotator.elasticsearch import _build_query
+from annotator.tombstone import Tombstone
+from tests.helpers import MockConsumer, MockUser
+
+import fixtures
+
+try:
+    import tracemalloc
+except ImportError:  # Python < 3.4
+    tracemalloc = None
+
+description = """
+Run the benchmarks, and compare their results against a baseline.
+"""
+
+DEFAULT_BASELINE = os.path.join(here, 'baseline.json')
+
+# The number of annotations, and of URIs and users they are spread over
+ANNOTATIONS = 2000
+URIS = 50
+USERS = 20
+
+benchmarks = []
+
+
+def benchmark(name):
+    """Register a function which sets up a benchmark, and returns its body"""
+    def register(setup):
+        benchmarks.append((name, setup))
+        return setup
+    return register
+
+
+class Context(object):
+    """The app and data the benchmarks run against"""
+
+    def __init__(self, seed=0):
+        self.rng = random.Random(seed)
+        self.uris = fixtures.make_uris(URIS)
+        self.users = fixtures.make_users(USERS)
+
+        es.host = 'memory://bench'
+        es.index = 'bench'
+        es.authorization_enabled = True
+        # The models share the index, which drop_all deletes
+        Annotation.drop_all()
+        for model in (Annotation, Document, Tombstone):
+            model.create_all()
+
+        for uri in self.uris:
+            Document(fixtures.make_document(self.rng, uri)).save()
+
+        self.annotations = []
+        for _ in range(ANNOTATIONS):
+            ann = Annotation(fixtures.make_annotation(self.rng, self.uris,
+                                                      self.users))
+            ann.save(refresh=False)
+            self.annotations.append(ann)
+
+        self.consumer = MockConsumer(fixtures.CONSUMER)
+        self.user = MockUser(self.users[0], fixtures.CONSUMER)
+        self.headers = fixtures.auth_headers(self.user.id)
+        self.token = self.headers['x-annotator-auth-token']
+
+        self.app = fixtures.make_app()
+        self.client = self.app.test_client()
+
+    def own_annotations(self):
+        return [a for a in self.annotations if a['user'] == self.user.id]
+
+
+@benchmark('authz.authorize')
+def bench_authorize(ctx):
+    # Mostly annotations of other users, which run through all the checks
+    anns = ctx.annotations[:100]
+    user = ctx.user
+
+    def run():
+        for ann in anns:
+            authz.authorize(ann, 'read', user)
+    return run
+
+
+@benchmark('authz.permissions_filter')
+def bench_permissions_filter(ctx):
+    user = ctx.user
+    return lambda: authz.permissions_filter(user)
+
+
+@benchmark('elasticsearch._build_query')
+def bench_build_query(ctx):
+    query = {'user': 'user1', 'tags': 'todo'}
+    return lambda: _build_query(query, 0, 20)
+
+
+@benchmark('Annotation._build_query')
+def bench_annotation_build_query(ctx):
+    # Includes looking up the equivalent URIs of the document
+    query = {'uri': ctx.uris[0], 'user': 'user1'}
+    return lambda: Annotation._build_query(query=query, offset=0, limit=20)
+
+
+@benchmark('auth.decode_token')
+def bench_decode_token(ctx):
+    token, secret = ctx.token, ctx.consumer.secret
+    return lambda: auth.decode_token(token, secret=secret)
+
+
+@benchmark('store.jsonify[200]')
+def bench_jsonify(ctx):
+    rows = ctx.annotations[:200]
+    app = ctx.app
+
+    def run():
+        with app.test_request_context():
+            store.jsonify({'total': len(rows), 'rows': rows})
+    return run
+
+
+@benchmark('GET /annotations/<id>')
+def bench_read(ctx):
+    ids = [a['id'] for a in ctx.annotations
+           if authz.GROUP_WORLD in a['permissions']['read']][:100]
+    it = _cycle(ids)
+    return lambda: _request(ctx, 'get', '/api/annotations/' + next(it))
+
+
+@benchmark('GET /search?uri')
+def bench_search_uri(ctx):
+    it = _cycle(ctx.uris)
+    return lambda: _request(ctx, 'get', '/api/search?uri=' + next(it))
+
+
+@benchmark('GET /search?limit=200')
+def bench_search_page(ctx):
+    return lambda: _request(ctx, 'get', '/api/search?limit=200')
+
+
+@benchmark('GET /facets')
+def bench_facets(ctx):
+    return lambda: _request(ctx, 'get', '/api/facets')
+
+
+@benchmark('POST /annotations')
+def bench_create(ctx):
+    rng = random.Random(1)
+
+    def run():
+        ann = fixtures.make_annotation(rng, ctx.uris, [ctx.user.id])
+        _request(ctx, 'post', '/api/annotations?refresh=false',
+                 data=json.dumps(ann), content_type='application/json')
+    return run
+
+
+@benchmark('PUT /annotations/<id>')
+def bench_update(ctx):
+    it = _cycle([a['id'] for a in ctx.own_annotations()])
+    data = json.dumps({'text': 'An updated note', 'tags': ['review']})
+
+    def run():
+        _request(ctx, 'put', '/api/annotations/{0}?refresh=false'.format(
+            next(it)), data=data, content_type='application/json')
+    return run
+
+
+def _cycle(items):
+    while True:
+        for item in items:
+            yield item
+
+
+def _request(ctx, method, url, **kwargs):
+    res = getattr(ctx.client, method)(url, headers=ctx.headers, **kwargs)
+    if res.status_code >= 400:
+        raise RuntimeError('{0} {1} failed with status {2}'.format(
+            method.upper(), url, res.status_code))
+    return res
+
+
+def measure(run, iterations, warmup=10):
+    for _ in range(warmup):
+        run()
+
+    times = []
+    timer = timeit.default_timer
+    started = timer()
+    for _ in range(iterations):
+        start = timer()
+        run()
+        times.append(timer() - start)
+    elapsed = timer() - started
+
+    times.sort()
+    return {'ops': iterations / elapsed,
+            'p50': _percentile(times, 50),
+            'p99': _percentile(times, 99),
+            'peak_kib': _peak_allocation(run)}
+
+
+def _percentile(sorted_values, p):
+    i = int(round(p / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[i]
+
+
+def _peak_allocation(run, calls=20):
+    """Returns the mean peak of memory allocated during a call, in KiB"""
+    if tracemalloc is None:
+        return None
+    peaks = []
+    for _ in range(calls):
+        # Restarting resets the peak, which older Pythons cannot do otherwise
+        tracemalloc.start()
+        try:
+            run()
+            peaks.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+    return sum(peaks) / float(len(peaks)) / 1024
+
+
+def compare(result, base, tolerance):
+    """
+    Returns a description of how a result compares to its baseline, and
+    whether it is a regression.
+    """
+    if base is None:
+        return 'new', False
+    ratio = result['p50'] / base['p50']
+    regressed = ratio > 1 + tolerance
+    return '{0:+.0f}%{1}'.format((ratio - 1) * 100,
+                                 ' REGRESSION' if regressed else ''), regressed
+
+
+def _rounded(results):
+    return dict((name, {'ops': round(r['ops'], 1),
+                        'p50': round(r['p50'], 7),
+                        'p99': round(r['p99'], 7),
+                        'peak_kib': (None if r['peak_kib'] is None
+                                     else round(r['peak_kib'], 1))})
+                for name, r in results.items())
+
+
+def main(argv):
+    argparser = argparse.ArgumentParser(description=description)
+    argparser.add_argument('filter', nargs='?', default='',
+                           help="Only run benchmarks whose name contains this")
+    argparser.add_argument('-n', '--iterations', type=int, default=200,
+                           help="Iterations per benchmark "
+                                "(default: %(default)s)")
+    argparser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                           help="Baseline file (default: %(default)s)")
+    argparser.add_argument('--tolerance', type=float, default=0.2,
+                           help="Slowdown of the median to tolerate, as a "
+                                "fraction (default: %(default)s)")
+    argparser.add_argument('--save', action='store_true',
+                           help="Save the results as the new baseline")
+    argparser.add_argument('--check', action='store_true',
+                           help="Exit with status 1 if any benchmark "
+                                "regressed")
+    args = argparser.parse_args(argv[1:])
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except IOError:
+        baseline = {}
+
+    if baseline and (baseline.get('python'), baseline.get('machine')) != (
+            platform.python_version(), platform.machine()):
+        print("Warning: the baseline was recorded with Python {0} on {1}, "
+              "so the comparison may be meaningless.".format(
+                  baseline.get('python'), baseline.get('machine')),
+              file=sys.stderr)
+
+    print("Setting up {0} annotations...".format(ANNOTATIONS),
+          file=sys.stderr)
+    ctx = Context()
+
+    print('{0:<28} {1:>9} {2:>9} {3:>9} {4:>9}  {5}'.format(
+        'benchmark', 'ops/s', 'p50 ms', 'p99 ms', 'peak KiB', 'vs baseline'))
+    results = {}
+    regressions = []
+    for name, setup in benchmarks:
+        if args.filter not in name:
+            continue
+        result = results[name] = measure(setup(ctx), args.iterations)
+        change, regressed = compare(result,
+                                    baseline.get('results', {}).get(name),
+                                    args.tolerance)
+        if regressed:
+            regressions.append(name)
+        peak = result['peak_kib']
+        print('{0:<28} {1:>9.0f} {2:>9.3f} {3:>9.3f} {4:>9} {5}'.format(
+            name, result['ops'], result['p50'] * 1000, result['p99'] * 1000,
+            '-' if peak is None else '{0:.1f}'.format(peak), change))
+
+    if args.save:
+        baseline = {'python': platform.python_version(),
+                    'machine': platform.machine(),
+                    'iterations': args.iterations,
+                    'results': dict(baseline.get('results', {}),
+                                    **_rounded(results))}
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print("Saved the results to {0}".format(args.baseline),
+              file=sys.stderr)
+
+    if regressions:
+        print("{0} benchmark(s) regressed by more than {1:.0f}%: {2}".format(
+            len(regressions), args.tolerance * 100, ', '.join(regressions)),
+            file=sys.stderr)
+        if args.check:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,102 @@
+"""
+Realistic annotations and documents, for benchmarks and load tests.
+
+Everything is generated from a random.Random instance, so a given seed always
+gives the same data.
+"""
+from flask import Flask, g
+
+from annotator import auth, authz, store
+from tests.helpers import MockConsumer
+
+WORDS = ('the of and to in is that for it as was with be by on not he this '
+         'are or his from at which but have an they you were her she there '
+         'been one all we their has would when if so no will can more other '
+         'annotation margin note reading paragraph source claim evidence '
+         'question summary citation figure table method result').split()
+
+TAGS = ('todo important question reference disagree review typo idea '
+        'follow-up definition').split()
+
+CONSUMER = 'bench'
+
+
+def make_uris(n, site='http://example.com'):
+    return ['{0}/articles/{1}'.format(site, i) for i in range(n)]
+
+
+def make_users(n):
+    return ['user{0}'.format(i) for i in range(n)]
+
+
+def make_document(rng, uri):
+    """
+    A document with several URIs for the same text, like the HTML and PDF
+    versions of an article, which searches by any one of them also match.
+    """
+    return {'title': _sentence(rng, 3, 8).title(),
+            'link': [{'href': uri, 'type': 'text/html'},
+                     {'href': uri + '.pdf', 'type': 'application/pdf'},
+                     {'href': 'doi:10.1000/' + uri.rsplit('/', 1)[-1]}]}
+
+
+def make_annotation(rng, uris, users):
+    user = rng.choice(users)
+    start = rng.randint(1, 40)
+    offset = rng.randint(0, 200)
+
+    read = rng.choice([[authz.GROUP_WORLD],
+                       [authz.GROUP_WORLD],
+                       [authz.GROUP_AUTHENTICATED],
+                       [authz.GROUP_CONSUMER],
+                       [user]])
+
+    return {'uri': rng.choice(uris),
+            'user': user,
+            'consumer': CONSUMER,
+            'text': _sentence(rng, 0, 40),
+            'quote': _sentence(rng, 1, 15),
+            'tags': rng.sample(TAGS, rng.randint(0, 3)),
+            'ranges': [{'start': '/div[1]/p[{0}]'.format(start),
+                        'end': '/div[1]/p[{0}]'.format(
+                            start + rng.randint(0, 2)),
+                        'startOffset': offset,
+                        'endOffset': offset + rng.randint(1, 300)}],
+            'permissions': {'read': read,
+                            'update': [user],
+                            'delete': [user],
+                            'admin': [user]}}
+
+
+def make_app(consumer_key=CONSUMER):
+    """
+    An app serving the store at /api, which authenticates requests with
+    tokens of the given consumer (see auth_headers) and enforces permissions.
+    """
+    consumer = MockConsumer(consumer_key)
+    app = Flask(__name__)
+    app.config['AUTHZ_ON'] = True
+
+    @app.before_request
+    def before_request():
+        g.auth = auth.Authenticator(lambda key: consumer)
+        g.authorize = authz.authorize
+
+    app.register_blueprint(store.store, url_prefix='/api')
+    return app
+
+
+def auth_headers(user_id, consumer_key=CONSUMER):
+    """The headers authenticating a request of a user of make_app's app"""
+    consumer = MockConsumer(consumer_key)
+    token = auth.encode_token({'consumerKey': consumer_key,
+                               'userId': user_id},
+                              consumer.secret)
+    if not isinstance(token, str):
+        token = token.decode('ascii')
+    return {'x-annotator-auth-token': token}
+
+
+def _sentence(rng, min_words, max_words):
+    return ' '.join(rng.choice(WORDS)
+                    for _ in range(rng.randint(min_words, max_words)))
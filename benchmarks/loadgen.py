@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+"""
+A load generator for the store.
+
+Drives the store's API through WSGI, from a number of concurrent threads or
+processes, with a mix of create, read, update, delete and search requests of
+realistic annotations, and reports the throughput and latency per route.
+
+By default the store runs against the in-memory Elasticsearch stand-in, which
+is seeded with annotations first. To load a real Elasticsearch, pass its URL
+with --host; note that the --index given is dropped and recreated.
+
+Instead of generating requests, --replay sends the requests in an NDJSON file,
+one JSON object per line like:
+
+    {"method": "GET", "path": "/search?uri=http://example.com", "user": "bob"}
+
+with an optional "body" to send as JSON. Paths are relative to the store's
+prefix. --log writes the generated requests in the same format, so that a
+run can be repeated exactly: seeded annotations get the same ids every run,
+and a logged create has the id it got as "created", so that later requests
+for that annotation are sent for the id it gets when replayed.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import timeit
+
+from six.moves.urllib.parse import urlencode
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+from annotator import es
+from annotator.annotation import Annotation
+from annotator.document import Document
+from annotator.tombstone import Tombstone
+
+import fixtures
+
+description = """
+Drive the store with concurrent traffic, and report throughput and latency
+per route.
+"""
+
+DEFAULT_MIX = 'create=10,read=40,update=10,delete=5,search=35'
+OPERATIONS = ('create', 'read', 'update', 'delete', 'search')
+
+
+def parse_mix(mix):
+    """Parses a mix like 'read=3,search=1' into a dict of weights"""
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError("Unknown operation '{0}' in the mix".format(name))
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def seed(args):
+    """
+    Fill the index with annotations and their documents. Returns the id and
+    user of each annotation.
+    """
+    # The models share the index, which drop_all deletes
+    Annotation.drop_all()
+    for model in (Annotation, Document, Tombstone):
+        model.create_all()
+
+    rng = random.Random(args.seed)
+    uris = fixtures.make_uris(args.uris)
+    users = fixtures.make_users(args.users)
+    for uri in uris:
+        Document(fixtures.make_document(rng, uri)).save(refresh=False)
+
+    annotations = []
+    for i in range(args.annotations):
+        ann = Annotation(fixtures.make_annotation(rng, uris, users))
+        ann['id'] = 'seed{0}'.format(i)
+        ann.save(refresh=False)
+        annotations.append((ann['id'], ann['user']))
+    es.conn.indices.refresh(es.index)
+    return annotations
+
+
+class Generator(object):
+    """Generates the requests of one worker"""
+
+    def __init__(self, rng, weights, uris, users, owned):
+        self.rng = rng
+        self.operations = sorted(weights)
+        self.cumulative = []
+        total = 0
+        for name in self.operations:
+            total += weights[name]
+            self.cumulative.append(total)
+        self.uris = uris
+        self.users = users
+        # The (id, user) of the annotations this worker may update and delete
+        self.owned = list(owned)
+
+    def next(self):
+        x = self.rng.random() * self.cumulative[-1]
+        for name, bound in zip(self.operations, self.cumulative):
+            if x < bound:
+                break
+        if name in ('read', 'update', 'delete') and not self.owned:
+            name = 'create'
+        return getattr(self, name)()
+
+    def create(self):
+        body = fixtures.make_annotation(self.rng, self.uris, self.users)
+        return {'method': 'POST', 'path': '/annotations', 'body': body,
+                'user': body['user']}
+
+    def read(self):
+        id, user = self.rng.choice(self.owned)
+        return {'method': 'GET', 'path': '/annotations/' + id, 'user': user}
+
+    def update(self):
+        id, user = self.rng.choice(self.owned)
+        body = {'text': fixtures._sentence(self.rng, 1, 30),
+                'tags': self.rng.sample(fixtures.TAGS, self.rng.randint(0, 3))}
+        return {'method': 'PUT', 'path': '/annotations/' + id, 'body': body,
+                'user': user}
+
+    def delete(self):
+        id, user = self.owned.pop(self.rng.randrange(len(self.owned)))
+        return {'method': 'DELETE', 'path': '/annotations/' + id,
+                'user': user}
+
+    def search(self):
+        rng = self.rng
+        params = rng.choice([
+            {'uri': rng.choice(self.uris)},
+            {'uri': rng.choice(self.uris)},
+            {'uri': rng.choice(self.uris), 'user': rng.choice(self.users)},
+            {'tags': rng.choice(fixtures.TAGS)},
+            {'user': rng.choice(self.users), 'limit': 50},
+        ])
+        return {'method': 'GET', 'path': '/search?' + urlencode(params),
+                'user': rng.choice(self.users)}
+
+    def created(self, request):
+        """Keep track of the annotations created"""
+        self.owned.append((request['created'], request['user']))
+
+
+def run_worker(app, requests, deadline=None, log=None, ids=None):
+    """
+    Send requests, an iterable of request dicts, to the app until they run out
+    or the deadline passes. Returns a (route, status, seconds) tuple for each.
+
+    ids maps the ids of annotations created in a logged run to the ids they
+    got when replayed, and is shared by the workers of a run.
+    """
+    if ids is None:
+        ids = {}
+    client = app.test_client()
+    adapter = app.url_map.bind('localhost')
+    headers = {}
+    timer = timeit.default_timer
+    results = []
+
+    for request in requests:
+        if deadline is not None and timer() > deadline:
+            break
+        user = request.get('user')
+        if user not in headers:
+            headers[user] = fixtures.auth_headers(user) if user else {}
+
+        path = '/api' + _replace_ids(request['path'], ids)
+        kwargs = {'headers': headers[user]}
+        if 'body' in request:
+            kwargs['data'] = json.dumps(request['body'])
+            kwargs['content_type'] = 'application/json'
+
+        start = timer()
+        res = client.open(path, method=request['method'], **kwargs)
+        duration = timer() - start
+
+        results.append((_route(adapter, request['method'], path),
+                        res.status_code, duration))
+
+        if request['method'] == 'POST' and res.status_code == 201:
+            created = json.loads(res.data.decode('utf-8')).get('id')
+            if 'created' in request:
+                ids[request['created']] = created
+            else:
+                request = dict(request, created=created)
+            if hasattr(requests, 'created'):
+                requests.created(request)
+        if log is not None:
+            log(request)
+    return results
+
+
+def _replace_ids(path, ids):
+    if not ids:
+        return path
+    path, sep, query = path.partition('?')
+    return '/'.join(ids.get(p, p) for p in path.split('/')) + sep + query
+
+
+class _Generated(object):
+    """The requests of a Generator, as an iterable run_worker can report to"""
+
+    def __init__(self, generator, count):
+        self.generator = generator
+        self.count = count
+        self.created = generator.created
+
+    def __iter__(self):
+        i = 0
+        while self.count is None or i < self.count:
+            yield self.generator.next()
+            i += 1
+
+
+def _route(adapter, method, path):
+    try:
+        rule, _ = adapter.match(path.split('?', 1)[0], method=method,
+                                return_rule=True)
+        return '{0} {1}'.format(method, rule.rule)
+    except Exception:
+        return '{0} (unrouted)'.format(method)
+
+
+def _worker_requests(args, index, annotations):
+    """The requests worker number index sends"""
+    if args.replay:
+        return _replayed(args.replay, index, args.concurrency)
+
+    owned = annotations[index::args.concurrency]
+    generator = Generator(random.Random(args.seed + 1 + index),
+                          parse_mix(args.mix),
+                          fixtures.make_uris(args.uris),
+                          fixtures.make_users(args.users),
+                          owned)
+    count = None
+    if args.duration is None:
+        count = args.requests // args.concurrency
+        if index < args.requests % args.concurrency:
+            count += 1
+    return _Generated(generator, count)
+
+
+def _replayed(path, index, workers):
+    """Every workers'th request in a request log, from the index'th on"""
+    with open(path) as f:
+        for i, line in enumerate(f):
+            if i % workers == index and line.strip():
+                yield json.loads(line)
+
+
+def _work(job):
+    """Runs a worker in a process of the pool"""
+    args, index, annotations, deadline = job
+    _configure(args)
+    return run_worker(fixtures.make_app(),
+                      _worker_requests(args, index, annotations), deadline)
+
+
+def _configure(args):
+    es.host = args.host
+    es.index = args.index
+    es.authorization_enabled = True
+
+
+def summarize(results, elapsed):
+    """Returns a summary of the results of every route"""
+    routes = {}
+    for route, status, duration in results:
+        routes.setdefault(route, []).append((duration, status))
+
+    summary = []
+    for route in sorted(routes):
+        durations = sorted(d for d, _ in routes[route])
+        errors = sum(1 for _, status in routes[route] if status >= 400)
+        summary.append({'route': route,
+                        'count': len(durations),
+                        'rps': len(durations) / elapsed,
+                        'p50': _percentile(durations, 50),
+                        'p90': _percentile(durations, 90),
+                        'p99': _percentile(durations, 99),
+                        'max': durations[-1],
+                        'errors': errors})
+    return summary
+
+
+def _percentile(sorted_values, p):
+    i = int(round(p / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[i]
+
+
+def report(summary, elapsed, out=sys.stdout):
+    print('{0:<34} {1:>7} {2:>8} {3:>8} {4:>8} {5:>8} {6:>8} {7:>7}'.format(
+        'route', 'count', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms',
+        'errors'), file=out)
+    for s in summary:
+        print('{0:<34} {1:>7} {2:>8.1f} {3:>8.2f} {4:>8.2f} {5:>8.2f} '
+              '{6:>8.2f} {7:>7}'.format(
+                  s['route'], s['count'], s['rps'], s['p50'] * 1000,
+                  s['p90'] * 1000, s['p99'] * 1000, s['max'] * 1000,
+                  s['errors']), file=out)
+    total = sum(s['count'] for s in summary)
+    print('{0} requests in {1:.2f}s, {2:.1f} req/s'.format(
+        total, elapsed, total / elapsed), file=out)
+
+
+def main(argv):
+    argparser = argparse.ArgumentParser(description=description)
+    argparser.add_argument('--host', default='memory://loadgen',
+                           help="Elasticsearch URL (default: %(default)s)")
+    argparser.add_argument('--index', default='annotator-loadgen',
+                           help="Index to use, which is recreated "
+                                "(default: %(default)s)")
+    argparser.add_argument('-c', '--concurrency', type=int, default=4,
+                           help="Number of workers (default: %(default)s)")
+    argparser.add_argument('--processes', action='store_true',
+                           help="Run the workers in processes rather than "
+                                "threads. With the in-memory stand-in, every "
+                                "process has its own copy of the data.")
+    argparser.add_argument('-n', '--requests', type=int, default=2000,
+                           help="Number of requests to send "
+                                "(default: %(default)s)")
+    argparser.add_argument('-d', '--duration', type=float,
+                           help="Send requests for this many seconds, "
+                                "rather than a number of requests")
+    argparser.add_argument('--mix', default=DEFAULT_MIX,
+                           help="Relative weights of the operations "
+                                "(default: %(default)s)")
+    argparser.add_argument('--annotations', type=int, default=2000,
+                           help="Number of annotations to seed "
+                                "(default: %(default)s)")
+    argparser.add_argument('--uris', type=int, default=50,
+                           help="Number of documents the annotations are on "
+                                "(default: %(default)s)")
+    argparser.add_argument('--users', type=int, default=20,
+                           help="Number of users (default: %(default)s)")
+    argparser.add_argument('--seed', type=int, default=0,
+                           help="Random seed (default: %(default)s)")
+    argparser.add_argument('--replay',
+                           help="Send the requests in this NDJSON file "
+                                "instead of generating them")
+    argparser.add_argument('--log',
+                           help="Write the requests sent to this NDJSON file")
+    argparser.add_argument('--json', action='store_true',
+                           help="Print the summary as JSON")
+    args = argparser.parse_args(argv[1:])
+
+    try:
+        parse_mix(args.mix)
+    except ValueError as e:
+        argparser.error(str(e))
+    if args.processes and args.log:
+        argparser.error("--log can't be used with --processes")
+
+    _configure(args)
+    print("Seeding {0} annotations...".format(args.annotations),
+          file=sys.stderr)
+    annotations = seed(args)
+
+    timer = timeit.default_timer
+    started = timer()
+    deadline = None if args.duration is None else started + args.duration
+
+    if args.processes:
+        pool = multiprocessing.Pool(args.concurrency)
+        try:
+            jobs = [(args, i, annotations, deadline)
+                    for i in range(args.concurrency)]
+            results = [r for rs in pool.map(_work, jobs) for r in rs]
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        log = None
+        if args.log:
+            log_file = open(args.log, 'w')
+            lock = threading.Lock()
+
+            def log(request):
+                with lock:
+                    log_file.write(json.dumps(request) + '\n')
+
+        app = fixtures.make_app()
+        ids = {}
+        results = []
+        results_lock = threading.Lock()
+
+        def work(index):
+            rs = run_worker(app, _worker_requests(args, index, annotations),
+                            deadline, log, ids)
+            with results_lock:
+                results.extend(rs)
+
+        threads = [threading.Thread(target=work, args=(i,))
+                   for i in range(args.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if args.log:
+            log_file.close()
+
+    elapsed = timer() - started
+    summary = summarize(results, elapsed)
+    if args.json:
+        json.dump({'elapsed': elapsed, 'routes': summary}, sys.stdout,
+                  indent=2, sort_keys=True)
+        print()
+    else:
+        report(summary, elapsed)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+import sys
+import argparse
+import datetime
+
+from annotator import es
+from annotator.tombstone import Tombstone, HORIZON
+
+description = """
+Purge the tombstones of deleted annotations that are older than a given
+horizon, to keep the index from growing without bound.
+
+Clients of the changes feed that have not synced for longer than the horizon
+will not learn about these deletions, and need to re-fetch all annotations.
+"""
+
+def main(argv):
+    argparser = argparse.ArgumentParser(description=description)
+    argparser.add_argument('index', help="Index to purge tombstones from")
+    argparser.add_argument('--host', help="Elasticsearch server, "
+                                          "http://host[:port]")
+    argparser.add_argument('--horizon', type=float, default=HORIZON.days,
+                           help="Age in days of the oldest tombstones to "
+                                "keep (default: %(default)s)")
+    args = argparser.parse_args()
+
+    if args.host:
+        es.host = args.host
+    es.index = args.index
+
+    cutoff = Tombstone.purge(datetime.timedelta(days=args.horizon))
+    print("Purged tombstones of annotations deleted before {0}."
+          .format(cutoff))
+
+if __name__ == '__main__':
+    main(sys.argv)
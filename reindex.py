@@ -4,36 +4,132 @@ import argparse
 
 from elasticsearch import Elasticsearch
 
-from annotator.reindexer import Reindexer
+from annotator import transforms
+from annotator.reindexer import DEFAULT_MAX_DELTA, Reindexer
 
 description = """
 Reindex an elasticsearch index.
 
-WARNING: Documents that are created while reindexing may be lost!
+WARNING: Documents that are created while reindexing may be lost, unless
+--live is given!
 """
 
+def parse_size(s):
+    """Parses a size in bytes like '512K' or '10M'"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    s = s.strip().upper().rstrip('B')
+    try:
+        if s and s[-1] in units:
+            return int(float(s[:-1]) * units[s[-1]])
+        return int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: {0}".format(s))
+
 def main(argv):
     argparser = argparse.ArgumentParser(description=description)
     argparser.add_argument('old_index', help="Index to read from")
     argparser.add_argument('new_index', help="Index to write to")
     argparser.add_argument('--host', help="Elasticsearch server, host[:port]")
     argparser.add_argument('--alias', help="Alias for the new index")
+    argparser.add_argument('--workers', type=int, default=1,
+                           help="Number of threads copying slices of the "
+                                "index in parallel (default: %(default)s)")
+    argparser.add_argument('--chunk-size', type=parse_size,
+                           help="Size of the bulk requests in bytes, "
+                                "optionally with a K, M or G suffix "
+                                "(default: 10M)")
+    argparser.add_argument('--checkpoint',
+                           help="Save the progress of the reindexing to this "
+                                "file, to be able to --resume it")
+    argparser.add_argument('--resume', action='store_true',
+                           help="Continue the reindexing saved to the "
+                                "--checkpoint file")
+    argparser.add_argument('--no-bulk-settings', action='store_false',
+                           dest='bulk_settings',
+                           help="Don't disable refreshing and replicas of "
+                                "the new index while filling it")
+    argparser.add_argument('--transform', action='append', default=[],
+                           metavar='STAGE',
+                           help="Transform the documents on the way, with "
+                                "one of {0}, or a 'module:function' taking "
+                                "and returning a list of hits. Can be given "
+                                "more than once.".format(
+                                    ', '.join(sorted(transforms.STAGES))))
+    argparser.add_argument('--transform-processes', type=int, default=0,
+                           help="Number of processes to transform documents "
+                                "in (default: transform them in the threads "
+                                "copying them)")
+    argparser.add_argument('--live', action='store_true',
+                           help="Keep copying the changes made to the old "
+                                "index while reindexing, until they are few "
+                                "enough to move the alias")
+    argparser.add_argument('--max-delta', type=int,
+                           default=DEFAULT_MAX_DELTA,
+                           help="With --live, the number of changes to catch "
+                                "up with which is small enough to move the "
+                                "alias (default: %(default)s)")
+    argparser.add_argument('--verify', action='store_true',
+                           help="Don't reindex, but compare the documents of "
+                                "the indices, with --workers threads, and "
+                                "exit with status 1 if any differ")
     args = argparser.parse_args()
 
+    if args.resume and not args.checkpoint:
+        argparser.error("--resume needs the --checkpoint file to resume from")
+
+    try:
+        stages = [transforms.get_stage(name) for name in args.transform]
+    except (ValueError, ImportError, AttributeError) as e:
+        argparser.error(str(e))
+
     host = args.host
-    old_index = args.old_index
-    new_index = args.new_index
-    alias = args.alias
 
     if host:
         conn = Elasticsearch([host])
     else:
         conn = Elasticsearch()
 
+    pipeline = None
+    if stages:
+        pipeline = transforms.Pipeline(stages,
+                                       processes=args.transform_processes)
+
+    reindexer = Reindexer(conn, interactive=True, pipeline=pipeline)
+    try:
+        reindex(reindexer, args)
+    finally:
+        if pipeline is not None:
+            pipeline.close()
+
+
+def reindex(reindexer, args):
+    old_index = args.old_index
+    new_index = args.new_index
+    alias = args.alias
+
+    if args.verify:
+        differences = reindexer.verify(old_index, new_index,
+                                       workers=args.workers)
+        if any(differences.values()):
+            sys.exit(1)
+        return
 
-    reindexer = Reindexer(conn, interactive=True)
+    if args.live:
+        reindexer.reindex_live(old_index, new_index, alias,
+                               workers=args.workers,
+                               chunk_size=args.chunk_size,
+                               checkpoint=args.checkpoint,
+                               resume=args.resume,
+                               bulk_settings=args.bulk_settings,
+                               max_delta=args.max_delta)
+        return
 
-    reindexer.reindex(old_index, new_index)
+    reindexer.reindex(old_index, new_index,
+                      workers=args.workers,
+                      chunk_size=args.chunk_size,
+                      checkpoint=args.checkpoint,
+                      resume=args.resume,
+                      bulk_settings=args.bulk_settings)
 
     if alias:
         reindexer.alias(new_index, alias)
@@ -20,7 +20,10 @@ import time
 
 from flask import Flask, g, current_app
 import elasticsearch
-from annotator import es, annotation, auth, authz, document, store
+from annotator import es, annotation, auth, authz, document, events, store, tombstone
+from annotator import metrics
+from annotator import upgrades
+from annotator.slowlog import SlowLog
 from tests.helpers import MockUser, MockConsumer, MockAuthenticator
 from tests.helpers import mock_authorizer
 
@@ -60,19 +63,62 @@ def main():
     if app.config.get('AUTHZ_ON') is not None:
         es.authorization_enabled = app.config['AUTHZ_ON']
 
+    # Log searches slower than SLOW_SEARCH_THRESHOLD seconds
+    if app.config.get('SLOW_SEARCH_THRESHOLD') is not None:
+        es.slowlog = SlowLog(
+            threshold=app.config['SLOW_SEARCH_THRESHOLD'],
+            sample_rate=app.config.get('SLOW_SEARCH_SAMPLE_RATE', 1.0),
+            max_per_minute=app.config.get('SLOW_SEARCH_MAX_PER_MINUTE', 10),
+            capture=app.config.get('SLOW_SEARCH_CAPTURE'))
+
+    # Record the requests made to Elasticsearch to ELASTICSEARCH_RECORD_PATH,
+    # or answer them from such a recording in ELASTICSEARCH_REPLAY_PATH.
+    # ELASTICSEARCH_REPLAY_LATENCY ('recorded', or a number of seconds)
+    # simulates the time Elasticsearch takes to answer.
+    es.record_path = app.config.get('ELASTICSEARCH_RECORD_PATH')
+    es.replay_path = app.config.get('ELASTICSEARCH_REPLAY_PATH')
+    es.replay_latency = app.config.get('ELASTICSEARCH_REPLAY_LATENCY')
+
+    # While reindexing live into another index, also save changes there
+    es.dual_write_index = app.config.get('ELASTICSEARCH_DUAL_WRITE_INDEX')
+
+    # Upgrade documents of older schema versions as they are read, with the
+    # upgrades in annotator.upgrades.registry, optionally writing them back
+    if app.config.get('UPGRADE_ON_READ'):
+        es.upgrades = upgrades.registry
+        if app.config.get('UPGRADE_WRITE_BACK'):
+            es.upgrades.write_back = upgrades.WriteBack(es)
+
+    # Share annotation change events between processes through Redis, if
+    # configured. Otherwise event streams only see changes made by the same
+    # process.
+    if app.config.get('EVENTS_REDIS_URL') is not None:
+        events.broker = events.RedisBroker(app.config['EVENTS_REDIS_URL'])
+
+    # Start from an empty metrics directory, rather than adding up snapshots
+    # left behind by an earlier run
+    if app.config.get('METRICS_DIR') is not None:
+        metrics.registry.clear(app.config['METRICS_DIR'])
+
+    models = annotation.Annotation, document.Document, tombstone.Tombstone
+
     with app.test_request_context():
         try:
-            annotation.Annotation.create_all()
-            document.Document.create_all()
+            for model in models:
+                model.create_all()
         except elasticsearch.exceptions.RequestError as e:
             if e.error.startswith('MergeMappingException'):
                 date = time.strftime('%Y-%m-%d')
+                differences = [d for model in models
+                               for d in model.mapping_diff()]
                 log.fatal("Elasticsearch index mapping is incorrect! Please "
                           "reindex it. You can use reindex.py for this, e.g. "
-                          "python reindex.py --host {0} {1} {1}-{2}".format(
+                          "python reindex.py --host {0} {1} {1}-{2}\n"
+                          "The mapping differs in:\n  {3}".format(
                               es.host,
                               es.index,
-                              date))
+                              date,
+                              '\n  '.join(differences)))
             raise
 
     @app.before_request
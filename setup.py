@@ -23,6 +23,7 @@ setup(
         'docs': ['Sphinx'],
         'testing': ['Flask>=0.9,<2', 'mock', 'nose', 'coverage'],
         'flask': ['Flask>=0.9,<2'],
+        'redis': ['redis>=2.10'],
     },
 
     # metadata for upload to PyPI
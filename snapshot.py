@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+import sys
+import argparse
+
+from elasticsearch import Elasticsearch
+
+from annotator.reindexer import Reindexer
+from annotator.snapshot import DEFAULT_CHUNK_DOCS, Snapshotter
+from reindex import parse_size
+
+description = """
+Export an elasticsearch index to a snapshot in a local directory, or import
+a snapshot to an index.
+
+WARNING: Documents that are created while exporting may be left out!
+"""
+
+def main(argv):
+    argparser = argparse.ArgumentParser(description=description)
+    argparser.add_argument('--host', help="Elasticsearch server, host[:port]")
+    argparser.add_argument('--workers', type=int, default=1,
+                           help="Number of threads exporting slices of the "
+                                "index, or importing files, in parallel "
+                                "(default: %(default)s)")
+    commands = argparser.add_subparsers(dest='command')
+
+    export = commands.add_parser('export', help="Export an index")
+    export.add_argument('index', help="Index to export")
+    export.add_argument('path', help="Directory to write the snapshot to")
+    export.add_argument('--chunk-docs', type=int, default=DEFAULT_CHUNK_DOCS,
+                        help="Maximum number of documents in a file "
+                             "(default: %(default)s)")
+    export.add_argument('--overwrite', action='store_true',
+                        help="Replace the snapshot in the directory, if any, "
+                             "and write to it even if it isn't empty")
+
+    import_ = commands.add_parser('import', help="Import a snapshot")
+    import_.add_argument('path', help="Directory of the snapshot")
+    import_.add_argument('index', help="Index to import to")
+    import_.add_argument('--alias', help="Alias for the index")
+    import_.add_argument('--chunk-size', type=parse_size,
+                         help="Size of the bulk requests in bytes, "
+                              "optionally with a K, M or G suffix "
+                              "(default: 10M)")
+    import_.add_argument('--no-bulk-settings', action='store_false',
+                         dest='bulk_settings',
+                         help="Don't disable refreshing and replicas of "
+                              "the index while filling it")
+    args = argparser.parse_args()
+
+    if args.command is None:
+        argparser.error("export or import?")
+
+    host = args.host
+
+    if host:
+        conn = Elasticsearch([host])
+    else:
+        conn = Elasticsearch()
+
+    snapshotter = Snapshotter(conn, interactive=True)
+
+    if args.command == 'export':
+        snapshotter.export_index(args.index, args.path,
+                                 workers=args.workers,
+                                 chunk_docs=args.chunk_docs,
+                                 overwrite=args.overwrite)
+        return
+
+    snapshotter.import_index(args.path, args.index,
+                             workers=args.workers,
+                             chunk_size=args.chunk_size,
+                             bulk_settings=args.bulk_settings)
+
+    if args.alias:
+        Reindexer(conn, interactive=True).alias(args.index, args.alias)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,7 +1,7 @@
 import os
 from flask import Flask, g, request
 
-from annotator import es, auth, authz, annotation, store, document
+from annotator import es, auth, authz, annotation, store, document, tombstone
 
 from .helpers import MockUser, MockConsumer
 
@@ -12,7 +12,8 @@ def create_app():
     app = Flask(__name__)
     app.config.from_pyfile(os.path.join(here, 'test.cfg'))
 
-    es.host = app.config['ELASTICSEARCH_HOST']
+    es.host = os.environ.get('ELASTICSEARCH_HOST',
+                             app.config['ELASTICSEARCH_HOST'])
     es.index = app.config['ELASTICSEARCH_INDEX']
     es.authorization_enabled = app.config['AUTHZ_ON']
 
@@ -32,13 +33,16 @@ class TestCase(object):
         cls.app = create_app()
         annotation.Annotation.drop_all()
         document.Document.drop_all()
+        tombstone.Tombstone.drop_all()
 
     def setup(self):
         annotation.Annotation.create_all()
         document.Document.create_all()
+        tombstone.Tombstone.create_all()
         es.conn.cluster.health(wait_for_status='yellow')
         self.cli = self.app.test_client()
 
     def teardown(self):
         annotation.Annotation.drop_all()
         document.Document.drop_all()
+        tombstone.Tombstone.drop_all()
@@ -1,13 +1,15 @@
+import iso8601
 from nose.tools import *
 from mock import MagicMock
 from . import TestCase, helpers as h
 
-from annotator import es
+from annotator import annotation, es
 from annotator.annotation import Annotation
 
 class TestAnnotation(TestCase):
     def setup(self):
         super(TestAnnotation, self).setup()
+        Annotation.timeline_cache.clear()
 
     def teardown(self):
         super(TestAnnotation, self).teardown()
@@ -352,3 +354,66 @@ class TestAnnotation(TestCase):
         res = Annotation.search(user=user,
                                 query={'custom_field':'casesensitive'})
         assert_equal(len(res), 0)
+
+    def test_timeline(self):
+        perms = {'read': ['group:__world__']}
+        Annotation(created='2014-01-01T10:00:00+00:00',
+                   permissions=perms).save()
+        Annotation(created='2014-01-01T12:00:00+00:00',
+                   permissions=perms).save()
+        Annotation(created='2014-01-03T10:00:00+00:00',
+                   permissions=perms).save()
+
+        res = Annotation.timeline()
+        assert_equal(res[:2], [
+            {'start': '2014-01-01T00:00:00+00:00', 'count': 2},
+            {'start': '2014-01-03T00:00:00+00:00', 'count': 1},
+        ])
+
+        res = Annotation.timeline(interval='week')
+        assert_equal(res[0], {'start': '2013-12-30T00:00:00+00:00', 'count': 3})
+
+        res = Annotation.timeline(interval='hour')
+        assert_equal(len(res), 3)
+
+    def test_timeline_caches_closed_buckets(self):
+        perms = {'read': ['group:__world__']}
+        Annotation(created='2014-01-01T10:00:00+00:00',
+                   permissions=perms).save()
+        res = Annotation.timeline()
+        assert_equal(res, [{'start': '2014-01-01T00:00:00+00:00', 'count': 1}])
+
+        # A closed bucket is not recounted...
+        Annotation(created='2014-01-01T11:00:00+00:00',
+                   permissions=perms).save()
+        res = Annotation.timeline()
+        assert_equal(res, [{'start': '2014-01-01T00:00:00+00:00', 'count': 1}])
+
+        # ...but a different query is not served from the cache.
+        res = Annotation.timeline(query={'foo': 'bar'})
+        assert_equal(res, [])
+
+    def test_timeline_permissions(self):
+        Annotation(created='2014-01-01T10:00:00+00:00',
+                   user='alice', consumer='testconsumer',
+                   permissions={'read': ['alice']}).save()
+
+        alice = h.MockUser('alice', 'testconsumer')
+        bob = h.MockUser('bob', 'testconsumer')
+
+        res = Annotation.timeline(user=alice, authorization_enabled=True)
+        assert_equal(len(res), 1)
+
+        res = Annotation.timeline(user=bob, authorization_enabled=True)
+        assert_equal(res, [])
+
+
+class TestBucketStart(object):
+
+    def test_bucket_start(self):
+        dt = iso8601.parse_date('2014-01-01T10:30:15.123+00:00')
+        for interval, start in (('hour', '2014-01-01T10:00:00+00:00'),
+                                ('day', '2014-01-01T00:00:00+00:00'),
+                                ('week', '2013-12-30T00:00:00+00:00')):
+            ms = annotation._bucket_start(dt, interval)
+            assert_equal(annotation._from_epoch_ms(ms).isoformat(), start)
@@ -0,0 +1,42 @@
+from mock import patch
+from nose.tools import *
+
+from annotator.cache import LRUCache
+
+
+class TestLRUCache(object):
+
+    def test_get_set(self):
+        c = LRUCache()
+        assert_equal(c.get('a'), None)
+        c.set('a', 1)
+        assert_equal(c.get('a'), 1)
+        assert_equal(c.get('b', 2), 2)
+        assert_equal((c.hits, c.misses), (1, 2))
+
+    def test_evicts_least_recently_used(self):
+        c = LRUCache(maxsize=2)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.get('a')
+        c.set('c', 3)
+        assert_equal(len(c), 2)
+        assert_equal(c.get('a'), 1)
+        assert_equal(c.get('b'), None)
+        assert_equal(c.get('c'), 3)
+
+    @patch('annotator.cache.time')
+    def test_ttl(self, time_mock):
+        c = LRUCache(ttl=10)
+        time_mock.time.return_value = 100
+        c.set('a', 1)
+        time_mock.time.return_value = 110
+        assert_equal(c.get('a'), 1)
+        time_mock.time.return_value = 111
+        assert_equal(c.get('a'), None)
+
+    def test_clear(self):
+        c = LRUCache()
+        c.set('a', 1)
+        c.clear()
+        assert_equal(c.get('a'), None)
@@ -39,6 +39,9 @@ class TestModel(object):
 
         class MyModel(self.es.Model):
             __type__ = 'footype'
+            __mapping__ = {'user': {'type': 'string',
+                                    'index': 'not_analyzed'},
+                           'text': {'type': 'string'}}
 
         self.Model = MyModel
 
@@ -82,3 +85,87 @@ class TestModel(object):
         conn = es_mock.return_value
         call_kwargs = conn.index.call_args_list[0][1]
         assert call_kwargs['op_type'] == 'index', "Operation should be: index"
+
+    @patch('annotator.elasticsearch.elasticsearch.Elasticsearch')
+    def test_msearch_raw(self, es_mock):
+        conn = es_mock.return_value
+        conn.msearch.return_value = {'responses': [{'hits': {}},
+                                                   {'error': 'foo'}]}
+        res = self.Model.msearch_raw([{'query': 1}, {'query': 2}])
+        assert_equal(res, [{'hits': {}}, {'error': 'foo'}])
+
+        call_kwargs = conn.msearch.call_args[1]
+        assert_equal(call_kwargs['body'], [{}, {'query': 1}, {}, {'query': 2}])
+        assert_equal(call_kwargs['index'], 'foobar')
+        assert_equal(call_kwargs['doc_type'], 'footype')
+
+    @patch('annotator.elasticsearch.elasticsearch.Elasticsearch')
+    def test_dual_write(self, es_mock):
+        conn = es_mock.return_value
+        conn.index.return_value = {'_id': 'abc'}
+        self.es.dual_write_index = 'foobar-new'
+        m = self.Model(bla='blub')
+        m.save()
+        m.delete()
+
+        assert_equal([c[1]['index'] for c in conn.index.call_args_list],
+                     ['foobar', 'foobar-new'])
+        assert_equal(conn.index.call_args[1]['id'], 'abc')
+        assert_equal([c[1]['index'] for c in conn.delete.call_args_list],
+                     ['foobar', 'foobar-new'])
+
+    @patch('annotator.elasticsearch.elasticsearch.Elasticsearch')
+    def test_dual_write_failure(self, es_mock):
+        conn = es_mock.return_value
+        conn.index.side_effect = [
+            {'_id': 'abc'},
+            elasticsearch.exceptions.ConnectionError('N/A', 'Down', None)]
+        self.es.dual_write_index = 'foobar-new'
+        m = self.Model(bla='blub')
+        m.save()
+        assert_equal(m['id'], 'abc')
+
+    @patch('annotator.elasticsearch.elasticsearch.Elasticsearch')
+    def test_create_all_new_index(self, es_mock):
+        conn = es_mock.return_value
+        conn.indices.exists.return_value = False
+        self.Model.create_all()
+        conn.indices.create.assert_called_once_with(
+            'foobar', body={'mappings': self.Model.get_mapping()})
+        assert_false(conn.indices.put_mapping.called)
+
+    @patch('annotator.elasticsearch.elasticsearch.Elasticsearch')
+    def test_create_all_mapping_up_to_date(self, es_mock):
+        conn = es_mock.return_value
+        conn.indices.exists.return_value = True
+        conn.indices.get_mapping.return_value = {
+            'foobar-1': {'mappings': self.Model.get_mapping()}}
+        self.Model.create_all()
+        assert_false(conn.indices.create.called)
+        assert_false(conn.indices.put_mapping.called)
+
+    @patch('annotator.elasticsearch.elasticsearch.Elasticsearch')
+    def test_create_all_mapping_changed(self, es_mock):
+        conn = es_mock.return_value
+        conn.indices.exists.return_value = True
+        mapping = self.Model.get_mapping()
+        mapping['footype']['_meta']['fingerprint'] = 'old'
+        conn.indices.get_mapping.return_value = {
+            'foobar': {'mappings': mapping}}
+        self.Model.create_all()
+        conn.indices.put_mapping.assert_called_once_with(
+            index='foobar', doc_type='footype',
+            body=self.Model.get_mapping())
+
+    @patch('annotator.elasticsearch.elasticsearch.Elasticsearch')
+    def test_mapping_diff(self, es_mock):
+        conn = es_mock.return_value
+        mapping = self.Model.get_mapping()
+        mapping['footype']['properties'] = {'user': {'type': 'string'},
+                                            'text': {'type': 'long'}}
+        conn.indices.get_mapping.return_value = {
+            'foobar': {'mappings': mapping}}
+        assert_equal(self.Model.mapping_diff(), [
+            'footype.properties.text.type is "long", should be "string"',
+            'footype.properties.user.index is missing, should be '
+            '"not_analyzed"'])
@@ -0,0 +1,117 @@
+from flask import json
+from mock import patch
+from nose.tools import *
+
+from . import create_app
+from .helpers import MockUser
+from annotator import auth, events
+
+
+class TestLocalBroker(object):
+
+    def setup(self):
+        self.broker = events.LocalBroker()
+
+    def test_publish_subscribe(self):
+        s = self.broker.subscribe(['http://example.com'])
+        self.broker.publish('http://example.com', {'foo': 'bar'})
+        assert_equal(s.get(timeout=0), {'foo': 'bar'})
+        assert_equal(s.get(timeout=0), None)
+
+    def test_other_channel(self):
+        s = self.broker.subscribe(['http://example.com'])
+        self.broker.publish('http://example.org', {'foo': 'bar'})
+        assert_equal(s.get(timeout=0), None)
+
+    def test_multiple_channels(self):
+        s = self.broker.subscribe(['http://example.com', 'http://example.org'])
+        self.broker.publish('http://example.org', {'foo': 'bar'})
+        assert_equal(s.get(timeout=0), {'foo': 'bar'})
+
+    def test_close(self):
+        s = self.broker.subscribe(['http://example.com'])
+        s.close()
+        self.broker.publish('http://example.com', {'foo': 'bar'})
+        assert_equal(s.get(timeout=0), None)
+        assert_equal(self.broker._subscriptions, {})
+
+    def test_overflow(self):
+        s = self.broker.subscribe(['http://example.com'])
+        for i in range(events.SUBSCRIPTION_MAXSIZE + 1):
+            self.broker.publish('http://example.com', {'i': i})
+        assert_true(s.overflowed)
+
+
+class TestPublish(object):
+
+    @patch('annotator.events.broker')
+    def test_publish(self, broker):
+        events.publish('create', {'id': '1', 'uri': 'http://example.com'})
+        broker.publish.assert_called_once_with(
+            'http://example.com',
+            {'action': 'create',
+             'annotation': {'id': '1', 'uri': 'http://example.com'}})
+
+    @patch('annotator.events.broker')
+    def test_publish_no_uri(self, broker):
+        events.publish('create', {'id': '1'})
+        assert_false(broker.publish.called)
+
+    @patch('annotator.events.broker')
+    def test_publish_failure(self, broker):
+        broker.publish.side_effect = IOError
+        events.publish('create', {'id': '1', 'uri': 'http://example.com'})
+
+
+class TestStream(object):
+
+    def setup(self):
+        self.app = create_app()
+        self.app.config['STREAM_HEARTBEAT'] = 0.05
+        self.app.config['STREAM_MAX_DURATION'] = 0.1
+        self.cli = self.app.test_client()
+        self.broker = events.LocalBroker()
+
+        self.user = MockUser()
+        payload = {'consumerKey': self.user.consumer.key,
+                   'userId': self.user.id}
+        token = auth.encode_token(payload, self.user.consumer.secret)
+        self.headers = {'x-annotator-auth-token': token}
+
+    def test_no_uri(self):
+        response = self.cli.get('/api/annotations/stream',
+                                headers=self.headers)
+        assert_equal(response.status_code, 400)
+
+    @patch('annotator.store.Document')
+    def test_stream(self, doc_mock):
+        doc_mock.get_by_uri.return_value = None
+
+        readable = {'id': '1', 'uri': 'http://example.com',
+                    'permissions': {'read': ['group:__world__']}}
+        unreadable = {'id': '2', 'uri': 'http://example.com',
+                      'permissions': {'read': ['bob']}}
+
+        subscribe = self.broker.subscribe
+
+        def subscribe_and_publish(channels):
+            s = subscribe(channels)
+            for ann in (unreadable, readable):
+                self.broker.publish('http://example.com',
+                                    {'action': 'create', 'annotation': ann})
+            return s
+
+        with patch('annotator.events.broker') as broker:
+            broker.subscribe.side_effect = subscribe_and_publish
+            response = self.cli.get(
+                '/api/annotations/stream?uri=http://example.com',
+                headers=self.headers)
+            data = response.data.decode('utf-8')
+
+        messages = [m for m in data.split('\n\n') if m.startswith('event:')]
+        assert_equal(response.mimetype, 'text/event-stream')
+        assert_equal(len(messages), 1)
+        event, payload = messages[0].split('\n')
+        assert_equal(event, 'event: create')
+        assert_equal(json.loads(payload[len('data: '):]), readable)
+        assert_equal(self.broker._subscriptions, {})
@@ -0,0 +1,74 @@
+import os
+import random
+import sys
+
+from nose.tools import *
+
+from . import TestCase
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks'))
+
+import fixtures
+import loadgen
+
+
+class TestLoadgen(TestCase):
+
+    def setup(self):
+        super(TestLoadgen, self).setup()
+        self.app = fixtures.make_app()
+
+    def _generator(self, mix, owned=()):
+        return loadgen.Generator(random.Random(1), loadgen.parse_mix(mix),
+                                 fixtures.make_uris(3),
+                                 fixtures.make_users(2), owned)
+
+    def _statuses(self, results):
+        return [(route, status) for route, status, _ in results]
+
+    def test_created_ids_tracked(self):
+        generator = self._generator('create')
+        logged = []
+        results = loadgen.run_worker(self.app,
+                                     loadgen._Generated(generator, 3),
+                                     log=logged.append)
+
+        assert_equal(self._statuses(results),
+                     [('POST /api/annotations', 201)] * 3)
+        ids = [r['created'] for r in logged]
+        assert_equal(len(set(ids)), 3)
+        assert_equal([id for id, _ in generator.owned], ids)
+
+        # The annotations created can be read and deleted in turn
+        generator = self._generator('read=1,delete=1', generator.owned)
+        requests = loadgen._Generated(generator, 6)
+        results = loadgen.run_worker(self.app, requests)
+        for route, status in self._statuses(results):
+            if route.startswith('POST'):
+                assert_equal(status, 201)
+            else:
+                assert_in(status, (200, 204))
+        assert_true(any(r.startswith('DELETE') for r, _, _ in results))
+
+    def test_replay_created_ids(self):
+        logged = []
+        loadgen.run_worker(self.app,
+                           loadgen._Generated(self._generator('create'), 1),
+                           log=logged.append)
+        old = logged[0]['created']
+        user = logged[0]['user']
+        logged.append({'method': 'GET', 'path': '/annotations/' + old,
+                       'user': user})
+        logged.append({'method': 'DELETE', 'path': '/annotations/' + old,
+                       'user': user})
+
+        # Replayed, the create gets a new id, which the later requests use
+        ids = {}
+        results = loadgen.run_worker(self.app, logged, ids=ids)
+        assert_equal(self._statuses(results),
+                     [('POST /api/annotations', 201),
+                      ('GET /api/annotations/<id>', 200),
+                      ('DELETE /api/annotations/<id>', 204)])
+        assert_equal(list(ids), [old])
+        assert_not_equal(ids[old], old)
@@ -0,0 +1,192 @@
+from elasticsearch import helpers
+from elasticsearch.exceptions import ConflictError, NotFoundError
+from elasticsearch.exceptions import RequestError, TransportError
+from nose.tools import *
+
+from annotator.memory import MemoryElasticsearch, connect
+
+MAPPING = {
+    'analyzer': 'keyword',
+    '_id': {'path': 'id'},
+    '_source': {'excludes': ['id']},
+    'properties': {
+        'text': {'type': 'string', 'analyzer': 'standard'},
+        'user': {'type': 'string'},
+        'created': {'type': 'date'},
+    }
+}
+
+DOCS = [
+    {'id': '1', 'text': 'Hello World', 'user': 'alice', 'tags': ['a', 'b'],
+     'created': '2014-01-01T10:00:00+00:00', 'permissions': {'read': ['x']}},
+    {'id': '2', 'text': 'hello there', 'user': 'bob', 'tags': ['b'],
+     'created': '2014-01-02T10:00:00+00:00'},
+    {'id': '3', 'text': 'Goodbye', 'user': 'Alice',
+     'created': '2014-01-09T10:00:00+00:00'},
+]
+
+
+class TestMemoryElasticsearch(object):
+
+    def setup(self):
+        self.es = MemoryElasticsearch()
+        self.es.indices.create('test', body={'mappings': {'doc': MAPPING}})
+        for doc in DOCS:
+            self.es.index('test', 'doc', doc)
+
+    def _ids(self, query, **kwargs):
+        res = self.es.search(index='test', doc_type='doc',
+                             body={'query': query}, **kwargs)
+        return sorted(h['_id'] for h in res['hits']['hits'])
+
+    def test_connect_shares_stores(self):
+        assert_true(connect('a') is connect('a'))
+        assert_false(connect('a') is connect('b'))
+
+    def test_get(self):
+        doc = self.es.get(index='test', doc_type='doc', id='1')
+        assert_equal(doc['_source']['user'], 'alice')
+        assert_false('id' in doc['_source'])
+        assert_raises(NotFoundError, self.es.get,
+                      index='test', doc_type='doc', id='9')
+
+    def test_index_generates_ids(self):
+        res = self.es.index('test', 'doc', {'text': 'new'}, op_type='create')
+        assert_equal(len(res['_id']), 22)
+        assert_true(res['created'])
+
+    def test_index_create_conflict(self):
+        assert_raises(ConflictError, self.es.index, 'test', 'doc',
+                      {'id': '1'}, op_type='create')
+
+    def test_delete(self):
+        self.es.delete(index='test', doc_type='doc', id='1')
+        assert_equal(self._ids({'match': {'text': 'hello'}}), ['2'])
+        assert_raises(NotFoundError, self.es.delete,
+                      index='test', doc_type='doc', id='1')
+
+    def test_match_analysis(self):
+        # Mapped with the standard analyzer: lowercased words
+        assert_equal(self._ids({'match': {'text': 'HELLO'}}), ['1', '2'])
+        assert_equal(self._ids({'match': {'text': {
+            'query': 'hello world', 'operator': 'and'}}}), ['1'])
+        # The keyword analyzer: exact values
+        assert_equal(self._ids({'match': {'user': 'alice'}}), ['1'])
+        assert_equal(self._ids({'term': {'permissions.read': 'x'}}), ['1'])
+
+    def test_bool(self):
+        assert_equal(self._ids({'bool': {
+            'should': [{'term': {'tags': 'a'}}, {'term': {'tags': 'b'}}],
+            'minimum_should_match': 2}}), ['1'])
+        assert_equal(self._ids({'bool': {
+            'must': [{'match_all': {}}],
+            'must_not': [{'ids': {'values': ['1']}}]}}), ['2', '3'])
+
+    def test_filters(self):
+        f = {'or': [{'term': {'user': 'bob'}},
+                    {'and': [{'term': {'tags': 'a'}},
+                             {'not': {'filter': {'term': {'user': 'bob'}}}}]}]}
+        assert_equal(self._ids({'filtered': {'filter': f}}), ['1', '2'])
+        assert_equal(self._ids({'filtered': {'filter': {
+            'missing': {'field': 'tags'}}}}), ['3'])
+
+    def test_range(self):
+        assert_equal(self._ids({'range': {'created': {
+            'gte': '2014-01-02T10:00:00+00:00'}}}), ['2', '3'])
+        assert_equal(self._ids({'range': {'created': {
+            'lt': 1388656800000}}}), ['1'])
+
+    def test_query_string(self):
+        assert_equal(self._ids({'query_string': {'query': 'hello'}}),
+                     ['1', '2'])
+        assert_equal(self._ids({'query_string': {
+            'query': 'hello AND user:bob'}}), ['2'])
+        assert_equal(self._ids({'query_string': {'query': 'text:good*'}}),
+                     ['3'])
+
+    def test_unknown_query(self):
+        assert_raises(RequestError, self._ids, {'fuzzy': {'text': 'helo'}})
+
+    def test_sort_and_page(self):
+        body = {'sort': [{'created': {'order': 'desc'}}], 'from': 1, 'size': 1}
+        res = self.es.search(index='test', doc_type='doc', body=body)
+        assert_equal(res['hits']['total'], 3)
+        assert_equal([h['_id'] for h in res['hits']['hits']], ['2'])
+        assert_equal(res['hits']['hits'][0]['sort'], [1388656800000])
+
+    def test_sort_missing_last(self):
+        for order in ('asc', 'desc'):
+            body = {'sort': [{'tags': order}]}
+            res = self.es.search(index='test', doc_type='doc', body=body)
+            assert_equal(res['hits']['hits'][-1]['_id'], '3')
+
+    def test_aggregations(self):
+        body = {'aggs': {
+            'tags': {'terms': {'field': 'tags'}},
+            'weeks': {'date_histogram': {'field': 'created',
+                                         'interval': 'week'}}}}
+        res = self.es.search(index='test', doc_type='doc', body=body,
+                             search_type='count')
+        assert_equal(res['hits']['hits'], [])
+        aggs = res['aggregations']
+        assert_equal([(b['key'], b['doc_count'])
+                      for b in aggs['tags']['buckets']],
+                     [('b', 2), ('a', 1)])
+        assert_equal([(b['key_as_string'], b['doc_count'])
+                      for b in aggs['weeks']['buckets']],
+                     [('2013-12-30T00:00:00.000Z', 2),
+                      ('2014-01-06T00:00:00.000Z', 1)])
+
+    def test_msearch(self):
+        res = self.es.msearch(index='test', doc_type='doc', body=[
+            {}, {'query': {'term': {'user': 'bob'}}},
+            {}, {'query': {'fuzzy': {'text': 'x'}}}])
+        responses = res['responses']
+        assert_equal(responses[0]['hits']['total'], 1)
+        assert_true('error' in responses[1])
+
+    def test_delete_by_query(self):
+        self.es.delete_by_query(index='test', doc_type='doc', body={
+            'query': {'range': {'created': {'lt': '2014-01-05'}}}})
+        assert_equal(self._ids({'match_all': {}}), ['3'])
+
+    def test_reindex_with_helpers(self):
+        self.es.indices.create('copy')
+        helpers.reindex(self.es, 'test', 'copy', chunk_size=2)
+        res = self.es.search(index='copy', body={'query': {'match_all': {}}})
+        assert_equal(res['hits']['total'], 3)
+
+    def test_aliases(self):
+        self.es.indices.put_alias(index='test', name='current')
+        assert_true(self.es.indices.exists_alias('current'))
+        assert_equal(self._ids({'match_all': {}}),
+                     sorted(h['_id'] for h in self.es.search(
+                         index='current',
+                         body={'query': {'match_all': {}}})['hits']['hits']))
+        assert_raises(RequestError, self.es.indices.create, 'current')
+
+    def test_create_existing_index(self):
+        with assert_raises(RequestError) as cm:
+            self.es.indices.create('test')
+        assert_true(cm.exception.error.startswith(
+            'IndexAlreadyExistsException'))
+
+    def test_closed_index(self):
+        self.es.indices.close('test')
+        assert_raises(TransportError, self._ids, {'match_all': {}})
+        self.es.indices.open('test')
+        assert_equal(len(self._ids({'match_all': {}})), 3)
+
+    def test_mapping_conflict(self):
+        with assert_raises(RequestError) as cm:
+            self.es.indices.put_mapping(
+                index='test', doc_type='doc',
+                body={'doc': {'properties': {'created': {'type': 'string'}}}})
+        assert_true(cm.exception.error.startswith('MergeMappingException'))
+
+    def test_settings(self):
+        self.es.indices.put_settings(index='test',
+                                     body={'index': {'refresh_interval': -1}})
+        settings = self.es.indices.get_settings(index='test')
+        assert_equal(settings['test']['settings']['index']['refresh_interval'],
+                     '-1')
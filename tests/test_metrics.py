@@ -0,0 +1,168 @@
+import os
+import shutil
+import tempfile
+
+from mock import patch
+from nose.tools import *
+
+from . import create_app
+from .helpers import MockUser
+from annotator import auth, metrics
+
+
+class TestRegistry(object):
+
+    def setup(self):
+        self.registry = metrics.Registry()
+        self.counter = self.registry.counter('foo_total', "Foos",
+                                             ('kind',))
+        self.histogram = self.registry.histogram('bar_seconds', "Bars",
+                                                 buckets=(0.1, 1.0))
+
+    def test_counter(self):
+        self.counter.inc(kind='a')
+        self.counter.inc(2, kind='a')
+        self.counter.inc(kind='b"c')
+        text = self.registry.render()
+        assert_true('# TYPE foo_total counter\n' in text)
+        assert_true('foo_total{kind="a"} 3.0\n' in text)
+        assert_true('foo_total{kind="b\\"c"} 1.0\n' in text)
+
+    def test_histogram(self):
+        for value in (0.05, 0.5, 0.5, 5):
+            self.histogram.observe(value)
+        text = self.registry.render()
+        assert_true('# TYPE bar_seconds histogram\n' in text)
+        assert_true('bar_seconds_bucket{le="0.1"} 1.0\n' in text)
+        assert_true('bar_seconds_bucket{le="1.0"} 3.0\n' in text)
+        assert_true('bar_seconds_bucket{le="+Inf"} 4.0\n' in text)
+        assert_true('bar_seconds_sum 6.05\n' in text)
+        assert_true('bar_seconds_count 4.0\n' in text)
+
+    def test_callback(self):
+        self.registry.callback('gauge', 'baz', "Baz", lambda: {(): 7})
+        self.registry.callback('gauge', 'broken', "Broken", lambda: 1 / 0)
+        text = self.registry.render()
+        assert_true('baz 7.0\n' in text)
+        assert_true('# TYPE broken gauge\n' in text)
+
+    def test_shared_directory(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.counter.inc(kind='a')
+            self.histogram.observe(0.5)
+
+            # Pretend another process has been counting too
+            other = metrics.Registry()
+            other.counter('foo_total', "Foos", ('kind',)).inc(4, kind='a')
+            other.histogram('bar_seconds', "Bars",
+                            buckets=(0.1, 1.0)).observe(0.05)
+            with patch('os.getpid', return_value=-1):
+                other.flush(directory)
+
+            text = self.registry.render(directory)
+            assert_true('foo_total{kind="a"} 5.0\n' in text)
+            assert_true('bar_seconds_bucket{le="0.1"} 1.0\n' in text)
+            assert_true('bar_seconds_count 2.0\n' in text)
+            assert_equal(len(self._snapshots(directory)), 2)
+
+            self.registry.clear(directory)
+            assert_equal(self._snapshots(directory), [])
+        finally:
+            shutil.rmtree(directory)
+
+    def _snapshots(self, directory):
+        return sorted(f for f in os.listdir(directory)
+                      if f.startswith('metrics-'))
+
+    def _other(self, count):
+        # Another process's registry, with the same metrics
+        other = metrics.Registry()
+        other.counter('foo_total', "Foos", ('kind',)).inc(count, kind='a')
+        other.histogram('bar_seconds', "Bars",
+                        buckets=(0.1, 1.0)).observe(0.05)
+        return other
+
+    def test_exited_process_still_counted(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.counter.inc(kind='a')
+            for pid, count in ((101, 4), (102, 2)):
+                other = self._other(count)
+                with patch('os.getpid', return_value=pid):
+                    with patch('atexit.register') as register:
+                        other.flush(directory)
+                        other.flush(directory, min_interval=0)
+                assert_equal(register.call_count, 1)
+                assert_equal(register.call_args[0][1:], (directory, pid))
+
+                with patch('annotator.metrics._alive', return_value=True):
+                    before = self.registry.render(directory)
+                    # Not by a process forked from the one that wrote it...
+                    other.exit(directory, pid)
+                    assert_true('metrics-{0}.json'.format(pid) in
+                                self._snapshots(directory))
+                    # ...but by that one, as it exits
+                    with patch('os.getpid', return_value=pid):
+                        other.exit(directory, pid)
+                    after = self.registry.render(directory)
+                # The totals don't go down
+                assert_equal(after, before)
+
+            assert_true('foo_total{kind="a"} 7.0\n' in after)
+            assert_true('bar_seconds_count 2.0\n' in after)
+            assert_equal(self._snapshots(directory),
+                         sorted(['metrics-exited.json',
+                                 'metrics-{0}.json'.format(os.getpid())]))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_dead_process_still_counted(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with patch('os.getpid', return_value=101):
+                self._other(4).flush(directory)
+            with patch('annotator.metrics._alive', return_value=True):
+                before = self.registry.render(directory)
+
+            # The process was killed, without a chance to clean up
+            with patch('annotator.metrics._alive', return_value=False):
+                after = self.registry.render(directory)
+            assert_equal(after, before)
+            assert_true('foo_total{kind="a"} 4.0\n' in after)
+            assert_false('metrics-101.json' in self._snapshots(directory))
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestStoreMetrics(object):
+
+    def setup(self):
+        self.app = create_app()
+        self.cli = self.app.test_client()
+
+        user = MockUser()
+        payload = {'consumerKey': user.consumer.key, 'userId': user.id}
+        token = auth.encode_token(payload, user.consumer.secret)
+        self.headers = {'x-annotator-auth-token': token}
+
+    def test_disabled(self):
+        response = self.cli.get('/api/metrics')
+        assert_equal(response.status_code, 404)
+
+    @patch('annotator.store._es_bulk_queue')
+    @patch('annotator.store.Annotation')
+    def test_enabled(self, ann_mock, bulk_queue):
+        self.app.config['METRICS_ENABLED'] = True
+        ann_mock.search.return_value = []
+        self.cli.get('/api/annotations', headers=self.headers)
+
+        response = self.cli.get('/api/metrics')
+        text = response.data.decode('utf-8')
+        assert_equal(response.status_code, 200)
+        assert_true('annotator_requests_total{endpoint="store.index",'
+                    'method="GET",status="200"}' in text)
+        assert_true('annotator_request_duration_seconds_count{'
+                    'endpoint="store.index"}' in text)
+        assert_true('annotator_token_decodes_total{verified="true",'
+                    'result="valid"}' in text)
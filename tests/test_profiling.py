@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import time
+
+from mock import patch
+from nose.tools import *
+
+from . import create_app
+from .helpers import MockUser
+from annotator import auth
+from annotator.profiling import SamplingProfiler
+
+
+def busy(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+class TestSamplingProfiler(object):
+
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def test_profile(self):
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start()
+        busy(0.05)
+        profiler.stop()
+
+        assert_true(sum(profiler.samples.values()) > 0)
+        lines = profiler.collapsed().splitlines()
+        assert_true(any('busy (' in l for l in lines))
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            assert_true(int(count) > 0)
+
+    def test_write(self):
+        profiler = SamplingProfiler()
+        profiler.samples = {'a (x.py:1);b (x.py:5)': 3}
+        path = profiler.write(self.dir, 'store.index', 'abc/123')
+        assert_true(path.endswith('-store.index-abc_123.folded'))
+        with open(path) as f:
+            assert_equal(f.read(), 'a (x.py:1);b (x.py:5) 3\n')
+
+
+class TestStoreProfiling(object):
+
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.app = create_app()
+        self.app.config['PROFILE_DIR'] = self.dir
+        self.app.config['PROFILE_TOKEN'] = 'sekrit'
+        self.cli = self.app.test_client()
+
+        user = MockUser()
+        payload = {'consumerKey': user.consumer.key, 'userId': user.id}
+        token = auth.encode_token(payload, user.consumer.secret)
+        self.headers = {'x-annotator-auth-token': token}
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    @patch('annotator.store.Annotation')
+    def test_not_profiled(self, ann_mock):
+        ann_mock.search.return_value = []
+        self.headers['x-annotator-profile'] = 'wrong'
+        self.cli.get('/api/annotations', headers=self.headers)
+        assert_equal(os.listdir(self.dir), [])
+
+    @patch('annotator.store.Annotation')
+    def test_profiled_by_token(self, ann_mock):
+        ann_mock.search.side_effect = lambda **kwargs: busy(0.05) or []
+        self.headers['x-annotator-profile'] = 'sekrit'
+        self.headers['x-request-id'] = 'req1'
+        self.cli.get('/api/annotations', headers=self.headers)
+
+        files = os.listdir(self.dir)
+        assert_equal(len(files), 1)
+        assert_true(files[0].endswith('-store.index-req1.folded'))
+
+    @patch('annotator.store.Annotation')
+    def test_profiled_by_sample_rate(self, ann_mock):
+        ann_mock.search.return_value = []
+        self.app.config['PROFILE_SAMPLE_RATE'] = 1
+        self.cli.get('/api/annotations', headers=self.headers)
+        assert_equal(len(os.listdir(self.dir)), 1)
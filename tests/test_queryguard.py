@@ -0,0 +1,103 @@
+from nose.tools import *
+
+from annotator.queryguard import QueryGuard, QueryRejected
+
+
+class TestQueryGuard(object):
+
+    def setup(self):
+        self.guard = QueryGuard()
+
+    def test_simple_query(self):
+        query = {'query': {'match': {'text': 'foo'}}}
+        cost = self.guard.apply(query)
+        assert_true(cost > 0)
+        assert_equal(query['timeout'], '10s')
+        assert_false('terminate_after' in query)
+
+    def test_terminate_after(self):
+        query = {'query': {'match_all': {}}}
+        QueryGuard(timeout=None, terminate_after=1000).apply(query)
+        assert_false('timeout' in query)
+        assert_equal(query['terminate_after'], 1000)
+
+    def test_leading_wildcard_query_string(self):
+        for q in ('*foo', 'bar AND ?foo', 'text:*foo', '(*foo)'):
+            query = {'query': {'query_string': {'query': q}}}
+            assert_raises(QueryRejected, self.guard.apply, query)
+
+    def test_trailing_wildcard_query_string(self):
+        query = {'query': {'query_string': {'query': 'foo* AND b?r'}}}
+        self.guard.apply(query)
+
+    def test_leading_wildcard_allowed(self):
+        guard = QueryGuard(allow_leading_wildcards=True)
+        guard.apply({'query': {'query_string': {'query': '*foo'}}})
+
+    def test_leading_wildcard_query(self):
+        for clause in ({'wildcard': {'text': '*foo'}},
+                       {'wildcard': {'text': {'value': '?foo'}}},
+                       {'regexp': {'text': '.*foo'}}):
+            query = {'query': {'bool': {'must': [clause]}}}
+            assert_raises(QueryRejected, self.guard.apply, query)
+
+        self.guard.apply({'query': {'wildcard': {'text': 'foo*'}}})
+
+    def test_scripts(self):
+        query = {'query': {'filtered': {'filter': {'script': {
+            'script': "doc['foo'].value > 1"}}}}}
+        assert_raises(QueryRejected, self.guard.apply, query)
+
+        query = {'query': {'match_all': {}},
+                 'script_fields': {'foo': {'script': '1'}}}
+        assert_raises(QueryRejected, self.guard.apply, query)
+
+        QueryGuard(allow_scripts=True).apply(query)
+
+    def test_aggregation_depth(self):
+        query = {'aggs': {'a': {'terms': {'field': 'user'},
+                                'aggs': {'b': {'terms': {'field': 'tags'}}}}}}
+        self.guard.apply(query)
+
+        query['aggs']['a']['aggs']['b']['aggs'] = {
+            'c': {'terms': {'field': 'uri'}}}
+        assert_raises(QueryRejected, self.guard.apply, query)
+
+    def test_terms_size(self):
+        guard = QueryGuard(max_terms=3)
+        guard.apply({'query': {'terms': {'user': ['a', 'b', 'c']}}})
+        assert_raises(QueryRejected, guard.apply,
+                      {'query': {'terms': {'user': ['a', 'b', 'c', 'd']}}})
+
+    def test_max_cost(self):
+        guard = QueryGuard(max_cost=15)
+        query = {'query': {'bool': {'should': [
+            {'query_string': {'query': 'foo'}},
+            {'query_string': {'query': 'bar'}}]}}}
+        try:
+            guard.apply(query)
+        except QueryRejected as e:
+            assert_true(e.cost > 15)
+        else:
+            assert False, "query should have been rejected"
+
+    def test_rejected_cost(self):
+        # The cost of the whole query, not of the part walked before the
+        # script was found
+        query = {'query': {'bool': {'should': [
+            {'script': {'script': 'true'}},
+            {'query_string': {'query': 'foo'}}]}}}
+        try:
+            self.guard.apply(query)
+        except QueryRejected as e:
+            assert_equal(e.cost, QueryGuard(allow_scripts=True).check(query))
+        else:
+            assert False, "query should have been rejected"
+
+    def test_from_config(self):
+        guard = QueryGuard.from_config({'SEARCH_RAW_TIMEOUT': '1s',
+                                        'SEARCH_RAW_MAX_TERMS': 5,
+                                        'OTHER_SETTING': True})
+        assert_equal(guard.timeout, '1s')
+        assert_equal(guard.max_terms, 5)
+        assert_equal(guard.max_agg_depth, 2)
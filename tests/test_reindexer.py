@@ -0,0 +1,351 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+
+import iso8601
+from mock import ANY, patch
+from nose.tools import *
+
+from . import TestCase
+from annotator import es, transforms
+from annotator.annotation import Annotation
+from annotator.reindexer import (BULK_LOAD_SETTINGS, DEFAULT_SETTINGS,
+                                 Checkpoint, Reindexer, bulk_load)
+from annotator.transforms import PerDocument, Pipeline
+
+
+class TestReindexer(TestCase):
+
+    def setup(self):
+        super(TestReindexer, self).setup()
+        self.new_index = es.index + '-reindexed'
+        self.dir = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.dir, 'checkpoint.json')
+        self.reindexer = Reindexer(es.conn)
+        for i in range(25):
+            Annotation(id=str(i), text='Annotation {0}'.format(i),
+                       created='2015-01-{0:02d}T12:00:00'.format(i + 1)).save()
+        # A document without a creation date
+        es.conn.index(index=es.index, doc_type='other', id='x',
+                      body={'foo': 'bar'}, refresh=True)
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+        if es.conn.indices.exists(self.new_index):
+            es.conn.indices.delete(self.new_index)
+        super(TestReindexer, self).teardown()
+
+    def _count(self, index):
+        es.conn.indices.refresh(index)
+        return es.conn.count(index=index)['count']
+
+    def test_reindex(self):
+        self.reindexer.reindex(es.index, self.new_index)
+        assert_equal(self._count(self.new_index), 26)
+
+    def test_reindex_parallel(self):
+        self.reindexer.reindex(es.index, self.new_index, workers=3,
+                               chunk_size=1024)
+        assert_equal(self._count(self.new_index), 26)
+        doc = es.conn.get(index=self.new_index, doc_type='annotation', id='7')
+        assert_equal(doc['_source']['text'], 'Annotation 7')
+
+    def test_slices(self):
+        slices = self.reindexer.get_slices(es.index, 4)
+        assert_equal(slices[-1],
+                     {'filtered': {'filter': {'missing': {'field':
+                                                          'created'}}}})
+        counts = [es.conn.count(index=es.index, body={'query': q})['count']
+                  for q in slices]
+        assert_equal(sum(counts), 26)
+        assert_equal(counts[-1], 1)
+
+    def test_catch_up(self):
+        self.reindexer.reindex(es.index, self.new_index)
+        since = datetime.datetime.now(iso8601.iso8601.UTC).isoformat()
+
+        changed = Annotation.fetch('3')
+        changed['text'] = 'Changed'
+        changed.save()
+        Annotation(id='new', text='New').save()
+        Annotation.fetch('4').delete()
+
+        count = self.reindexer.catch_up(es.index, self.new_index, since)
+        # The changed and new annotations, the tombstone, and the deletion
+        assert_equal(count, 4)
+        es.conn.indices.refresh(self.new_index)
+        get = lambda id: es.conn.get(index=self.new_index,
+                                     doc_type='annotation', id=id,
+                                     ignore=404)
+        assert_equal(get('3')['_source']['text'], 'Changed')
+        assert_true(get('new')['found'])
+        assert_false(get('4')['found'])
+
+    def test_catch_up_keeps_newer_changes(self):
+        self.reindexer.reindex(es.index, self.new_index)
+        since = datetime.datetime.now(iso8601.iso8601.UTC).isoformat()
+
+        for id in ('3', '4'):
+            changed = Annotation.fetch(id)
+            changed['text'] = 'Changed in the old index'
+            changed.save()
+
+        # Later changes, made to the new index once the alias moved
+        later = (datetime.datetime.now(iso8601.iso8601.UTC) +
+                 datetime.timedelta(minutes=1)).isoformat()
+        es.conn.index(index=self.new_index, doc_type='annotation', id='3',
+                      body={'text': 'Changed in the new index',
+                            'updated': later})
+        es.conn.delete(index=self.new_index, doc_type='annotation', id='4')
+        es.conn.index(index=self.new_index, doc_type='tombstone', id='4',
+                      body={'id': '4', 'deleted': later})
+
+        self.reindexer.catch_up(es.index, self.new_index, since)
+        es.conn.indices.refresh(self.new_index)
+        get = lambda id: es.conn.get(index=self.new_index,
+                                     doc_type='annotation', id=id,
+                                     ignore=404)
+        assert_equal(get('3')['_source']['text'], 'Changed in the new index')
+        assert_false(get('4')['found'])
+
+    def test_reindex_live(self):
+        alias = es.index + '-alias'
+        self.reindexer.reindex_live(es.index, self.new_index, alias)
+        assert_equal(list(es.conn.indices.get_alias(alias).keys()),
+                     [self.new_index])
+        assert_equal(self._count(alias), 26)
+
+    def test_reindex_live_gives_up(self):
+        self.reindexer.catch_up = lambda *args: 1000
+        assert_raises(RuntimeError, self.reindexer.reindex_live, es.index,
+                      self.new_index, max_delta=10, max_rounds=2)
+
+    def test_checkpoint(self):
+        self.reindexer.reindex(es.index, self.new_index, workers=2,
+                               checkpoint=self.checkpoint)
+        with open(self.checkpoint) as f:
+            checkpoint = json.load(f)
+        assert_equal(checkpoint['source'], es.index)
+        assert_equal(checkpoint['target'], self.new_index)
+        assert_true(all(s['done'] for s in checkpoint['slices']))
+        assert_equal(sum(s['copied'] for s in checkpoint['slices']), 26)
+
+    def test_resume(self):
+        copy_slice = self.reindexer.copy_slice
+        copied = []
+
+        def fail_once(old_index, new_index, query, *args):
+            if len(copied) == 1:
+                copied.append(None)
+                raise RuntimeError("Interrupted")
+            copied.append(query)
+            return copy_slice(old_index, new_index, query, *args)
+
+        self.reindexer.copy_slice = fail_once
+        assert_raises(RuntimeError, self.reindexer.reindex, es.index,
+                      self.new_index, checkpoint=self.checkpoint)
+        slices = Checkpoint.load(self.checkpoint).slices
+        assert_equal([s['done'] for s in slices[:2]], [True, False])
+
+        self.reindexer.reindex(es.index, self.new_index,
+                               checkpoint=self.checkpoint, resume=True)
+        assert_equal(self._count(self.new_index), 26)
+        # The slice copied before the interruption wasn't copied again
+        assert_equal(copied.count(slices[0]['query']), 1)
+
+    @patch('annotator.reindexer.CHECKPOINT_EVERY', 5)
+    def test_resume_part_way(self):
+        # A single slice of all annotations, and one without creation dates
+        slices = self.reindexer.get_slices(es.index, 1)
+        assert_equal(len(slices), 2)
+
+        update = Checkpoint.update
+
+        def interrupt(checkpoint, i, **progress):
+            update(checkpoint, i, **progress)
+            if progress.get('after') is not None:
+                raise RuntimeError("Interrupted")
+
+        with patch.object(Checkpoint, 'update', interrupt):
+            assert_raises(RuntimeError, self.reindexer.reindex, es.index,
+                          self.new_index, chunk_size=1024,
+                          checkpoint=self.checkpoint)
+        s = Checkpoint.load(self.checkpoint).slices[0]
+        assert_equal(s['copied'], 5)
+        assert_false(s['done'])
+
+        self.reindexer.reindex(es.index, self.new_index,
+                               checkpoint=self.checkpoint, resume=True)
+        assert_equal(self._count(self.new_index), 26)
+
+    def test_resume_other_indices(self):
+        self.reindexer.reindex(es.index, self.new_index,
+                               checkpoint=self.checkpoint)
+        other = es.index + '-other'
+        assert_raises(ValueError, self.reindexer.reindex, es.index, other,
+                      checkpoint=self.checkpoint, resume=True)
+        assert_false(es.conn.indices.exists(other))
+
+    def test_verify(self):
+        self.reindexer.reindex(es.index, self.new_index)
+        es.conn.delete(index=self.new_index, doc_type='annotation', id='3')
+        slices = self.reindexer.get_slices(es.index, 4)
+        mismatches = self.reindexer.verify_slices(es.index, self.new_index,
+                                                  slices)
+        assert_equal(len(mismatches), 1)
+        i, old_count, new_count = mismatches[0]
+        assert_equal(old_count - new_count, 1)
+
+    def _settings(self, index):
+        res = es.conn.indices.get_settings(index=index, flat_settings=True)
+        return res[index]['settings']
+
+    def test_bulk_load(self):
+        es.conn.indices.put_settings(index=es.index, body={
+            'index.refresh_interval': '5s', 'index.number_of_replicas': '2'})
+        with bulk_load(es.conn, es.index):
+            settings = self._settings(es.index)
+            assert_equal(settings['index.refresh_interval'], '-1')
+            assert_equal(settings['index.number_of_replicas'], '0')
+
+        settings = self._settings(es.index)
+        assert_equal(settings['index.refresh_interval'], '5s')
+        assert_equal(settings['index.number_of_replicas'], '2')
+        assert_equal(settings['index.translog.flush_threshold_size'],
+                     DEFAULT_SETTINGS['index.translog.flush_threshold_size'])
+
+    def test_bulk_load_alias(self):
+        alias = es.index + '-alias'
+        es.conn.indices.put_alias(index=es.index, name=alias)
+        es.conn.indices.put_settings(index=es.index, body={
+            'index.refresh_interval': '5s'})
+        with bulk_load(es.conn, alias):
+            assert_equal(self._settings(es.index)['index.refresh_interval'],
+                         '-1')
+        assert_equal(self._settings(es.index)['index.refresh_interval'], '5s')
+
+    def test_bulk_load_left_over_settings(self):
+        # As left by a run killed while loading
+        es.conn.indices.put_settings(index=es.index, body=BULK_LOAD_SETTINGS)
+        with bulk_load(es.conn, es.index):
+            pass
+        settings = self._settings(es.index)
+        for k, v in DEFAULT_SETTINGS.items():
+            assert_equal(settings[k], v)
+
+    def test_resume_restores_settings(self):
+        es.conn.indices.create(self.new_index)
+        es.conn.indices.put_settings(index=self.new_index, body={
+            'index.refresh_interval': '5s'})
+
+        class Killed(Exception):
+            pass
+
+        # Killed while copying, before the settings could be restored
+        def killed(*args, **kwargs):
+            raise Killed()
+        put_settings = es.conn.indices.put_settings
+        calls = []
+
+        def put_settings_once(*args, **kwargs):
+            if calls:
+                raise Killed()
+            calls.append(kwargs)
+            return put_settings(*args, **kwargs)
+
+        with patch.object(self.reindexer, 'copy_slice', killed):
+            with patch.object(es.conn.indices, 'put_settings',
+                              put_settings_once):
+                assert_raises(Killed, self.reindexer.reindex, es.index,
+                              self.new_index, checkpoint=self.checkpoint)
+        assert_equal(self._settings(self.new_index)['index.refresh_interval'],
+                     '-1')
+
+        self.reindexer.reindex(es.index, self.new_index,
+                               checkpoint=self.checkpoint, resume=True)
+        settings = self._settings(self.new_index)
+        assert_equal(settings['index.refresh_interval'], '5s')
+        assert_equal(settings['index.number_of_replicas'],
+                     DEFAULT_SETTINGS['index.number_of_replicas'])
+        assert_equal(settings['index.translog.flush_threshold_size'],
+                     DEFAULT_SETTINGS['index.translog.flush_threshold_size'])
+
+    def test_bulk_load_failure(self):
+        es.conn.indices.put_settings(index=es.index, body={
+            'index.refresh_interval': '5s'})
+        with patch.object(es.conn.indices, 'optimize') as optimize:
+            with assert_raises(ValueError):
+                with bulk_load(es.conn, es.index):
+                    raise ValueError("Failed")
+        assert_equal(self._settings(es.index)['index.refresh_interval'], '5s')
+        assert_false(optimize.called)
+
+    def test_reindex_bulk_settings(self):
+        with patch('annotator.reindexer.bulk_load') as bulk_load:
+            self.reindexer.reindex(es.index, self.new_index)
+        bulk_load.assert_called_once_with(es.conn, self.new_index, log=ANY,
+                                          original=None)
+
+    def test_pipeline(self):
+        pipeline = Pipeline([PerDocument(transforms.normalize_user)])
+        Annotation(id='alice', user={'id': 'alice'}).save()
+        Reindexer(es.conn, pipeline=pipeline).reindex(es.index,
+                                                      self.new_index)
+        doc = es.conn.get(index=self.new_index, doc_type='annotation',
+                          id='alice')
+        assert_equal(doc['_source']['user'], 'alice')
+        assert_equal(pipeline.stats()[0]['docs'], 27)
+
+    def test_pipeline_dropping_documents(self):
+        def drop_three(hit):
+            if hit['_id'] != '3':
+                return hit
+        pipeline = Pipeline([PerDocument(drop_three)])
+        # The slices differ in their counts, which is not an error
+        Reindexer(es.conn, pipeline=pipeline).reindex(
+            es.index, self.new_index, checkpoint=self.checkpoint)
+        assert_false(es.conn.exists(index=self.new_index,
+                                    doc_type='annotation', id='3'))
+        assert_true(es.conn.exists(index=self.new_index,
+                                   doc_type='annotation', id='7'))
+
+    def test_verify_documents(self):
+        self.reindexer.reindex(es.index, self.new_index)
+        es.conn.delete(index=self.new_index, doc_type='annotation', id='3')
+        es.conn.index(index=self.new_index, doc_type='annotation', id='7',
+                      body={'text': 'Changed',
+                            'created': '2015-01-08T12:00:00'})
+        # Created after all annotations of the old index
+        es.conn.index(index=self.new_index, doc_type='annotation', id='new',
+                      body={'created': '2016-01-01T00:00:00'})
+        differences = self.reindexer.verify(es.index, self.new_index,
+                                            workers=2, range_docs=4)
+        assert_equal(differences, {'missing': [('annotation', '3')],
+                                   'extra': [('annotation', 'new')],
+                                   'differing': [('annotation', '7')]})
+
+    def test_verify_documents_match(self):
+        self.reindexer.reindex(es.index, self.new_index)
+        differences = self.reindexer.verify(es.index, self.new_index)
+        assert_false(any(differences.values()))
+
+    def test_compare_slice_fetches_differing_ranges(self):
+        self.reindexer.reindex(es.index, self.new_index)
+        es.conn.delete(index=self.new_index, doc_type='annotation', id='3')
+        scanned = []
+        scan = self.reindexer._scan_by_uid
+
+        def scan_by_uid(index, query):
+            scanned.append(query)
+            return scan(index, query)
+
+        self.reindexer._scan_by_uid = scan_by_uid
+        query = {'match_all': {}}
+        missing, extra, differing = self.reindexer.compare_slice(
+            es.index, self.new_index, query, range_docs=5)
+        assert_equal(missing, set([('annotation', '3')]))
+        # Both indices were scanned whole once, and one range again
+        assert_equal(scanned[:2], [query, query])
+        assert_equal(len(scanned), 4)
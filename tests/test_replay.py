@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+import time
+
+import elasticsearch
+from nose.tools import *
+
+from annotator import timing
+from annotator.elasticsearch import ElasticSearch
+from annotator.replay import (Cassette, Recorder, RecordingMixin,
+                              ReplayConnection)
+
+
+class FakeConnection(object):
+    def __init__(self, **kwargs):
+        pass
+
+    def perform_request(self, method, url, params=None, body=None,
+                        timeout=None, ignore=()):
+        if url.endswith('/missing'):
+            raise elasticsearch.NotFoundError(404, 'Not found',
+                                              {'found': False})
+        return 200, {}, '{"url": "%s"}' % url
+
+
+class FakeRecordingConnection(RecordingMixin, FakeConnection):
+    pass
+
+
+class TestReplay(object):
+
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'es.ndjson.gz')
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def _record(self, *requests):
+        recorder = Recorder(self.path)
+        conn = FakeRecordingConnection(recorder=recorder)
+        for method, url, params, body in requests:
+            try:
+                conn.perform_request(method, url, params, body)
+            except elasticsearch.TransportError:
+                pass
+        recorder.close()
+
+    def test_round_trip(self):
+        self._record(('GET', '/annotator/annotation/1', None, None),
+                     ('POST', '/annotator/_search', {'size': 10},
+                      '{"query": {"match_all": {}}, "from": 0}'))
+        conn = ReplayConnection(cassette=Cassette.load(self.path))
+
+        res = conn.perform_request('GET', '/annotator/annotation/1')
+        assert_equal(res, (200, {}, '{"url": "/annotator/annotation/1"}'))
+
+        # Bodies are compared as JSON, and parameters as strings
+        res = conn.perform_request('POST', '/annotator/_search',
+                                   {'size': '10'},
+                                   b'{"from": 0, "query": {"match_all": {}}}')
+        assert_equal(res[2], '{"url": "/annotator/_search"}')
+
+    def test_errors_replayed(self):
+        self._record(('GET', '/annotator/annotation/missing', None, None))
+        conn = ReplayConnection(cassette=Cassette.load(self.path))
+        with assert_raises(elasticsearch.NotFoundError) as cm:
+            conn.perform_request('GET', '/annotator/annotation/missing')
+        assert_equal(cm.exception.info, {'found': False})
+
+        res = conn.perform_request('GET', '/annotator/annotation/missing',
+                                   ignore=(404,))
+        assert_equal(res[0], 404)
+
+    def test_unrecorded_request(self):
+        conn = ReplayConnection(cassette=Cassette())
+        assert_raises(elasticsearch.ConnectionError,
+                      conn.perform_request, 'GET', '/annotator/annotation/1')
+
+    def test_order_and_loose_matching(self):
+        cassette = Cassette([
+            _entry('PUT', '/a/annotation/1', '{"updated": "1"}', '"first"'),
+            _entry('PUT', '/a/annotation/1', '{"updated": "2"}', '"second"'),
+        ])
+        conn = ReplayConnection(cassette=cassette)
+        body = '{"updated": "3"}'
+        replies = [conn.perform_request('PUT', '/a/annotation/1', None,
+                                        body)[2] for _ in range(3)]
+        assert_equal(replies, ['"first"', '"second"', '"second"'])
+
+    def test_latency(self):
+        cassette = Cassette([_entry('GET', '/a', None, '{}', duration=0.05)])
+        conn = ReplayConnection(cassette=cassette, latency='recorded')
+        start = time.time()
+        conn.perform_request('GET', '/a')
+        assert_true(time.time() - start >= 0.05)
+
+    def test_timed(self):
+        cassette = Cassette([_entry('GET', '/annotator/_search', None, '{}')])
+        conn = ReplayConnection(cassette=cassette)
+        collector = timing.start()
+        try:
+            conn.perform_request('GET', '/annotator/_search')
+        finally:
+            timing.stop()
+        assert_equal(collector.es_calls[0]['operation'], 'search')
+
+    def test_wrapper(self):
+        self._record(('GET', '/annotator/annotation/1', None, None))
+        es = ElasticSearch(index='annotator', replay_path=self.path)
+        doc = es.conn.get(index='annotator', doc_type='annotation', id='1')
+        assert_equal(doc, {'url': '/annotator/annotation/1'})
+
+
+def _entry(method, url, body, data, duration=0.001):
+    return {'method': method, 'url': url, 'params': {}, 'body': body,
+            'status': 200, 'data': data, 'duration': duration}
@@ -0,0 +1,91 @@
+from mock import MagicMock, patch
+from nose.tools import *
+
+from annotator.elasticsearch import ElasticSearch
+from annotator.slowlog import RateLimiter, SlowLog
+
+
+class TestRateLimiter(object):
+
+    @patch('annotator.slowlog.time')
+    def test_allow(self, time_mock):
+        time_mock.time.return_value = 0
+        limiter = RateLimiter(2, per=60)
+        assert_true(limiter.allow())
+        assert_true(limiter.allow())
+        assert_false(limiter.allow())
+
+        time_mock.time.return_value = 30
+        assert_true(limiter.allow())
+        assert_false(limiter.allow())
+
+
+class TestSlowLog(object):
+
+    def setup(self):
+        self.model = MagicMock()
+        self.model.es.index = 'annotator'
+        self.model.__type__ = 'annotation'
+        self.query = {'query': {'match_all': {}}}
+
+    @patch('annotator.slowlog.log')
+    def test_fast(self, log):
+        slowlog = SlowLog(threshold=1.0)
+        assert_false(slowlog.observe(self.model, self.query, {}, 0.5))
+        assert_false(log.warn.called)
+
+    @patch('annotator.slowlog.log')
+    def test_slow(self, log):
+        slowlog = SlowLog(threshold=1.0)
+        assert_true(slowlog.observe(self.model, self.query, {}, 1.5))
+        args = log.warn.call_args[0]
+        assert_true('"match_all"' in args[-1])
+        assert_false(self.model.es.conn.search.called)
+
+    @patch('annotator.slowlog.log')
+    def test_sampling(self, log):
+        slowlog = SlowLog(threshold=1.0, sample_rate=0)
+        assert_false(slowlog.observe(self.model, self.query, {}, 1.5))
+
+    @patch('annotator.slowlog.log')
+    def test_rate_limit(self, log):
+        slowlog = SlowLog(threshold=1.0, max_per_minute=1)
+        assert_true(slowlog.observe(self.model, self.query, {}, 1.5))
+        assert_false(slowlog.observe(self.model, self.query, {}, 1.5))
+        assert_equal(slowlog.suppressed, 1)
+
+    @patch('annotator.slowlog.log')
+    def test_capture_explain(self, log):
+        conn = self.model.es.conn
+        conn.search.return_value = {'took': 5, 'hits': {'hits': [
+            {'_explanation': {'value': 1.0}}]}}
+        slowlog = SlowLog(threshold=1.0, capture='explain')
+        slowlog.observe(self.model, self.query, {'search_type': 'count'}, 1.5)
+
+        kwargs = conn.search.call_args[1]
+        assert_equal(kwargs['body'], {'query': {'match_all': {}},
+                                      'explain': True, 'size': 1})
+        assert_equal(kwargs['search_type'], 'count')
+        assert_false('explain' in self.query)
+        assert_true('"value": 1.0' in log.warn.call_args[0][-1])
+
+    def test_bad_capture(self):
+        assert_raises(ValueError, SlowLog, capture='foo')
+
+
+class TestModelSlowLog(object):
+
+    @patch('annotator.elasticsearch.elasticsearch.Elasticsearch')
+    def test_search_raw_observed(self, es_mock):
+        es = ElasticSearch(index='foobar', slowlog=MagicMock())
+
+        class MyModel(es.Model):
+            __type__ = 'footype'
+
+        es_mock.return_value.search.return_value = {'hits': {'hits': []}}
+        MyModel.search_raw({'query': {'match_all': {}}})
+
+        model, query, params, duration = es.slowlog.observe.call_args[0]
+        assert_equal(model, MyModel)
+        assert_equal(query, {'query': {'match_all': {}}})
+        assert_true(duration >= 0)
@@ -0,0 +1,101 @@
+import json
+import os
+import shutil
+import tempfile
+
+from nose.tools import *
+
+from . import TestCase
+from annotator import es
+from annotator.annotation import Annotation
+from annotator.snapshot import MANIFEST, Snapshotter, load_manifest
+
+
+class TestSnapshotter(TestCase):
+
+    def setup(self):
+        super(TestSnapshotter, self).setup()
+        self.new_index = es.index + '-imported'
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'snapshot')
+        self.snapshotter = Snapshotter(es.conn)
+        for i in range(25):
+            Annotation(id=str(i), text='Annotation {0}'.format(i),
+                       created='2015-01-{0:02d}T12:00:00'.format(i + 1)).save()
+        Annotation(id='deleted').save()
+        Annotation.fetch('deleted').delete()
+        es.conn.indices.refresh(es.index)
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+        if es.conn.indices.exists(self.new_index):
+            es.conn.indices.delete(self.new_index)
+        super(TestSnapshotter, self).teardown()
+
+    def _count(self, index):
+        es.conn.indices.refresh(index)
+        return es.conn.count(index=index)['count']
+
+    def test_export(self):
+        count = self.snapshotter.export_index(es.index, self.path, workers=2,
+                                              chunk_docs=10)
+        # The annotations and the tombstone of the deleted one
+        assert_equal(count, 26)
+        manifest = load_manifest(self.path)
+        assert_equal(manifest['index'], es.index)
+        assert_equal(sum(c['docs'] for c in manifest['chunks']), 26)
+        assert_true(all(c['docs'] <= 10 for c in manifest['chunks']))
+        assert_in('annotation', manifest['mappings'])
+
+    def test_export_twice(self):
+        self.snapshotter.export_index(es.index, self.path)
+        assert_raises(ValueError, self.snapshotter.export_index, es.index,
+                      self.path)
+
+    def test_export_to_non_empty_directory(self):
+        os.makedirs(self.path)
+        other = os.path.join(self.path, 'other.txt')
+        open(other, 'w').close()
+        assert_raises(ValueError, self.snapshotter.export_index, es.index,
+                      self.path)
+
+        count = self.snapshotter.export_index(es.index, self.path,
+                                              overwrite=True)
+        assert_equal(count, 26)
+        assert_true(os.path.exists(other))
+
+    def test_export_overwrite(self):
+        self.snapshotter.export_index(es.index, self.path, chunk_docs=10)
+        self.snapshotter.export_index(es.index, self.path, overwrite=True)
+        manifest = load_manifest(self.path)
+        files = [c['file'] for c in manifest['chunks']]
+        assert_equal(sorted(os.listdir(self.path)), sorted(files + [MANIFEST]))
+
+    def test_import(self):
+        self.snapshotter.export_index(es.index, self.path, chunk_docs=10)
+        count = self.snapshotter.import_index(self.path, self.new_index,
+                                              workers=2)
+        assert_equal(count, 26)
+        assert_equal(self._count(self.new_index), 26)
+        doc = es.conn.get(index=self.new_index, doc_type='annotation', id='7')
+        assert_equal(doc['_source']['text'], 'Annotation 7')
+        mappings = es.conn.indices.get_mapping(index=self.new_index)
+        assert_equal(mappings[self.new_index]['mappings'],
+                     load_manifest(self.path)['mappings'])
+
+    def test_import_unfinished(self):
+        os.makedirs(self.path)
+        assert_raises(ValueError, self.snapshotter.import_index, self.path,
+                      self.new_index)
+        assert_false(es.conn.indices.exists(self.new_index))
+
+    def test_import_missing_documents(self):
+        self.snapshotter.export_index(es.index, self.path)
+        filename = os.path.join(self.path, MANIFEST)
+        with open(filename) as f:
+            manifest = json.load(f)
+        manifest['chunks'][0]['docs'] += 1
+        with open(filename, 'w') as f:
+            json.dump(manifest, f)
+        assert_raises(RuntimeError, self.snapshotter.import_index, self.path,
+                      self.new_index)
@@ -6,7 +6,7 @@ from mock import patch
 from flask import json, g
 from six.moves import xrange
 
-from annotator import auth, es
+from annotator import auth, es, store
 from annotator.annotation import Annotation
 
 
@@ -345,10 +345,260 @@ class TestStore(TestCase):
         assert_equal(len(res['rows']), 20)
         assert_equal(res['rows'][0], first)
 
+    def test_msearch(self):
+        uri1 = u'http://xyz.com'
+        uri2 = u'urn:uuid:xxxxx'
+        anno = self._create_annotation(uri=uri1, user=u'levin')
+        anno2 = self._create_annotation(uri=uri1, user=u'anna')
+        anno3 = self._create_annotation(uri=uri2, user=u'levin')
+
+        response = self.cli.post('/api/msearch',
+                                 data=json.dumps([{'uri': uri1},
+                                                  {'user': u'levin',
+                                                   'limit': 1},
+                                                  {}]),
+                                 content_type='application/json',
+                                 headers=self.headers)
+        res = json.loads(response.data)
+
+        assert_equal(len(res), 3)
+        assert_equal(res[0]['total'], 2)
+        assert_equal(set(r['id'] for r in res[0]['rows']),
+                     set([anno['id'], anno2['id']]))
+        assert_equal(res[1]['total'], 2)
+        assert_equal(len(res[1]['rows']), 1)
+        assert_equal(res[2]['total'], 3)
+
+    def test_msearch_bad_payload(self):
+        for payload in ({'uri': 'http://xyz.com'}, ['foo'], 'foo'):
+            response = self.cli.post('/api/msearch',
+                                     data=json.dumps(payload),
+                                     content_type='application/json',
+                                     headers=self.headers)
+            assert_equal(response.status_code, 400)
+
+    def test_msearch_too_many(self):
+        payload = [{}] * (store.MSEARCH_MAX_SEARCHES + 1)
+        response = self.cli.post('/api/msearch',
+                                 data=json.dumps(payload),
+                                 content_type='application/json',
+                                 headers=self.headers)
+        assert_equal(response.status_code, 400)
+
+    def test_facets(self):
+        self._create_annotation(uri=u'http://xyz.com', tags=['a', 'b'])
+        self._create_annotation(uri=u'http://xyz.com', tags=['a'])
+        self._create_annotation(uri=u'http://abc.com', tags=['a', 'c'])
+
+        res = self._get_facets()
+        assert_equal(res['total'], 3)
+        assert_equal(sorted(res['facets'].keys()),
+                     ['consumer', 'tags', 'uri', 'user'])
+        assert_equal(res['facets']['tags'][0], {'value': 'a', 'count': 3})
+        assert_equal(res['facets']['uri'][0],
+                     {'value': 'http://xyz.com', 'count': 2})
+
+        res = self._get_facets('uri=http://xyz.com&fields=tags&size=1')
+        assert_equal(res['total'], 2)
+        assert_equal(res['facets'], {'tags': [{'value': 'a', 'count': 2}]})
+
+    def test_facets_unknown_field(self):
+        response = self.cli.get('/api/facets?fields=tags,text',
+                                headers=self.headers)
+        assert_equal(response.status_code, 400)
+
+    def test_timeline(self):
+        Annotation.timeline_cache.clear()
+        self._create_annotation(uri=u'http://xyz.com',
+                                created='2014-01-01T10:00:00+00:00')
+        self._create_annotation(uri=u'http://abc.com',
+                                created='2014-01-01T11:00:00+00:00')
+
+        res = self.cli.get('/api/timeline?uri=http://xyz.com&interval=week',
+                           headers=self.headers)
+        assert_equal(json.loads(res.data)['buckets'],
+                     [{'start': '2013-12-30T00:00:00+00:00', 'count': 1}])
+
+    def test_timeline_bad_params(self):
+        for qs in ('field=text', 'interval=month'):
+            response = self.cli.get('/api/timeline?' + qs,
+                                    headers=self.headers)
+            assert_equal(response.status_code, 400)
+
+    def test_search_raw_rejected(self):
+        response = self.cli.get('/api/search_raw?q=*foo', headers=self.headers)
+        assert_equal(response.status_code, 400)
+
+        response = self.cli.post('/api/search_raw',
+                                 data=json.dumps({'query': {'wildcard': {
+                                     'text': '*foo'}}}),
+                                 content_type='application/json',
+                                 headers=self.headers)
+        assert_equal(response.status_code, 400)
+
+    @patch('annotator.store.Annotation.search_raw')
+    def test_search_raw_post_params(self, search_raw):
+        search_raw.return_value = {'hits': {'total': 0, 'hits': []}}
+        response = self.cli.post('/api/search_raw?q=*foo&df=text&timeout=1h'
+                                 '&terminate_after=100000&search_type=count'
+                                 '&size=5',
+                                 data=json.dumps({'query': {'match_all': {}}}),
+                                 content_type='application/json',
+                                 headers=self.headers)
+        assert_equal(response.status_code, 200)
+        query, params = search_raw.call_args[0]
+        assert_equal(params, {'search_type': 'count', 'size': 5})
+        assert_equal(query['timeout'], '10s')
+
+    def test_counts(self):
+        self._create_annotation(uri=u'http://xyz.com')
+        self._create_annotation(uri=u'http://xyz.com')
+        self._create_annotation(uri=u'http://abc.com')
+
+        res = self._post_counts({'uris': [u'http://xyz.com',
+                                          u'http://abc.com',
+                                          u'http://nothing.com']})
+        assert_equal(res['counts'], {u'http://xyz.com': 2,
+                                     u'http://abc.com': 1,
+                                     u'http://nothing.com': 0})
+
+    def test_counts_equivalent_uris(self):
+        self._create_annotation(uri=u'http://xyz.com/a.html', document={
+            'link': [{'href': u'http://xyz.com/a.html', 'type': 'text/html'},
+                     {'href': u'http://xyz.com/a.pdf',
+                      'type': 'application/pdf'}]})
+        self._create_annotation(uri=u'http://xyz.com/a.pdf')
+
+        res = self._post_counts([u'http://xyz.com/a.html'])
+        assert_equal(res['counts'], {u'http://xyz.com/a.html': 2})
+
+    def test_counts_bad_payload(self):
+        for payload in ({'uris': 'http://xyz.com'}, [1, 2], 'foo'):
+            response = self.cli.post('/api/counts',
+                                     data=json.dumps(payload),
+                                     content_type='application/json',
+                                     headers=self.headers)
+            assert_equal(response.status_code, 400)
+
+    def test_counts_too_many(self):
+        payload = ['http://xyz.com/%d' % i
+                   for i in xrange(store.COUNTS_MAX_URIS + 1)]
+        response = self.cli.post('/api/counts',
+                                 data=json.dumps(payload),
+                                 content_type='application/json',
+                                 headers=self.headers)
+        assert_equal(response.status_code, 400)
+
+    def test_changes(self):
+        anno = self._create_annotation(uri=u'http://xyz.com', text=u'one')
+        anno2 = self._create_annotation(uri=u'http://abc.com', text=u'two')
+
+        res = self._get_changes()
+        assert_equal([r['id'] for r in res['rows']], [anno['id'], anno2['id']])
+
+        # Nothing has changed since the last call
+        res = self._get_changes('since=' + res['next'])
+        assert_equal(res['rows'], [])
+
+        anno['text'] = u'one, edited'
+        anno.save()
+
+        res = self._get_changes('since=' + res['next'])
+        assert_equal([r['id'] for r in res['rows']], [anno['id']])
+        assert_equal(res['rows'][0]['text'], u'one, edited')
+
+    def test_changes_deleted(self):
+        anno = self._create_annotation(uri=u'http://xyz.com')
+
+        res = self._get_changes()
+        assert_equal([r['id'] for r in res['rows']], [anno['id']])
+        assert_equal(res['deleted'], [])
+
+        self.cli.delete('/api/annotations/' + anno['id'], headers=self.headers)
+
+        res = self._get_changes('since=' + res['next'])
+        assert_equal(res['rows'], [])
+        assert_equal([t['id'] for t in res['deleted']], [anno['id']])
+        assert_equal(res['deleted'][0]['uri'], u'http://xyz.com')
+
+    def test_changes_limit(self):
+        for i in xrange(5):
+            self._create_annotation(refresh=False)
+
+        es.conn.indices.refresh(es.index)
+
+        seen = set()
+        res = self._get_changes('limit=2')
+        while res['rows']:
+            assert_true(len(res['rows']) <= 2)
+            for row in res['rows']:
+                assert_true(row['id'] not in seen)
+                seen.add(row['id'])
+            res = self._get_changes('limit=2&since=' + res['next'])
+
+        assert_equal(len(seen), 5)
+
+    def test_changes_same_millisecond(self):
+        # More annotations changed in the same millisecond than fit a page
+        for i in xrange(5):
+            self._index_annotation(str(i), '2014-01-01T00:00:00.100{0}00+00:00'
+                                   .format(i))
+
+        seen = []
+        res = self._get_changes('limit=2')
+        while res['rows']:
+            seen.extend(r['id'] for r in res['rows'])
+            res = self._get_changes('limit=2&since=' + res['next'])
+        assert_equal(sorted(seen), ['0', '1', '2', '3', '4'])
+
+        # An annotation delivered at the checkpoint's time, which changed
+        # again within the same millisecond
+        self._index_annotation('2', '2014-01-01T00:00:00.100900+00:00')
+        res = self._get_changes('limit=2&since=' + res['next'])
+        assert_equal([r['id'] for r in res['rows']], ['2'])
+        res = self._get_changes('limit=2&since=' + res['next'])
+        assert_equal(res['rows'], [])
+
+    def test_changes_uri(self):
+        anno = self._create_annotation(uri=u'http://xyz.com')
+        self._create_annotation(uri=u'http://abc.com')
+
+        res = self._get_changes('uri=http://xyz.com')
+        assert_equal([r['id'] for r in res['rows']], [anno['id']])
+
+    def test_changes_bad_since(self):
+        response = self.cli.get('/api/annotations/changes?since=foobar',
+                                headers=self.headers)
+        assert_equal(response.status_code, 400)
+
     def _get_search_results(self, qs=''):
         res = self.cli.get('/api/search?{qs}'.format(qs=qs), headers=self.headers)
         return json.loads(res.data)
 
+    def _get_changes(self, qs=''):
+        res = self.cli.get('/api/annotations/changes?{qs}'.format(qs=qs),
+                           headers=self.headers)
+        return json.loads(res.data)
+
+    def _index_annotation(self, id, updated):
+        # Bypasses Annotation.save, which would set 'updated' to now
+        es.conn.index(index=es.index, doc_type='annotation', id=id,
+                      body={'updated': updated,
+                            'permissions': {'read': ['group:__world__']}},
+                      refresh=True)
+
+    def _get_facets(self, qs=''):
+        res = self.cli.get('/api/facets?{qs}'.format(qs=qs),
+                           headers=self.headers)
+        return json.loads(res.data)
+
+    def _post_counts(self, payload):
+        res = self.cli.post('/api/counts',
+                            data=json.dumps(payload),
+                            content_type='application/json',
+                            headers=self.headers)
+        return json.loads(res.data)
+
 
 class TestStoreAuthz(TestCase):
 
@@ -512,6 +762,113 @@ class TestStoreAuthz(TestCase):
         res = self.cli.get('/api/search?{qs}'.format(qs=qs), **kwargs)
         return json.loads(res.data)
 
+    def test_changes_authorized(self):
+        res = self._get_changes()
+        assert res['rows'] == []
+
+        res = self._get_changes(headers=self.bob_headers)
+        assert [r['id'] for r in res['rows']] == [self.anno_id]
+
+        res = self._get_changes(headers=self.charlie_headers)
+        assert res['rows'] == []
+
+    def test_msearch_authorized(self):
+        payload = json.dumps([{}, {'text': 'Foobar'}])
+
+        res = json.loads(self.cli.post('/api/msearch', data=payload,
+                                       content_type='application/json',
+                                       headers=self.bob_headers).data)
+        assert [r['total'] for r in res] == [1, 1]
+
+        res = json.loads(self.cli.post('/api/msearch', data=payload,
+                                       content_type='application/json',
+                                       headers=self.charlie_headers).data)
+        assert [r['total'] for r in res] == [0, 0]
+
+    def test_facets_authorized(self):
+        res = json.loads(self.cli.get('/api/facets',
+                                      headers=self.bob_headers).data)
+        assert res['total'] == 1
+        assert res['facets']['user'] == [{'value': 'alice', 'count': 1}]
+
+        res = json.loads(self.cli.get('/api/facets',
+                                      headers=self.charlie_headers).data)
+        assert res['total'] == 0
+        assert res['facets']['user'] == []
+
+    def test_counts_authorized(self):
+        payload = json.dumps({'uris': [u'http://example.com']})
+        Annotation(uri=u'http://example.com', user='bob',
+                   consumer=self.user.consumer.key,
+                   permissions={'read': ['bob']}).save()
+
+        res = self.cli.post('/api/counts', data=payload,
+                            content_type='application/json',
+                            headers=self.bob_headers)
+        assert json.loads(res.data)['counts'] == {u'http://example.com': 1}
+
+        res = self.cli.post('/api/counts', data=payload,
+                            content_type='application/json',
+                            headers=self.charlie_headers)
+        assert json.loads(res.data)['counts'] == {u'http://example.com': 0}
+
     def _get_search_raw_results(self, qs='', **kwargs):
         res = self.cli.get('/api/search_raw?{qs}'.format(qs=qs), **kwargs)
         return json.loads(res.data)
+
+    def _get_changes(self, qs='', **kwargs):
+        res = self.cli.get('/api/annotations/changes?{qs}'.format(qs=qs),
+                           **kwargs)
+        return json.loads(res.data)
+
+
+class TestChangesCheckpoint(object):
+
+    def test_decode_timestamp(self):
+        since, seen = store._decode_since('2014-01-01T00:00:00.123456+00:00')
+        assert_equal(since, '2014-01-01T00:00:00.123000+00:00')
+        assert_equal(seen, [])
+
+    def test_decode_empty(self):
+        assert_equal(store._decode_since(None), (None, []))
+        assert_equal(store._decode_since(''), (None, []))
+
+    def test_token_roundtrip(self):
+        seen = [['row', 'a', '2014-01-01T00:00:00.000100+00:00'],
+                ['row', 'b', '2014-01-01T00:00:00.000200+00:00']]
+        token = store._encode_since('2014-01-01T00:00:00+00:00', seen)
+        since, decoded = store._decode_since(token)
+        assert_equal(since, '2014-01-01T00:00:00+00:00')
+        assert_equal(decoded, seen)
+
+    def test_decode_junk(self):
+        assert_raises(ValueError, store._decode_since, 'foobar')
+        assert_raises(ValueError, store._decode_since, u'\u2603')
+
+    def test_checkpoint_ties(self):
+        changes = [('2014-01-01T00:00:00.100000+00:00', 'a', 'row',
+                    '2014-01-01T00:00:00.100100+00:00'),
+                   ('2014-01-01T00:00:00.200000+00:00', 'b', 'row',
+                    '2014-01-01T00:00:00.200100+00:00'),
+                   ('2014-01-01T00:00:00.200000+00:00', 'c', 'deleted',
+                    '2014-01-01T00:00:00.200200+00:00')]
+        since, seen = store._checkpoint(changes, None, [])
+        assert_equal(since, '2014-01-01T00:00:00.200000+00:00')
+        assert_equal(seen, [['row', 'b', '2014-01-01T00:00:00.200100+00:00'],
+                            ['deleted', 'c',
+                             '2014-01-01T00:00:00.200200+00:00']])
+
+    def test_checkpoint_keeps_seen_on_same_time(self):
+        a = ['row', 'a', '2014-01-01T00:00:00.200100+00:00']
+        b = ['row', 'b', '2014-01-01T00:00:00.200200+00:00']
+        changes = [('2014-01-01T00:00:00.200000+00:00', 'c', 'row',
+                    '2014-01-01T00:00:00.200300+00:00'),
+                   ('2014-01-01T00:00:00.200000+00:00', 'b', 'row',
+                    '2014-01-01T00:00:00.200400+00:00')]
+        since, seen = store._checkpoint(changes,
+                                        '2014-01-01T00:00:00.200000+00:00',
+                                        [a, b])
+        # b changed again, which replaces its earlier change
+        assert_equal(seen, [a, ['row', 'c',
+                                '2014-01-01T00:00:00.200300+00:00'],
+                            ['row', 'b', '2014-01-01T00:00:00.200400+00:00']])
@@ -0,0 +1,110 @@
+from mock import patch
+from nose.tools import *
+
+from . import create_app
+from .helpers import MockUser
+from annotator import auth, timing
+from annotator.timing import TimingMixin, _describe
+
+
+class FakeConnection(object):
+    def perform_request(self, method, url, params=None, body=None,
+                        timeout=None, ignore=()):
+        return 200, {}, '{"took": 1}'
+
+
+class FakeTimedConnection(TimingMixin, FakeConnection):
+    pass
+
+
+class TestTiming(object):
+
+    def teardown(self):
+        timing.stop()
+
+    def test_not_collecting(self):
+        assert_equal(timing.current(), None)
+        conn = FakeTimedConnection()
+        res = conn.perform_request('GET', '/annotator/annotation/_search')
+        assert_equal(res, (200, {}, '{"took": 1}'))
+        with timing.phase('json'):
+            pass
+
+    def test_collect(self):
+        collector = timing.start()
+        conn = FakeTimedConnection()
+        conn.perform_request('GET', '/annotator/annotation/_search')
+        with timing.phase('json'):
+            pass
+        with timing.phase('json'):
+            pass
+        assert_equal(timing.stop(), collector)
+        assert_equal(timing.current(), None)
+
+        assert_equal(len(collector.es_calls), 1)
+        call = collector.es_calls[0]
+        assert_equal(call['operation'], 'search')
+        assert_equal(call['index'], 'annotator')
+        assert_equal(call['size'], len('{"took": 1}'))
+        assert_equal(list(collector.phases.keys()), ['json'])
+
+    def test_server_timing(self):
+        collector = timing.Collector()
+        collector.record_es('search', 'annotator', 0.0123, 100)
+        collector.add('auth', 0.001)
+        header = collector.server_timing()
+        assert_true(header.startswith('es;dur=12.3;desc="1 call", '
+                                      'auth;dur=1.0, total;dur='))
+
+    def test_describe(self):
+        for method, url, expected in (
+                ('GET', '/annotator/annotation/_search', 'search'),
+                ('GET', '/_msearch', 'msearch'),
+                ('GET', '/annotator/annotation/123', 'get'),
+                ('PUT', '/annotator/annotation/123', 'index'),
+                ('POST', '/annotator/annotation?op_type=create', 'index'),
+                ('DELETE', '/annotator/annotation/123', 'delete'),
+                ('HEAD', '/annotator', 'exists'),
+                ('PUT', '/annotator', 'create_index'),
+                ('PUT', '/annotator/_mapping/annotation', 'mapping')):
+            assert_equal(_describe(method, url)[0], expected)
+        assert_equal(_describe('GET', '/_msearch')[1], '')
+
+
+class TestStoreTiming(object):
+
+    def setup(self):
+        self.app = create_app()
+        self.cli = self.app.test_client()
+
+        user = MockUser()
+        payload = {'consumerKey': user.consumer.key, 'userId': user.id}
+        token = auth.encode_token(payload, user.consumer.secret)
+        self.headers = {'x-annotator-auth-token': token}
+
+    @patch('annotator.store.Annotation')
+    def test_disabled(self, ann_mock):
+        ann_mock.search.return_value = []
+        response = self.cli.get('/api/annotations', headers=self.headers)
+        assert_false('Server-Timing' in response.headers)
+
+    @patch('annotator.store.Annotation')
+    def test_enabled(self, ann_mock):
+        self.app.config['REQUEST_TIMING'] = True
+        ann_mock.search.return_value = []
+        response = self.cli.get('/api/annotations', headers=self.headers)
+        header = response.headers['Server-Timing']
+        assert_true(header.startswith('es;dur='))
+        assert_true('auth;dur=' in header)
+        assert_true('json;dur=' in header)
+        assert_equal(timing.current(), None)
+
+    @patch('annotator.store.Annotation')
+    def test_stopped_on_error(self, ann_mock):
+        self.app.config['REQUEST_TIMING'] = True
+        # Tear the request down right away, as outside of tests
+        self.app.config['PRESERVE_CONTEXT_ON_EXCEPTION'] = False
+        ann_mock.search.side_effect = RuntimeError
+        assert_raises(RuntimeError, self.cli.get, '/api/annotations',
+                      headers=self.headers)
+        assert_equal(timing.current(), None)
@@ -0,0 +1,88 @@
+import datetime
+
+from flask import g
+from nose.tools import *
+
+from . import TestCase
+from .helpers import MockUser
+from annotator import es
+from annotator.annotation import Annotation
+from annotator.tombstone import Tombstone
+
+
+class TestTombstone(TestCase):
+
+    def setup(self):
+        super(TestTombstone, self).setup()
+        self.ctx = self.app.test_request_context(path='/api')
+        self.ctx.push()
+        g.user = None
+
+    def teardown(self):
+        self.ctx.pop()
+        super(TestTombstone, self).teardown()
+
+    def test_for_annotation(self):
+        ann = Annotation(id='1', uri='http://example.com', text='Foo',
+                         user={'id': 'alice'}, consumer='annotateit',
+                         permissions={'read': ['bob'], 'delete': ['alice']})
+        t = Tombstone.for_annotation(ann)
+        assert_equal(t['id'], '1')
+        assert_equal(t['uri'], 'http://example.com')
+        assert_equal(t['user'], 'alice')
+        assert_equal(t['consumer'], 'annotateit')
+        assert_equal(t['permissions'], {'read': ['bob']})
+        assert_true('deleted' in t)
+        assert_false('text' in t)
+
+    def test_delete_leaves_tombstone(self):
+        ann = Annotation(id='1', uri='http://example.com')
+        ann.save()
+        assert_equal(Tombstone.fetch('1'), None)
+
+        ann.delete()
+        t = Tombstone.fetch('1')
+        assert_equal(t['uri'], 'http://example.com')
+
+    def test_since(self):
+        perms = {'read': ['group:__world__']}
+        Annotation(id='1', uri='http://example.com', permissions=perms).save()
+        Annotation(id='2', uri='http://example.org', permissions=perms).save()
+        Annotation.fetch('1').delete()
+        Annotation.fetch('2').delete()
+
+        res = Tombstone.since()
+        assert_equal([t['id'] for t in res], ['1', '2'])
+
+        res = Tombstone.since(since=res[1]['deleted'])
+        assert_equal([t['id'] for t in res], ['2'])
+
+        seen = [['2', res[0]['deleted']]]
+        res = Tombstone.since(since=res[0]['deleted'], seen=seen)
+        assert_equal(res, [])
+
+        res = Tombstone.since(uri='http://example.org')
+        assert_equal([t['id'] for t in res], ['2'])
+
+    def test_since_permissions(self):
+        Annotation(id='1', user='alice', consumer='mockconsumer',
+                   permissions={'read': ['alice']}).save()
+        Annotation.fetch('1').delete()
+
+        res = Tombstone.since(user=MockUser('alice'))
+        assert_equal([t['id'] for t in res], ['1'])
+
+        res = Tombstone.since(user=MockUser('bob'))
+        assert_equal(res, [])
+
+    def test_purge(self):
+        old = (datetime.datetime.utcnow() -
+               datetime.timedelta(days=60)).isoformat()
+        Tombstone(id='1', deleted=old).save()
+        Tombstone(id='2', deleted=datetime.datetime.utcnow().isoformat()).save()
+
+        Tombstone.purge(datetime.timedelta(days=30))
+        es.conn.indices.refresh(es.index)
+
+        assert_equal(Tombstone.fetch('1'), None)
+        assert_not_equal(Tombstone.fetch('2'), None)
@@ -0,0 +1,85 @@
+from nose.tools import *
+
+from annotator import transforms
+from annotator.transforms import PerDocument, Pipeline
+
+
+def _hit(id, doc_type='annotation', **source):
+    return {'_index': 'annotator', '_type': doc_type, '_id': id,
+            '_source': source}
+
+
+def drop_odd(hit):
+    if int(hit['_id']) % 2:
+        return None
+    return hit
+
+
+def add_tag(hits):
+    for hit in hits:
+        hit['_source'].setdefault('tags', []).append('migrated')
+    return hits
+
+
+class TestPipeline(object):
+
+    def test_run(self):
+        pipeline = Pipeline([PerDocument(drop_odd), add_tag], chunk_docs=3)
+        hits = list(pipeline.run(_hit(str(i)) for i in range(10)))
+        assert_equal([h['_id'] for h in hits], ['0', '2', '4', '6', '8'])
+        assert_equal(hits[0]['_source']['tags'], ['migrated'])
+
+        stats = pipeline.stats()
+        assert_equal([s['stage'] for s in stats], ['drop_odd', 'add_tag'])
+        assert_equal([s['docs'] for s in stats], [10, 5])
+
+    def test_processes(self):
+        pipeline = Pipeline([PerDocument(drop_odd), add_tag], chunk_docs=2,
+                            processes=2)
+        try:
+            hits = list(pipeline.run(_hit(str(i)) for i in range(10)))
+        finally:
+            pipeline.close()
+        assert_equal([h['_id'] for h in hits], ['0', '2', '4', '6', '8'])
+        assert_equal([s['docs'] for s in pipeline.stats()], [10, 5])
+
+    def test_get_stage(self):
+        assert_equal(transforms.get_stage('normalize-user').name,
+                     'normalize_user')
+        assert_equal(transforms.get_stage('tests.test_transforms:add_tag'),
+                     add_tag)
+        assert_raises(ValueError, transforms.get_stage, 'foo')
+
+
+class TestStages(object):
+
+    def test_normalize_user(self):
+        hit = transforms.normalize_user(_hit('1', user={'id': 'alice'}))
+        assert_equal(hit['_source']['user'], 'alice')
+        hit = transforms.normalize_user(_hit('1', user='bob'))
+        assert_equal(hit['_source']['user'], 'bob')
+
+    def test_schema_version(self):
+        hit = transforms.schema_version(_hit('1'))
+        assert_equal(hit['_source']['annotator_schema_version'], 'v1.0')
+        hit = transforms.schema_version(
+            _hit('1', annotator_schema_version='v2.0'))
+        assert_equal(hit['_source']['annotator_schema_version'], 'v2.0')
+        hit = transforms.schema_version(_hit('1', doc_type='tombstone'))
+        assert_false('annotator_schema_version' in hit['_source'])
+
+    def test_canonical_uri(self):
+        hit = transforms.canonical_uri(
+            _hit('1', uri='HTTP://Example.COM:80/Path?q=1#section'))
+        assert_equal(hit['_source']['uri'], 'http://example.com/Path?q=1')
+
+        hit = transforms.canonical_uri(_hit('1', doc_type='document', link=[
+            {'href': 'https://example.com:443'},
+            {'href': 'doi:10.1000/182'}]))
+        assert_equal([l['href'] for l in hit['_source']['link']],
+                     ['https://example.com/', 'doi:10.1000/182'])
+
+    def test_canonical_uri_malformed(self):
+        for uri in ('http://example.com:eighty/', 'http://[::1/'):
+            hit = transforms.canonical_uri(_hit('1', uri=uri))
+            assert_equal(hit['_source']['uri'], uri)
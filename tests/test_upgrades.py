@@ -0,0 +1,93 @@
+from nose.tools import *
+
+from . import TestCase
+from annotator import authz, es
+from annotator.annotation import Annotation
+from annotator.upgrades import Upgrades, WriteBack
+
+
+def _upgrades(write_back=None):
+    upgrades = Upgrades(write_back=write_back)
+
+    @upgrades.register('annotation', None, 'v1.0')
+    def user_id(source):
+        if isinstance(source.get('user'), dict):
+            source['user'] = source['user']['id']
+
+    @upgrades.register('annotation', 'v1.0', 'v2.0')
+    def text(source):
+        return dict(source, text=source.get('text', '').strip())
+
+    return upgrades
+
+
+class TestUpgrades(object):
+
+    def test_upgrade(self):
+        source = _upgrades().upgrade('annotation', {'user': {'id': 'alice'},
+                                                    'text': ' Hi '})
+        assert_equal(source, {'user': 'alice', 'text': 'Hi',
+                              'annotator_schema_version': 'v2.0'})
+
+    def test_upgrade_from_version(self):
+        source = _upgrades().upgrade('annotation', {
+            'user': {'id': 'alice'}, 'annotator_schema_version': 'v1.0'})
+        assert_equal(source['user'], {'id': 'alice'})
+        assert_equal(source['annotator_schema_version'], 'v2.0')
+
+    def test_upgrade_not_needed(self):
+        upgrades = _upgrades()
+        assert_is_none(upgrades.upgrade('annotation', {
+            'annotator_schema_version': 'v2.0'}))
+        assert_is_none(upgrades.upgrade('document', {}))
+
+    def test_register_twice(self):
+        upgrades = _upgrades()
+        decorator = upgrades.register('annotation', 'v1.0', 'v1.1')
+        assert_raises(ValueError, decorator, lambda source: None)
+
+
+class TestUpgradesOnRead(TestCase):
+
+    def setup(self):
+        super(TestUpgradesOnRead, self).setup()
+        self.permissions = {'read': [authz.GROUP_WORLD]}
+        es.conn.index(index=es.index, doc_type='annotation', id='old',
+                      body={'user': {'id': 'alice'}, 'text': 'Old ',
+                            'permissions': self.permissions},
+                      refresh=True)
+        self.write_back = WriteBack(es)
+        es.upgrades = _upgrades(self.write_back)
+
+    def teardown(self):
+        es.upgrades = None
+        super(TestUpgradesOnRead, self).teardown()
+
+    def _stored(self):
+        return es.conn.get(index=es.index, doc_type='annotation',
+                           id='old')['_source']
+
+    def test_fetch(self):
+        ann = Annotation.fetch('old')
+        assert_equal(ann['user'], 'alice')
+        assert_equal(ann['annotator_schema_version'], 'v2.0')
+
+    def test_search(self):
+        anns = Annotation.search()
+        assert_equal([(a['user'], a['text']) for a in anns],
+                     [('alice', 'Old')])
+
+    def test_write_back(self):
+        Annotation.search()
+        assert_equal(self._stored()['user'], {'id': 'alice'})
+        self.write_back.flush()
+        assert_equal(self._stored(), {'user': 'alice', 'text': 'Old',
+                                      'permissions': self.permissions,
+                                      'annotator_schema_version': 'v2.0'})
+
+    def test_write_back_conflict(self):
+        Annotation.search()
+        es.conn.index(index=es.index, doc_type='annotation', id='old',
+                      body={'user': 'bob', 'text': 'Changed'}, refresh=True)
+        self.write_back.flush()
+        assert_equal(self._stored(), {'user': 'bob', 'text': 'Changed'})